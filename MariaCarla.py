@@ -3,11 +3,28 @@ import os
 import logging
 import traceback
 import json
-from flask import Flask, request, jsonify, render_template, send_from_directory # Aggiunto send_from_directory
-from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import OllamaEmbeddings
-import ollama
+import threading
+import time
+from contextlib import contextmanager
+from flask import Flask, request, jsonify, render_template, send_from_directory, Response, stream_with_context, g # Aggiunto send_from_directory
+from ollama_client import OllamaClientManager
+from ollama_scheduler import OllamaScheduler, EmbeddingBatcher, QueueFullError, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND
 import mysql.connector
+from db_pool import DBPool
+from answer_cache import SQLCache
+from result_cache import ResultCache, page_of
+from sql_examples import SQLExampleStore
+from schema_catalog import SchemaCatalog
+from schema_retriever import SchemaRetriever
+from doc_retriever import DocumentRetriever, CachedOllamaEmbeddings, CrossEncoderReranker
+from intent_router import IntentRouter
+from chat_sessions import SessionStore
+import metrics
+from metrics import observe_stage, timed
+from sql_guard import SQLRejected, prepare_sql, check_explain
+from sql_assistant import ResultCollector, column_types, result_window, sql_result_to_csv
+from ask_flow import (AskFlow, SchemaUnavailable, answer, run_steps, sse_event, with_session, BUSY_MESSAGE,
+                      EMBEDDING, COMPLETION, CHAT, CHAT_STREAM, SCHEMA, SQL, DOCUMENTS, CALL)
 
 
 try:
@@ -18,16 +35,90 @@ except ImportError:
 # --- Configurazione ---
 VECTORSTORE_DOCS_DIR = "vectorstore_docs"
 OLLAMA_MODEL_NAME = os.environ.get("OLLAMA_MODEL_NAME", "MariaCarla")
-OLLAMA_HOST = "http://localhost:11434"
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
 CHROMA_DOCS_COLLECTION_NAME = "rag_documents_collection"
+SCHEMA_CATALOG_TTL = int(os.environ.get("SCHEMA_CATALOG_TTL", "300")) # Secondi tra due controlli di freschezza dello schema
+SCHEMA_INDEX_DIR = "vectorstore_schema" # Indice BM25 di tabelle/colonne, accanto a vectorstore_docs
+SCHEMA_TOP_K = int(os.environ.get("SCHEMA_TOP_K", "8")) # Tabelle pertinenti da passare al modello (piu' i vicini via FK)
+SCHEMA_TOKEN_BUDGET = int(os.environ.get("SCHEMA_TOKEN_BUDGET", "2000")) # Sopra questa soglia lo schema viene ridotto
+OLLAMA_EMBED_MODEL = os.environ.get("OLLAMA_EMBED_MODEL", OLLAMA_MODEL_NAME) # Modello per gli embedding delle domande
+OLLAMA_DOCS_EMBED_MODEL = os.environ.get("OLLAMA_DOCS_EMBED_MODEL", OLLAMA_EMBED_MODEL) # Deve essere lo stesso usato da create_vectorstore_docs.py
+RAG_TOP_K = int(os.environ.get("RAG_TOP_K", "3")) # Chunk di documenti passati al modello
+RAG_CANDIDATES = int(os.environ.get("RAG_CANDIDATES", "20")) # Posizioni densa e BM25 fuse (RRF) prima di scegliere i top k
+RAG_RERANK_MODEL = os.environ.get("RAG_RERANK_MODEL", "") # Cross-encoder locale per il riordino (sentence-transformers, "" = disattivo)
+RAG_BACKEND = os.environ.get("RAG_BACKEND", "chroma") # "locale" = indice memory-mapped esportato con create_vectorstore_docs.py --local-index
+RAG_IVF_NPROBE = int(os.environ.get("RAG_IVF_NPROBE", "8")) # Gruppi IVF visitati per domanda (indice locale con IVF)
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "1024")) # Embedding di domande tenuti in LRU
+SQL_CACHE_MAX_ENTRIES = int(os.environ.get("SQL_CACHE_MAX_ENTRIES", "500"))
+SQL_CACHE_TTL = int(os.environ.get("SQL_CACHE_TTL", "3600")) # Secondi di validita' di un SQL in cache
+SQL_CACHE_SIMILARITY = float(os.environ.get("SQL_CACHE_SIMILARITY", "0.95")) # Soglia coseno per la cache semantica
+SQL_EXAMPLES_FILE = os.environ.get("SQL_EXAMPLES_FILE", "sql_examples.sqlite3") # Domande -> SQL riuscite, per few-shot e modelli ("" = disattivo)
+SQL_EXAMPLES_MAX = int(os.environ.get("SQL_EXAMPLES_MAX", "2000")) # Esempi tenuti, oltre si tolgono fallimenti e meno usati
+SQL_FEW_SHOT = int(os.environ.get("SQL_FEW_SHOT", "3")) # Esempi simili messi nel prompt di generazione SQL
+SQL_FEW_SHOT_SIMILARITY = float(os.environ.get("SQL_FEW_SHOT_SIMILARITY", "0.6")) # Soglia coseno per usare un esempio
+INTENT_MIN_CONFIDENCE = float(os.environ.get("INTENT_MIN_CONFIDENCE", "0.6")) # Sotto questa confidenza il router chiede al modello
+INTENT_EXAMPLES_FILE = os.environ.get("INTENT_EXAMPLES_FILE", "intent_examples.jsonl") # Esempi etichettati {"domanda", "intento"} in aggiunta a quelli di base
+INTENT_LOG_FILE = os.environ.get("INTENT_LOG_FILE", "intent_log.jsonl") # Decisioni del router, da rivedere ed etichettare ("" = nessun log)
+INTENT_LOG_MAX_MB = float(os.environ.get("INTENT_LOG_MAX_MB", "10")) # Oltre questa misura il log passa a .1 e ricomincia (0 = nessun limite)
+SESSION_DIR = os.environ.get("SESSION_DIR", "sessions") # Un file JSON per conversazione ("" = solo in memoria)
+SESSION_TTL = int(os.environ.get("SESSION_TTL", "7200")) # Secondi di inattivita' dopo cui una conversazione scade
+SESSION_TOKEN_BUDGET = int(os.environ.get("SESSION_TOKEN_BUDGET", "1500")) # Token di storico oltre cui i turni vecchi vengono riassunti
+SESSION_KEEP_TURNS = int(os.environ.get("SESSION_KEEP_TURNS", "4")) # Turni recenti sempre tenuti per intero
+SESSION_PURGE_EVERY = int(os.environ.get("SESSION_PURGE_EVERY", "100")) # Salvataggi tra una pulizia e l'altra dei file di sessione scaduti (0 = mai)
+SQL_PAGE_SIZE = int(os.environ.get("SQL_PAGE_SIZE", "100")) # Righe per pagina nei risultati SQL
+SQL_MAX_ROWS = int(os.environ.get("SQL_MAX_ROWS", "1000")) # Oltre questo numero di righe la lettura si ferma (risultato troncato)
+SQL_FETCH_BATCH = int(os.environ.get("SQL_FETCH_BATCH", "200")) # Righe lette per ogni fetchmany
+SQL_MAX_EXECUTION_MS = int(os.environ.get("SQL_MAX_EXECUTION_MS", "10000")) # Tempo massimo per query (0 = nessun limite)
+SQL_EXPLAIN_MAX_ROWS = int(os.environ.get("SQL_EXPLAIN_MAX_ROWS", "5000000")) # Righe stimate da EXPLAIN oltre cui la query e' rifiutata (0 = nessun controllo)
+SQL_FULL_SCAN_MAX_ROWS = int(os.environ.get("SQL_FULL_SCAN_MAX_ROWS", "1000000")) # Full scan ammesso solo su tabelle piu' piccole (0 = nessun controllo)
+RESULT_CACHE_MB = float(os.environ.get("RESULT_CACHE_MB", "64")) # Memoria per i risultati delle query gia' eseguite (0 = nessuna cache)
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", "300")) # Secondi massimi di validita', anche senza scritture (tabelle senza UPDATE_TIME)
+RESULT_CACHE_CHECK_SECONDS = float(os.environ.get("RESULT_CACHE_CHECK_SECONDS", "2")) # Ogni quanto si rileggono gli UPDATE_TIME (ritardo massimo nel vedere una scrittura)
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "") # Cartella per i risultati tolti dalla memoria ("" = nessuno spill su disco)
+RESULT_CACHE_DISK_MB = float(os.environ.get("RESULT_CACHE_DISK_MB", "256")) # Spazio massimo su disco per lo spill
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1")) # Processi worker (gunicorn.conf.py): il tetto verso Ollama e' diviso tra loro
+FLASK_DEBUG = os.environ.get("FLASK_DEBUG", "0") == "1" # Debug del server di sviluppo (python MariaCarla.py)
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4")) # Richieste parallele per modello del server Ollama (stessa variabile del server)
+OLLAMA_MAX_CONCURRENCY = int(os.environ.get("OLLAMA_MAX_CONCURRENCY", str(max(1, -(-OLLAMA_NUM_PARALLEL // WEB_CONCURRENCY))))) # Chiamate contemporanee verso Ollama per processo, le altre in coda
+OLLAMA_MAX_QUEUE = int(os.environ.get("OLLAMA_MAX_QUEUE", "32")) # Domande in attesa oltre le quali si risponde 429
+OLLAMA_MAX_BACKGROUND = int(os.environ.get("OLLAMA_MAX_BACKGROUND", "0")) # Slot massimi per keep-warm e addestramento del router (0 = meta')
+EMBED_BATCH_WINDOW_MS = float(os.environ.get("EMBED_BATCH_WINDOW_MS", "5")) # Attesa per raggruppare gli embedding di domande contemporanee (0 = disattivo)
+EMBED_BATCH_MAX = int(os.environ.get("EMBED_BATCH_MAX", "32")) # Testi massimi in una chiamata di embedding
+OLLAMA_DEFAULT_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m") # Quanto Ollama tiene in memoria un modello inutilizzato
+OLLAMA_KEEP_ALIVE = { # keep_alive per modello (-1 = sempre caricato)
+    OLLAMA_MODEL_NAME: OLLAMA_DEFAULT_KEEP_ALIVE,
+}
+OLLAMA_KEEP_WARM_INTERVAL = int(os.environ.get("OLLAMA_KEEP_WARM_INTERVAL", "240")) # Secondi tra due ping di keep-warm (0 = disattivo)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
-vector_store_docs = None
-db_connection = None
+ollama_manager = OllamaClientManager(OLLAMA_HOST, keep_alive=OLLAMA_KEEP_ALIVE, default_keep_alive=OLLAMA_DEFAULT_KEEP_ALIVE,
+                                     max_connections=OLLAMA_MAX_CONCURRENCY * 2, embedding_cache_size=EMBEDDING_CACHE_SIZE)
+# Tetto allineato a OLLAMA_NUM_PARALLEL (diviso tra i worker): oltre, Ollama accoderebbe per conto suo senza priorita'
+ollama_scheduler = OllamaScheduler(OLLAMA_MAX_CONCURRENCY, OLLAMA_MAX_QUEUE, OLLAMA_MAX_BACKGROUND or None)
+ollama_manager.scheduler = ollama_scheduler # I ping di keep-warm passano in background
 
+def embed_many(model, texts, priority=PRIORITY_INTERACTIVE):
+    with ollama_scheduler.slot(priority):
+        return ollama_manager.embed(model, texts)['embeddings']
+
+if EMBED_BATCH_WINDOW_MS > 0:
+    # Le domande che arrivano insieme da thread diversi fanno un solo /api/embed
+    ollama_manager.embedding_batcher = EmbeddingBatcher(embed_many, max_batch=EMBED_BATCH_MAX,
+                                                        window=EMBED_BATCH_WINDOW_MS / 1000)
+document_retriever = DocumentRetriever(VECTORSTORE_DOCS_DIR, CHROMA_DOCS_COLLECTION_NAME,
+                                       CachedOllamaEmbeddings(ollama_manager, OLLAMA_DOCS_EMBED_MODEL), k=RAG_TOP_K,
+                                       candidates=RAG_CANDIDATES,
+                                       reranker=CrossEncoderReranker(RAG_RERANK_MODEL) if RAG_RERANK_MODEL else None,
+                                       backend=RAG_BACKEND, nprobe=RAG_IVF_NPROBE)
+db_pool = None
+# Tempi di avvio e processo che ha fatto preload() / init_worker(), riportati in /stats
+startup_info = {"preload_pid": None, "preload_s": None, "worker_pid": None, "worker_init_s": None, "started": None}
+worker_init_lock = threading.Lock()
+
+@observe_stage("llm")
 def get_ollama_completion(prompt_text, system_message=None, temperature=0.3, is_json=False):
     messages = []
     if system_message:
@@ -35,13 +126,13 @@ def get_ollama_completion(prompt_text, system_message=None, temperature=0.3, is_
     messages.append({'role': 'user', 'content': prompt_text})
 
     try:
-        client = ollama.Client(host=OLLAMA_HOST)
-        response = client.chat(
-            model=OLLAMA_MODEL_NAME,
-            messages=messages,
-            options={'temperature': temperature},
-            format='json' if is_json else ''
-        )
+        with ollama_scheduler.slot():
+            response = ollama_manager.chat(
+                model=OLLAMA_MODEL_NAME,
+                messages=messages,
+                options={'temperature': temperature},
+                format='json' if is_json else ''
+            )
         content = response['message']['content']
         if is_json:
             try:
@@ -50,96 +141,256 @@ def get_ollama_completion(prompt_text, system_message=None, temperature=0.3, is_
                 logger.error(f"Errore JSON da Ollama: {e}. Raw: {content}")
                 raise ValueError(f"Ollama non ha restituito JSON valido: {content}")
         return content
+    except QueueFullError:
+        raise
     except Exception as e:
         logger.error(f"Errore Ollama ({OLLAMA_MODEL_NAME}): {e}")
         logger.error(traceback.format_exc())
         raise
 
-def get_db_connection():
-    global db_connection
-    if db_connection and db_connection.is_connected():
-        return db_connection
+@observe_stage("llm")
+def get_ollama_chat(messages, temperature=0.3):
+    # Risposta completa di Ollama (testo, token e tempi), per i turni di cui si misura il prefill
+    try:
+        with ollama_scheduler.slot():
+            return ollama_manager.chat(model=OLLAMA_MODEL_NAME, messages=messages, options={'temperature': temperature})
+    except QueueFullError:
+        raise
+    except Exception as e:
+        logger.error(f"Errore Ollama ({OLLAMA_MODEL_NAME}): {e}")
+        logger.error(traceback.format_exc())
+        raise
+
+def get_ollama_chat_stream(messages, done, temperature=0.3):
+    # Restituisce i pezzi di testo man mano che Ollama li genera (prima l'evento "coda" se si e' atteso);
+    # l'ultimo chunk (token e tempi) viene messo in done['response']. Lo slot resta occupato fino all'ultimo chunk (o alla chiusura del client).
+    try:
+        with ollama_scheduler.slot() as position:
+            if position:
+                yield ("coda", {"posizione": position})
+            for chunk in ollama_manager.chat_stream(
+                model=OLLAMA_MODEL_NAME,
+                messages=messages,
+                options={'temperature': temperature}
+            ):
+                if chunk.get('done'):
+                    done['response'] = chunk
+                content = chunk['message']['content']
+                if content:
+                    yield content
+    except QueueFullError:
+        raise
+    except Exception as e:
+        logger.error(f"Errore Ollama stream ({OLLAMA_MODEL_NAME}): {e}")
+        logger.error(traceback.format_exc())
+        raise
+
+def get_ollama_embedding(text):
+    return ollama_manager.embed_query(OLLAMA_EMBED_MODEL, text)
+
+def get_db_pool():
+    global db_pool
+    if db_pool:
+        return db_pool
     if not DB_CONFIG:
         logger.error("db_config.py non trovato o DB_CONFIG non definito.")
         return None
     try:
-        logger.info(f"Connessione a MySQL: {DB_CONFIG['host']}/{DB_CONFIG['database']}")
-        db_connection = mysql.connector.connect(**DB_CONFIG)
-        if db_connection.is_connected():
-            logger.info("Connessione MySQL OK.")
-            return db_connection
+        logger.info(f"Creazione pool MySQL: {DB_CONFIG['host']}/{DB_CONFIG['database']}")
+        db_pool = DBPool(DB_CONFIG)
+        logger.info(f"Pool MySQL OK ({db_pool.pool_size} connessioni, overflow {db_pool.max_overflow}).")
     except mysql.connector.Error as err:
         logger.error(f"Errore connessione MySQL: {err}")
-        db_connection = None
-    return None
-
-def get_db_schema_string():
-    conn = get_db_connection()
-    if not conn:
-        return "Errore: Impossibile connettersi al database."
-    
-    schema_info = []
+        db_pool = None
+    return db_pool
+
+def close_db_pool():
+    global db_pool
+    if db_pool:
+        db_pool.close()
+        db_pool = None
+
+@contextmanager
+def get_db_connection():
+    # Una connessione dal pool per la durata del blocco 'with', poi restituita
+    pool = get_db_pool()
+    if not pool:
+        raise ConnectionError("Connessione DB non disponibile.")
+    with pool.connection() as conn:
+        yield conn
+
+@observe_stage("schema")
+def get_db_schema_string(question=None, session=None):
+    # Lo schema arriva dal catalogo in memoria: niente SHOW TABLES + DESCRIBE ad ogni domanda.
+    # Con una domanda si passano solo le tabelle pertinenti (entro SCHEMA_TOKEN_BUDGET).
+    # In una conversazione lo schema resta quello dei turni prima, piu' le eventuali tabelle nuove.
     try:
-        cursor = conn.cursor()
-        cursor.execute("SHOW TABLES")
-        tables = cursor.fetchall()
-        if not tables:
-            return "Database vuoto o tabelle non trovate."
-
-        schema_info.append("Schema Database:\n")
-        for (table_name,) in tables:
-            schema_info.append(f"Tabella: {table_name}\nColonne:")
-            cursor.execute(f"DESCRIBE `{table_name}`") # Usa backtick per nomi tabelle con caratteri speciali
-            columns = cursor.fetchall()
-            for col in columns:
-                schema_info.append(f"  - {col[0]} ({col[1]})")
-            schema_info.append("\n")
-        cursor.close()
-        return "".join(schema_info)
+        if session is not None:
+            pinned = session.schema_tables if session.schema_version == schema_catalog.version else ()
+            schema_string, tables = schema_retriever.get_session_schema(question, pinned)
+            if schema_string:
+                session.schema, session.schema_tables, session.schema_version = schema_string, tables, schema_catalog.version
+        elif question:
+            schema_string = schema_retriever.get_schema_string(question)
+        else:
+            schema_string = schema_catalog.get_schema_string()
+    except ConnectionError:
+        raise SchemaUnavailable("Errore: Impossibile connettersi al database.")
     except mysql.connector.Error as err:
         logger.error(f"Errore MySQL ottenimento schema: {err}")
-        return f"Errore ottenimento schema DB: {err}"
+        raise SchemaUnavailable(f"Errore ottenimento schema DB: {err}")
+    if not schema_string:
+        return "Database vuoto o tabelle non trovate."
+    return schema_string
 
-def execute_sql_query(sql_query):
-    conn = get_db_connection()
-    if not conn:
-        return {"error": "Connessione DB non disponibile."}
-
-    results = []
-    column_names = []
+@observe_stage("esecuzione_sql")
+def execute_sql_query(sql_query, offset=0, page_size=SQL_PAGE_SIZE):
     try:
         logger.info(f"Esecuzione SQL: {sql_query}")
-        # Sanificazione (MINIMA - NON PER PRODUZIONE!)
-        if not sql_query.strip().upper().startswith("SELECT"):
-            logger.warning(f"Query non-SELECT bloccata: {sql_query}")
-            return {"error": "Permesse solo query SELECT."}
-
-        cursor = conn.cursor(dictionary=True)
-        cursor.execute(sql_query)
-        
-        if cursor.description:
-            column_names = [desc[0] for desc in cursor.description]
-            results = cursor.fetchall()
-            logger.info(f"Query OK, {len(results)} righe.")
-        else:
-            conn.commit() 
-            logger.info(f"Query OK (senza risultati, rowcount: {cursor.rowcount}).")
-        
-        cursor.close()
-        return {"columns": column_names, "rows": results, "rowcount": len(results)}
+        # Una sola SELECT, LIMIT imposto dal codice e tempo massimo per statement
+        sql_query = prepare_sql(sql_query, SQL_MAX_ROWS, SQL_MAX_EXECUTION_MS)
+
+        ticket = None
+        if result_cache:
+            with timed("cache_risultati"):
+                cached, ticket = result_cache.lookup(sql_query)
+            if cached is not None:
+                logger.info(f"Risultato da cache ({cached['rowcount']} righe).")
+                return page_of(cached, offset, page_size)
+        # Da mettere in cache: si tengono tutte le righe (fino a SQL_MAX_ROWS), non solo la pagina
+        collector = ResultCollector(0, SQL_MAX_ROWS, SQL_MAX_ROWS) if ticket else ResultCollector(offset, page_size, SQL_MAX_ROWS)
+        columns = []
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            if SQL_EXPLAIN_MAX_ROWS or SQL_FULL_SCAN_MAX_ROWS:
+                # Stima del costo prima di eseguire: join esplosivi e full scan su tabelle grandi vengono rifiutati
+                cursor.execute(f"EXPLAIN {sql_query}")
+                rejection = check_explain(cursor.column_names, cursor.fetchall(), SQL_EXPLAIN_MAX_ROWS, SQL_FULL_SCAN_MAX_ROWS,
+                                          sql_query)
+                if rejection:
+                    cursor.close()
+                    raise SQLRejected(rejection)
+            cursor.execute(sql_query)
+
+            if cursor.description:
+                columns = column_types(cursor.description)
+                # Lettura a blocchi: si tiene solo la pagina richiesta, ci si ferma a SQL_MAX_ROWS
+                while True:
+                    batch = cursor.fetchmany(SQL_FETCH_BATCH)
+                    if not batch or not collector.add(batch):
+                        break
+                if collector.truncated:
+                    conn.consume_results() # Scarta le righe non lette senza costruirle
+                logger.info(f"Query OK, {collector.seen} righe lette{' (troncato)' if collector.truncated else ''}.")
+            else:
+                conn.commit()
+                logger.info(f"Query OK (senza risultati, rowcount: {cursor.rowcount}).")
+
+            cursor.close()
+        if ticket:
+            result = collector.result(columns)
+            result_cache.store(ticket, result)
+            return page_of(result, offset, page_size)
+        return collector.result(columns)
+    except SQLRejected as err:
+        logger.warning(f"Query bloccata: {err} ({sql_query})")
+        return {"error": str(err)}
+    except ConnectionError as err:
+        return {"error": str(err)}
     except mysql.connector.Error as err:
         logger.error(f"Errore MySQL query '{sql_query}': {err}")
         return {"error": f"Errore MySQL: {err}"}
     except Exception as e:
         logger.error(f"Errore imprevisto query '{sql_query}': {e}")
         return {"error": f"Errore imprevisto: {e}"}
-logger.info(f"Avvio App con modello Ollama: {OLLAMA_MODEL_NAME} su {OLLAMA_HOST}")
-get_db_connection()
+
+schema_catalog = SchemaCatalog(get_db_connection, ttl_seconds=SCHEMA_CATALOG_TTL)
+result_cache = ResultCache(get_db_connection, max_bytes=int(RESULT_CACHE_MB * 1024 * 1024), ttl_seconds=RESULT_CACHE_TTL,
+                           check_seconds=RESULT_CACHE_CHECK_SECONDS, spill_dir=RESULT_CACHE_DIR or None,
+                           max_disk_bytes=int(RESULT_CACHE_DISK_MB * 1024 * 1024)) if RESULT_CACHE_MB > 0 else None
+sql_cache = SQLCache(get_ollama_embedding, max_entries=SQL_CACHE_MAX_ENTRIES,
+                     ttl_seconds=SQL_CACHE_TTL, similarity_threshold=SQL_CACHE_SIMILARITY)
+sql_examples = SQLExampleStore(SQL_EXAMPLES_FILE, max_examples=SQL_EXAMPLES_MAX,
+                              min_similarity=SQL_FEW_SHOT_SIMILARITY) if SQL_EXAMPLES_FILE else None
+schema_retriever = SchemaRetriever(schema_catalog, SCHEMA_INDEX_DIR, top_k=SCHEMA_TOP_K, token_budget=SCHEMA_TOKEN_BUDGET)
+intent_router = IntentRouter(lambda texts: embed_many(OLLAMA_EMBED_MODEL, texts, PRIORITY_BACKGROUND),
+                             examples_path=INTENT_EXAMPLES_FILE, log_path=INTENT_LOG_FILE or None,
+                             min_confidence=INTENT_MIN_CONFIDENCE, log_max_bytes=int(INTENT_LOG_MAX_MB * 1024 * 1024))
+
+session_store = SessionStore(SESSION_DIR or None, ttl_seconds=SESSION_TTL, purge_every=SESSION_PURGE_EVERY)
+
+ask_flow = AskFlow(intent_router, sql_cache, sql_examples, schema_catalog, document_retriever, session_store,
+                   page_size=SQL_PAGE_SIZE, few_shot=SQL_FEW_SHOT, session_token_budget=SESSION_TOKEN_BUDGET,
+                   session_keep_turns=SESSION_KEEP_TURNS)
+# Come si esegue ogni passo di ask_flow in questa app: chiamate sincrone, un thread per richiesta
+ask_handlers = {
+    EMBEDDING: get_ollama_embedding,
+    COMPLETION: lambda prompt_text, system_message: get_ollama_completion(prompt_text, system_message=system_message),
+    CHAT: get_ollama_chat,
+    CHAT_STREAM: get_ollama_chat_stream,
+    SCHEMA: get_db_schema_string,
+    SQL: execute_sql_query,
+    DOCUMENTS: document_retriever.retrieve,
+    CALL: lambda fn: fn(),
+}
+
+def preload_schema_catalog():
+    try:
+        schema_catalog.refresh(force=True)
+        schema_retriever.ensure_index()
+    except (ConnectionError, mysql.connector.Error) as err:
+        logger.error(f"Catalogo schema non precaricato: {err}")
+
+def preload():
+    # Stato in sola lettura condiviso dai worker: con gunicorn.conf.py gira una volta nel master prima
+    # del fork (e di nuovo a ogni kill -HUP) e le pagine restano condivise copy-on-write.
+    # Le connessioni MySQL aperte qui vengono chiuse: ogni worker apre le sue.
+    start = time.perf_counter()
+    logger.info(f"Avvio App con modello Ollama: {OLLAMA_MODEL_NAME} su {OLLAMA_HOST}")
+    document_retriever.load(chroma=False)
+    preload_schema_catalog()
+    close_db_pool()
+    ollama_manager.warm_up([OLLAMA_MODEL_NAME], [OLLAMA_EMBED_MODEL, OLLAMA_DOCS_EMBED_MODEL])
+    intent_router.train()
+    startup_info["preload_pid"] = os.getpid()
+    startup_info["preload_s"] = round(time.perf_counter() - start, 2)
+    logger.info(f"Precaricamento completato in {startup_info['preload_s']}s, memoria {metrics.process_memory()}.")
+
+def init_worker():
+    # Nel processo che serve le richieste: dopo un fork connessioni proprie verso MySQL e Ollama,
+    # poi Chroma (se non c'e' l'indice locale) e keep-warm. Senza preload() prima, lo fa qui.
+    global db_pool
+    start = time.perf_counter()
+    if startup_info["preload_pid"] is None:
+        preload()
+    elif startup_info["preload_pid"] != os.getpid():
+        db_pool = None
+        ollama_manager.after_fork()
+    if not document_retriever.ready:
+        document_retriever.load()
+    get_db_pool()
+    ollama_manager.start_keep_warm([OLLAMA_MODEL_NAME], [OLLAMA_EMBED_MODEL, OLLAMA_DOCS_EMBED_MODEL], interval=OLLAMA_KEEP_WARM_INTERVAL)
+    startup_info["worker_pid"] = os.getpid()
+    startup_info["worker_init_s"] = round(time.perf_counter() - start, 2)
+    startup_info["started"] = time.time()
+    logger.info(f"Worker {os.getpid()} pronto in {startup_info['worker_init_s']}s, memoria {metrics.process_memory()}.")
+
+def process_info():
+    info = {"pid": os.getpid(), "workers": WEB_CONCURRENCY, "preload_s": startup_info["preload_s"],
+            "worker_init_s": startup_info["worker_init_s"]}
+    if startup_info["started"]:
+        info["uptime_s"] = round(time.time() - startup_info["started"])
+    return {**info, **metrics.process_memory()}
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def queue_full_response(err):
+    # Backpressure: meglio un 429 subito che una domanda che scade in coda
+    response = jsonify({"risposta": BUSY_MESSAGE, "posizione_coda": err.waiting + 1})
+    return response, 429, {"Retry-After": "5"}
+
 @app.route('/ask', methods=['POST'])
 def ask_assistant():
     data = request.get_json()
@@ -148,89 +399,100 @@ def ask_assistant():
         return jsonify({"risposta": "Domanda mancante."}), 400
     #user_question = "elencami le prime 15 righe della tabella d"
     logger.info(f"Ricevuta domanda: {user_question}")
-    response_text = "Non sono riuscito a elaborare la tua richiesta."
+    # Le pagine successive si chiedono ripetendo la domanda con "pagina": l'SQL arriva dalla cache
+    offset, page_size, as_csv = result_window(data, SQL_PAGE_SIZE, SQL_MAX_ROWS)
+    # Con "sessione" la domanda fa parte di una conversazione (storico lato server)
+    session = ask_flow.get_session(data)
+    try:
+        ollama_scheduler.check()
+        payload, query_results = answer(ask_flow.steps(user_question, session, offset, page_size), ask_handlers)
+    except QueueFullError as err:
+        logger.warning(str(err))
+        return queue_full_response(err)
+    if as_csv and query_results is not None:
+        return Response(sql_result_to_csv(query_results), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=risultato.csv'})
+    return jsonify(payload)
 
+@app.route('/ask/stream', methods=['POST'])
+def ask_assistant_stream():
+    # Come /ask, ma in Server-Sent Events: i token del modello arrivano al browser appena
+    # generati (evento "token", con il blocco <think> gia' rimosso) e la risposta finale
+    # chiude lo stream (evento "done").
+    data = request.get_json()
+    user_question = data.get('domanda')
+    if not user_question:
+        return jsonify({"risposta": "Domanda mancante."}), 400
+    logger.info(f"Ricevuta domanda (stream): {user_question}")
+    session = ask_flow.get_session(data)
     try:
-        # Logica di routing (da migliorare con LLM più potente per classificazione)
-        keywords_db = ["database", "tabella", "tabelle", "query", "sql", "dati di", "record di", "elenca da"]
-        is_db_query = any(keyword in user_question.lower() for keyword in keywords_db)
-
-        if is_db_query:
-            logger.info("Rilevata intenzione DB.")
-            db_schema = get_db_schema_string()
-            if "Errore" in db_schema: # Controlla errori dal DB
-                return jsonify({"risposta": db_schema})
-
-            # *** PROMPT SQL GENERATION MODIFICATO (SOLUZIONE 1) ***
-            system_sql_gen = '''
-            Sei un esperto di MySQL. Il tuo compito è generare UNA SOLA query SQL SELECT valida per rispondere alla domanda dell'utente, basandoti sullo schema del database fornito.
-            IMPORTANTE: La tua risposta DEVE contenere ESCLUSIVAMENTE la query SQL, e nient'altro. Inoltre devi aggiungere un limite di 100 righe.
-            Non includere spiegazioni, commenti, testo introduttivo, tag di pensiero, o qualsiasi altra cosa prima o dopo la query SQL.
-            Se la domanda non può essere risposta con una singola query SELECT o richiede informazioni non presenti nello schema, la tua risposta DEVE essere ESATTAMENTE la stringa "NON POSSO GENERARE LA QUERY".
-            Schema Database:
-            {db_schema}
-            '''
-
-            prompt_sql_gen = f"Domanda Utente: {user_question}\nQuery SQL:"
-            # *** FINE MODIFICA PROMPT ***
-            
-            logger.info("Invio a LLM per generazione SQL...")
-#            generated_sql_raw = get_ollama_completion(prompt_sql_gen, system_message=system_sql_gen).strip()
-            generated_sql_raw = get_ollama_completion(prompt_sql_gen, system_message=system_sql_gen).strip()
-            logger.info(f"SQL grezzo da LLM: '{generated_sql_raw}'")
-
-            # Semplice pulizia di virgolette esterne che a volte i modelli aggiungono
-            if generated_sql_raw.startswith('"') and generated_sql_raw.endswith('"'):
-                generated_sql = generated_sql_raw[1:-1].strip()
-            elif generated_sql_raw.startswith("'") and generated_sql_raw.endswith("'"):
-                generated_sql = generated_sql_raw[1:-1].strip()
-            else:
-                generated_sql = generated_sql_raw
+        ollama_scheduler.check()
+    except QueueFullError as err:
+        logger.warning(str(err))
+        return queue_full_response(err)
 
-            logger.info(f"SQL pulito per esecuzione: '{generated_sql}'")
-            pulisco = generated_sql.split('</think>')
-            generated_sql = generated_sql.split('</think>')[1].replace("\n","")
-            if "NON POSSO GENERARE LA QUERY" in generated_sql.upper() or not generated_sql.upper().startswith("SELECT"):
-                response_text = f"Non sono riuscito a generare una query SQL valida. (LLM ha detto: '{generated_sql_raw}')"
-            else:
-                query_results = execute_sql_query(generated_sql)
-                if "error" in query_results:
-                    response_text = f"Errore esecuzione SQL: {query_results['error']}\nSQL: {generated_sql}"
-                elif not query_results.get("rows") and query_results.get("rowcount", 0) == 0 :
-                    response_text = f"Query eseguita, nessun risultato.\nSQL: {generated_sql}"
-                else:
-                    results_for_llm = f"Query SQL Eseguita: {generated_sql}\nRisultati:\n"
-                    results_for_llm += "\n" + ", ".join(query_results['columns']) + "\n"
-
-                    for riga in query_results['rows']:
-                        r = list(riga.values())
-                        try:
-                            r[2] = r[2].strftime("%Y-%m-%d")
-                        except:
-                            pass
-                        r = str(r).replace("'","").replace("[","").replace("]","")
-                        results_for_llm += r + "\n"
-                    #if len(query_results['rows']) > 10: eliminato per superare le 15 righe
-                    #    results_for_llm += f"... e altre {len(query_results['rows']) - 10} righe.\n"
-                    #print('-------> ',results_for_llm)
-                    response_text = results_for_llm
-               #     system_report_gen = "Your name is MariaCarla and you convert data from JSON to CSV."
-               #     prompt_report_gen = f"""
-               #     Convert these data from JSON format to CSV format, use a comma as the separator:
-               #     Data:\n{results_for_llm}\n\n """
-                    
-               #     logger.info("Invio a LLM per generazione report da SQL...")
-               #     response_text = get_ollama_completion(prompt_report_gen, system_message=system_report_gen)
-        
-    except ValueError as ve:
-        logger.error(f"Errore valore: {ve}")
-        response_text = f"Problema dati AI: {ve}"
-    except Exception as e:
-        logger.error(f"Errore generale /ask: {e}", exc_info=True)
-        response_text = f"Errore interno: {e}"
-    #if "<TABELLAHTML>" in response_text:
-    #    return response_text
-    return jsonify({"risposta": response_text})
+    def generate():
+        done = {}
+        try:
+            for event, payload in run_steps(ask_flow.steps(user_question, session, stream=True), ask_handlers, done):
+                yield sse_event(event, payload)
+        except QueueFullError as err:
+            logger.warning(str(err))
+            done['payload'] = with_session({"risposta": BUSY_MESSAGE}, session)
+        yield sse_event("done", done['payload'])
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/sessione/<session_id>', methods=['DELETE'])
+def delete_session(session_id):
+    # "Nuova conversazione" dal frontend: lo storico lato server viene cancellato
+    session_store.delete(session_id)
+    return jsonify({"ok": True})
+
+
+@app.before_request
+def ensure_worker():
+    # Server senza hook (flask run, altri server WSGI): inizializzazione alla prima richiesta del processo
+    if startup_info["worker_pid"] != os.getpid():
+        with worker_init_lock:
+            if startup_info["worker_pid"] != os.getpid():
+                init_worker()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    # Per /ask/stream misura il tempo fino all'inizio dello stream; il resto e' in llm_stream
+    start = getattr(g, 'request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else "altro"
+        metrics.REQUEST_SECONDS.observe(route, str(response.status_code), value=time.perf_counter() - start)
+    return response
+
+@app.route('/metrics')
+def metrics_endpoint():
+    # Formato testo Prometheus, da leggere con uno scrape o a mano
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/stats')
+def stats():
+    # Statistiche per dimensionare il servizio sotto traffico reale
+    pool = get_db_pool()
+    return jsonify({
+        "processo": process_info(),
+        "ollama": ollama_scheduler.stats(),
+        "db_pool": pool.stats() if pool else None,
+        "sql_cache": sql_cache.stats(),
+        "result_cache": result_cache.stats() if result_cache else None,
+        "esempi_sql": sql_examples.stats() if sql_examples else None,
+        "embedding_cache": ollama_manager.embedding_cache_stats(),
+        "documenti": document_retriever.stats(),
+        "sessioni": session_store.stats(),
+    })
 
 
 @app.route('/favicon.ico')
@@ -247,4 +509,6 @@ def favicon():
     return send_from_directory(static_folder, 'favicon.ico', mimetype='image/vnd.microsoft.icon')
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    # Un solo processo, server di sviluppo di Flask. In produzione: gunicorn -c gunicorn.conf.py
+    init_worker()
+    app.run(host='0.0.0.0', port=5000, debug=FLASK_DEBUG, threaded=True)
\ No newline at end of file
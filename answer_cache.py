@@ -0,0 +1,130 @@
+# answer_cache.py
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from bm25 import tokenize
+
+logger = logging.getLogger("answer_cache")
+
+
+def normalize_question(question):
+    text = question.lower().strip()
+    text = re.sub(r"[^\w\s]", " ", text)
+    return " ".join(text.split())
+
+
+class SQLCache:
+    # Cache a due livelli dell'SQL generato, davanti alla chiamata LLM:
+    # 1) esatta sulla domanda normalizzata
+    # 2) semantica: riusa l'SQL di una domanda con embedding abbastanza simile
+    # Eviction LRU + TTL; tutto viene svuotato quando cambia la versione del catalogo schema.
+    def __init__(self, embed_fn, max_entries=500, ttl_seconds=3600, similarity_threshold=0.95):
+        self.embed_fn = embed_fn
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.entries = OrderedDict()  # domanda normalizzata -> {'sql', 'question', 'embedding', 'created'}
+        self.schema_version = None
+        self._lock = threading.Lock()
+        self.counters = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def _check_schema_version(self, schema_version):
+        if schema_version != self.schema_version:
+            if self.entries:
+                logger.info("Schema cambiato: cache SQL invalidata.")
+                self.counters["invalidations"] += 1
+            self.entries.clear()
+            self.schema_version = schema_version
+
+    def _expired(self, entry, now):
+        return self.ttl_seconds and now - entry['created'] > self.ttl_seconds
+
+    def _embed(self, question):
+        if self.embed_fn is None:
+            return None
+        try:
+            return np.asarray(self.embed_fn(question), dtype=np.float32)
+        except Exception as e:
+            logger.warning(f"Embedding domanda non disponibile, solo cache esatta: {e}")
+            return None
+
+    @staticmethod
+    def _compatible(question, cached):
+        # Le parole della domanda in cache che compaiono nell'SQL (nomi tabella, limiti numerici...)
+        # devono esserci anche nella nuova domanda: "tabella d" e "tabella e" sono vicine
+        # come embedding ma non devono condividere l'SQL.
+        sql_tokens = set(tokenize(cached['sql']))
+        new_tokens = set(tokenize(question))
+        return all(t in new_tokens for t in tokenize(cached['question']) if t in sql_tokens)
+
+    def lookup(self, question, schema_version, embedding=None):
+        # Restituisce (sql, livello, embedding); l'embedding calcolato va ripassato a store().
+        # Chi ha gia' l'embedding della domanda (es. calcolato in modo asincrono) puo' passarlo.
+        key = normalize_question(question)
+        now = time.time()
+        with self._lock:
+            self._check_schema_version(schema_version)
+            entry = self.entries.get(key)
+            if entry and self._expired(entry, now):
+                del self.entries[key]
+                entry = None
+            if entry:
+                self.entries.move_to_end(key)
+                self.counters["exact_hits"] += 1
+                return entry['sql'], "exact", entry['embedding']
+            has_entries = bool(self.entries)
+
+        if embedding is None:
+            embedding = self._embed(question)
+        else:
+            embedding = np.asarray(embedding, dtype=np.float32)
+        if embedding is None or not has_entries:
+            with self._lock:
+                self.counters["misses"] += 1
+            return None, None, embedding
+
+        with self._lock:
+            candidates = [(k, e) for k, e in self.entries.items()
+                          if e['embedding'] is not None and not self._expired(e, now)
+                          and e['embedding'].shape == embedding.shape]
+            if candidates:
+                matrix = np.stack([e['embedding'] for _, e in candidates])
+                norms = np.linalg.norm(matrix, axis=1) * (np.linalg.norm(embedding) or 1.0)
+                similarities = matrix @ embedding / np.where(norms == 0, 1.0, norms)
+                for idx in np.argsort(-similarities):
+                    if similarities[idx] < self.similarity_threshold:
+                        break
+                    best_key, best = candidates[idx]
+                    if self._compatible(question, best):
+                        self.entries.move_to_end(best_key)
+                        self.counters["semantic_hits"] += 1
+                        logger.info(f"Cache SQL semantica: '{best['question']}' (similarita' {similarities[idx]:.3f})")
+                        return best['sql'], "semantic", embedding
+            self.counters["misses"] += 1
+            return None, None, embedding
+
+    def store(self, question, sql, schema_version, embedding=None):
+        key = normalize_question(question)
+        with self._lock:
+            self._check_schema_version(schema_version)
+            self.entries[key] = {'sql': sql, 'question': question, 'embedding': embedding, 'created': time.time()}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def invalidate(self):
+        with self._lock:
+            self.entries.clear()
+            self.counters["invalidations"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self.entries)
+            return stats
@@ -0,0 +1,368 @@
+# ask_flow.py
+# Percorso di /ask e /ask/stream (routing, cache SQL, esempi, prompt, sessioni, risposta) scritto
+# una volta sola per l'app Flask (MariaCarla.py) e per quella asincrona (mariacarla_async.py).
+# AskFlow.steps() e' un generatore che non fa I/O: quando servono il modello, il database o un file
+# restituisce (yield) un passo (tipo, argomenti...) e riceve il risultato. run_steps() esegue i passi
+# con chiamate normali, arun_steps() con await; ogni app fornisce solo le funzioni per ogni tipo di passo.
+import inspect
+import json
+import logging
+import time
+from functools import partial
+
+from chat_sessions import SYSTEM_SUMMARY
+from doc_retriever import build_rag_prompts
+from intent_router import INTENT_DB, INTENT_CHAT, INTENT_DOCS, SYSTEM_CHAT, build_intent_prompts
+from metrics import timed
+from ollama_scheduler import QueueFullError
+from sql_assistant import (build_sql_prompts, build_sql_session_prompt, clean_generated_sql, check_generated_sql,
+                           format_sql_results, shape_sql_result)
+from think_filter import ThinkFilter, strip_think
+
+logger = logging.getLogger("ask_flow")
+
+# Tipi di passo: argomenti -> risultato atteso dalla funzione dell'app
+EMBEDDING = "embedding"      # (domanda) -> embedding della domanda o None
+COMPLETION = "completion"    # (prompt, system_message) -> testo del modello (dentro uno slot dello scheduler)
+CHAT = "chat"                # (messages) -> risposta completa di Ollama (dentro uno slot)
+CHAT_STREAM = "chat_stream"  # (messages, done) -> pezzi di testo o eventi ("coda", {...}); ultimo chunk in done['response']
+SCHEMA = "schema"            # (domanda, sessione) -> schema per il prompt; SchemaUnavailable se il DB non risponde
+SQL = "sql"                  # (sql, offset, page_size) -> risultato di execute_sql_query
+DOCUMENTS = "documenti"      # (domanda) -> chunk di documenti pertinenti
+CALL = "call"                # (funzione senza argomenti) -> I/O locale breve (SQLite degli esempi, file di sessione)
+
+BUSY_MESSAGE = "MariaCarla e' occupata, riprova tra qualche secondo."
+NO_ROUTE_MESSAGE = "Non so se la domanda sia per il DB o i documenti, e il sistema documenti non è pronto."
+
+
+class SchemaUnavailable(Exception):
+    # Sollevata dal passo SCHEMA: il messaggio va all'utente al posto della risposta
+    pass
+
+
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def with_session(payload, session):
+    if session is not None:
+        payload["sessione"] = session.info()
+    return payload
+
+
+def chat_result(response):
+    # (testo grezzo, testo visibile senza <think>, risposta di Ollama)
+    raw = response['message']['content']
+    return raw, strip_think(raw).strip(), response
+
+
+class ChatStream:
+    # Pezzi di testo di una risposta in stream -> eventi "token" con il blocco <think> gia' rimosso
+    def __init__(self):
+        self.done = {}
+        self.think_filter = ThinkFilter()
+        self.raw_parts = []
+        self.visible_parts = []
+
+    def feed(self, chunk):
+        if not isinstance(chunk, str):
+            return [chunk]  # Evento dell'app (es. posizione in coda), girato al client cosi' com'e'
+        self.raw_parts.append(chunk)
+        return self._token(self.think_filter.feed(chunk))
+
+    def flush(self):
+        return self._token(self.think_filter.flush())
+
+    def _token(self, visible):
+        if not visible:
+            return []
+        self.visible_parts.append(visible)
+        return [("token", {"t": visible})]
+
+    def result(self):
+        return "".join(self.raw_parts), "".join(self.visible_parts).strip(), self.done.get('response')
+
+
+def run_steps(steps, handlers, done):
+    # Esegue i passi con le funzioni sincrone di handlers ({tipo: funzione}). Restituisce (yield) gli
+    # eventi per lo stream ("coda", "token"); alla fine done['payload'] e done['risultato'].
+    # L'errore di un passo viene rilanciato dentro il percorso, che decide cosa farne.
+    value, error = None, None
+    while True:
+        try:
+            step = steps.throw(error) if error is not None else steps.send(value)
+        except StopIteration as stop:
+            done['payload'], done['risultato'] = stop.value
+            return
+        kind, args = step[0], step[1:]
+        value, error = None, None
+        try:
+            if kind == CHAT and args[1]:
+                stream = ChatStream()
+                with timed("llm_stream"):
+                    for chunk in handlers[CHAT_STREAM](args[0], stream.done):
+                        yield from stream.feed(chunk)
+                yield from stream.flush()
+                value = stream.result()
+            elif kind == CHAT:
+                value = chat_result(handlers[CHAT](args[0]))
+            else:
+                value = handlers[kind](*args)
+        except Exception as e:
+            error = e
+
+
+async def arun_steps(steps, handlers, done):
+    # Come run_steps(), con funzioni coroutine (o sincrone ma senza I/O) e stream asincrono
+    value, error = None, None
+    while True:
+        try:
+            step = steps.throw(error) if error is not None else steps.send(value)
+        except StopIteration as stop:
+            done['payload'], done['risultato'] = stop.value
+            return
+        kind, args = step[0], step[1:]
+        value, error = None, None
+        try:
+            if kind == CHAT and args[1]:
+                stream = ChatStream()
+                with timed("llm_stream"):
+                    async for chunk in handlers[CHAT_STREAM](args[0], stream.done):
+                        for event in stream.feed(chunk):
+                            yield event
+                for event in stream.flush():
+                    yield event
+                value = stream.result()
+            elif kind == CHAT:
+                value = chat_result(await handlers[CHAT](args[0]))
+            else:
+                value = handlers[kind](*args)
+                if inspect.isawaitable(value):
+                    value = await value
+        except Exception as e:
+            error = e
+
+
+def answer(steps, handlers):
+    # Senza stream: (payload JSON, risultato SQL completo o None)
+    done = {}
+    for _ in run_steps(steps, handlers, done):
+        pass
+    return done['payload'], done['risultato']
+
+
+async def aanswer(steps, handlers):
+    done = {}
+    async for _ in arun_steps(steps, handlers, done):
+        pass
+    return done['payload'], done['risultato']
+
+
+class AskFlow:
+    def __init__(self, intent_router, sql_cache, sql_examples, schema_catalog, document_retriever, session_store,
+                 page_size=100, few_shot=3, session_token_budget=1500, session_keep_turns=4):
+        self.intent_router = intent_router
+        self.sql_cache = sql_cache
+        self.sql_examples = sql_examples
+        self.schema_catalog = schema_catalog
+        self.document_retriever = document_retriever
+        self.session_store = session_store
+        self.page_size = page_size
+        self.few_shot = few_shot
+        self.session_token_budget = session_token_budget
+        self.session_keep_turns = session_keep_turns
+
+    def get_session(self, data):
+        session_id = data.get('sessione')
+        if not session_id:
+            return None
+        session = self.session_store.get(session_id)
+        if session is None:
+            logger.warning(f"Id di sessione non valido: {session_id!r}, domanda senza storico.")
+        return session
+
+    def steps(self, user_question, session=None, offset=0, page_size=None, stream=False):
+        # Passi di una domanda; restituisce (payload JSON, risultato SQL completo o None).
+        # QueueFullError esce: /ask risponde 429, /ask/stream lo dice nell'evento finale.
+        try:
+            return (yield from self._answer(user_question, session, offset, page_size or self.page_size, stream))
+        except QueueFullError:
+            raise
+        except ValueError as ve:
+            logger.error(f"Errore valore: {ve}")
+            return with_session({"risposta": f"Problema dati AI: {ve}"}, session), None
+        except Exception as e:
+            logger.error(f"Errore generale {'/ask/stream' if stream else '/ask'}: {e}", exc_info=True)
+            return with_session({"risposta": f"Errore interno: {e}"}, session), None
+
+    def _answer(self, user_question, session, offset, page_size, stream):
+        with timed("routing"):
+            question_embedding = yield from self._embedding(user_question)
+            intent = yield from self._route(user_question, question_embedding)
+        if intent == INTENT_DB:
+            logger.info("Rilevata intenzione DB.")
+            return (yield from self._answer_db(user_question, session, question_embedding, offset, page_size, stream))
+
+        if intent == INTENT_CHAT:
+            messages = yield from self._turn_messages(session, user_question, SYSTEM_CHAT, user_question)
+            _, response_text, ollama_response = yield CHAT, messages, stream
+            yield from self._record_turn(session, user_question, response_text, INTENT_CHAT, response=ollama_response)
+            return with_session({"risposta": response_text}, session), None
+
+        if not self.document_retriever.ready:
+            logger.warning("Né intenzione DB chiara né vector store documenti disponibile.")
+            return with_session({"risposta": NO_ROUTE_MESSAGE}, session), None
+        logger.info("Tentativo RAG su documenti.")
+        retrieved_docs = yield DOCUMENTS, user_question
+        system_rag_docs, prompt_rag_docs = build_rag_prompts(user_question, retrieved_docs)
+        messages = yield from self._turn_messages(session, prompt_rag_docs, system_rag_docs)
+        logger.info("Invio a LLM per RAG su documenti...")
+        generation_start = time.time()
+        _, response_text, ollama_response = yield CHAT, messages, stream
+        logger.info(f"Generazione risposta RAG in {time.time() - generation_start:.2f}s.")
+        yield from self._record_turn(session, user_question, response_text, INTENT_DOCS, response=ollama_response)
+        return with_session({"risposta": response_text}, session), None
+
+    def _embedding(self, user_question):
+        # Calcolato una volta: serve al router, alla cache SQL e agli esempi few-shot
+        try:
+            return (yield EMBEDDING, user_question)
+        except QueueFullError:
+            raise
+        except Exception as e:
+            logger.warning(f"Embedding domanda non disponibile: {e}")
+            return None
+
+    def _route(self, user_question, question_embedding):
+        # Di norma basta l'embedding; il modello si chiama solo con confidenza bassa
+        intent, confidence, source, classify_ms = self.intent_router.first_pass(user_question, question_embedding)
+        llm_answer = None
+        if self.intent_router.needs_llm(intent, confidence, source):
+            system_intent, prompt_intent = build_intent_prompts(user_question)
+            try:
+                llm_answer = yield COMPLETION, prompt_intent, system_intent
+            except Exception as e:
+                logger.warning(f"Classificazione LLM fallita: {e}")
+        intent, confidence, source = self.intent_router.finish(user_question, intent, confidence, source, llm_answer)
+        yield CALL, partial(self.intent_router.log, user_question, intent, confidence, source, classify_ms)
+        return intent
+
+    def _answer_db(self, user_question, session, question_embedding, offset, page_size, stream):
+        try:
+            db_schema = yield SCHEMA, user_question, session
+        except SchemaUnavailable as e:  # DB non raggiungibile: lo schema (con i COMMENT) puo' contenere qualsiasi parola
+            return {"risposta": str(e)}, None
+
+        with timed("cache_sql"):
+            cached_sql, cache_level, question_embedding = yield from self._lookup_sql(user_question, session,
+                                                                                    question_embedding)
+        if cached_sql:
+            logger.info(f"SQL da cache ({cache_level}): '{cached_sql}'")
+            response_text, sql_ok, query_results = yield from self._answer_from_sql(cached_sql, cached_sql, offset, page_size)
+            if cache_level == "modello":
+                yield from self._record_sql_example(user_question, cached_sql, sql_ok, query_results, question_embedding)
+            if cache_level != "sessione":
+                yield from self._record_turn(session, user_question, cached_sql, INTENT_DB, sql=cached_sql if sql_ok else None)
+            return self._sql_payload(response_text, cached_sql, query_results, session), query_results
+
+        examples = yield from self._few_shot_examples(question_embedding, session)
+        system_sql_gen, prompt_sql_gen = build_sql_prompts(user_question, db_schema, examples)
+        messages = yield from self._turn_messages(session, prompt_sql_gen, system_sql_gen,
+                                                  build_sql_session_prompt(user_question, examples))
+        logger.info(f"Invio a LLM per generazione SQL{' (stream)' if stream else ''}...")
+        generation_start = time.perf_counter()
+        generated_sql_raw, _, ollama_response = yield CHAT, messages, stream
+        generated_sql_raw = generated_sql_raw.strip()
+        logger.info(f"SQL grezzo da LLM: '{generated_sql_raw}'")
+
+        generated_sql = clean_generated_sql(generated_sql_raw)
+        response_text, sql_ok, query_results = yield from self._answer_from_sql(generated_sql, generated_sql_raw,
+                                                                                offset, page_size)
+        if cache_level != "sessione":
+            if sql_ok:
+                self.sql_cache.store(user_question, generated_sql, self.schema_catalog.version, embedding=question_embedding)
+            yield from self._record_sql_example(user_question, generated_sql or generated_sql_raw, sql_ok, query_results,
+                                                question_embedding, generation_start)
+        yield from self._record_turn(session, user_question, generated_sql or response_text, INTENT_DB,
+                                     sql=generated_sql if sql_ok else None, response=ollama_response)
+        return self._sql_payload(response_text, generated_sql, query_results, session), query_results
+
+    def _answer_from_sql(self, generated_sql, generated_sql_raw, offset, page_size):
+        # (testo risposta, True se la query e' stata eseguita senza errori, risultato grezzo o None)
+        rejection = check_generated_sql(generated_sql, generated_sql_raw)
+        if rejection:
+            return rejection, False, None
+        query_results = yield SQL, generated_sql, offset, page_size
+        with timed("formattazione"):
+            response_text, sql_ok = format_sql_results(generated_sql, query_results)
+        return response_text, sql_ok, query_results if sql_ok else None
+
+    @staticmethod
+    def _sql_payload(response_text, generated_sql, query_results, session):
+        payload = {"risposta": response_text}
+        if query_results is not None:
+            payload["risultato"] = shape_sql_result(generated_sql, query_results)
+        return with_session(payload, session)
+
+    @staticmethod
+    def _in_conversation(session):
+        return session is not None and bool(session.turns or session.summary)
+
+    def _lookup_sql(self, user_question, session, question_embedding):
+        # A conversazione avviata l'SQL dipende dallo storico: vale solo quello gia' generato nella sessione
+        if self._in_conversation(session):
+            return session.sql_for(user_question), "sessione", question_embedding
+        cached_sql, cache_level, question_embedding = self.sql_cache.lookup(user_question, self.schema_catalog.version,
+                                                                            embedding=question_embedding)
+        if cached_sql or self.sql_examples is None:
+            return cached_sql, cache_level, question_embedding
+        # Stessa domanda di una gia' riuscita a parte numeri e testi: il suo SQL con i nuovi valori
+        template_sql = yield CALL, partial(self._template_sql, user_question)
+        return template_sql, "modello" if template_sql else cache_level, question_embedding
+
+    def _template_sql(self, user_question):
+        self.sql_examples.sync_schema(self.schema_catalog.version, self.schema_catalog.tables)
+        sql, _ = self.sql_examples.template_sql(user_question)
+        return sql
+
+    def _few_shot_examples(self, question_embedding, session):
+        # In conversazione il prompt ha gia' lo storico: niente esempi
+        if self.sql_examples is None or self._in_conversation(session):
+            return None
+        return (yield CALL, partial(self.sql_examples.similar, question_embedding, self.few_shot))
+
+    def _record_sql_example(self, user_question, sql, sql_ok, query_results, question_embedding, start=None):
+        # Esito di ogni SQL generato (o preso da un modello): i riusciti diventano esempi
+        if self.sql_examples is None or not sql:
+            return
+        latency_ms = (time.perf_counter() - start) * 1000 if start is not None else None
+        rows = query_results.get('rowcount') if query_results else None
+        yield CALL, partial(self.sql_examples.record, user_question, sql, sql_ok, rows=rows, latency_ms=latency_ms,
+                            embedding=question_embedding, tables=self.schema_catalog.tables)
+
+    def _turn_messages(self, session, prompt_text, system_message, session_prompt=None):
+        # Senza sessione: system + prompt come sempre. In conversazione: prefisso fisso, storico
+        # e in coda il compito del turno (di default istruzioni + prompt nello stesso messaggio)
+        if session is None:
+            return [{'role': 'system', 'content': system_message}, {'role': 'user', 'content': prompt_text}]
+        yield from self._compact_session(session)
+        return session.messages(session_prompt or f"{system_message}\n\n{prompt_text}")
+
+    def _compact_session(self, session):
+        # Storico oltre il budget: i turni vecchi diventano un riassunto (il prefisso fisso non cambia)
+        text, n_turns = session.compaction(self.session_token_budget, self.session_keep_turns)
+        if not text:
+            return
+        try:
+            with timed("riassunto_sessione"):
+                summary = strip_think((yield COMPLETION, text, SYSTEM_SUMMARY)).strip()
+        except Exception as e:
+            logger.warning(f"Riassunto della sessione {session.id} fallito, i turni vecchi vengono scartati: {e}")
+            summary = session.summary
+        session.apply_summary(summary, n_turns)
+
+    def _record_turn(self, session, user_question, answer_text, intent, sql=None, response=None):
+        if session is None:
+            return
+        session.add_turn(user_question, answer_text, intent, sql=sql, response=response)
+        yield CALL, partial(self.session_store.save, session)
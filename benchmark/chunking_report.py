@@ -0,0 +1,89 @@
+# chunking_report.py
+# Confronto tra lo splitter generico di prima (750 caratteri, 150 di sovrapposizione) e la divisione
+# per formato di doc_chunking.py sugli stessi file di create_vectorstore_docs.py: chunk, caratteri
+# mandati all'embedding, chiamate a /api/embed e chunk di fogli/CSV rimasti senza intestazione.
+#
+#   python benchmark/chunking_report.py --batch-size 64 --json chunking.json
+import argparse
+import json
+import logging
+import math
+import os
+import sys
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from create_vectorstore_docs import EMBED_BATCH_SIZE, list_source_files, load_documents
+from doc_chunking import TABLE_FORMATS, legacy_splitter, source_format, split_documents
+
+
+def document_format(documents):
+    if documents and 'page' in documents[0].metadata:
+        return "pdf"
+    return source_format(documents[0].page_content)[0] if documents else "testo"
+
+
+def headerless(chunks):
+    # Chunk di un foglio/CSV senza la riga "--- Foglio: ..." seguita dall'intestazione
+    return sum(1 for chunk in chunks if "--- Foglio: " not in chunk.page_content)
+
+
+def summarize(name, files, legacy, structured, batch_size):
+    # create_vectorstore_docs.py manda i chunk di tutti i file a blocchi di batch_size
+    legacy_calls = math.ceil(legacy['chunks'] / batch_size)
+    structured_calls = math.ceil(structured['chunks'] / batch_size)
+    return {
+        "formato": name,
+        "file": files,
+        "chunk_prima": legacy['chunks'], "chunk_ora": structured['chunks'],
+        "caratteri_prima": legacy['chars'], "caratteri_ora": structured['chars'],
+        "chiamate_embed_prima": legacy_calls, "chiamate_embed_ora": structured_calls,
+        "chunk_risparmiati_pct": round(100 * (1 - structured['chunks'] / legacy['chunks']), 1) if legacy['chunks'] else 0.0,
+        "senza_intestazione_prima": legacy['headerless'], "senza_intestazione_ora": structured['headerless'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Chunk ed embedding: splitter generico contro divisione per formato.")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE, help="Chunk per chiamata di embedding")
+    parser.add_argument("--json", help="Salva i risultati in questo file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    splitter = legacy_splitter()
+    totals = {}
+    for path, loader_cls in list_source_files():
+        documents = load_documents(path, loader_cls)
+        if not documents:
+            continue
+        file_format = document_format(documents)
+        entry = totals.setdefault(file_format, {'file': 0, 'prima': {'chunks': 0, 'chars': 0, 'headerless': 0},
+                                                'ora': {'chunks': 0, 'chars': 0, 'headerless': 0}})
+        entry['file'] += 1
+        for key, chunks in (('prima', splitter.split_documents(documents)), ('ora', split_documents(documents, path))):
+            stats = entry[key]
+            stats['chunks'] += len(chunks)
+            stats['chars'] += sum(len(chunk.page_content) for chunk in chunks)
+            if file_format in TABLE_FORMATS:
+                # La divisione per formato ripete foglio e intestazione in testa a ogni chunk
+                stats['headerless'] += headerless(chunks) if key == 'prima' else \
+                    sum(1 for chunk in chunks if 'foglio' not in chunk.metadata)
+
+    if not totals:
+        print("Nessun documento trovato.")
+        return
+    results = [summarize(name, entry['file'], entry['prima'], entry['ora'], args.batch_size)
+               for name, entry in sorted(totals.items())]
+    all_legacy = {k: sum(e['prima'][k] for e in totals.values()) for k in ('chunks', 'chars', 'headerless')}
+    all_structured = {k: sum(e['ora'][k] for e in totals.values()) for k in ('chunks', 'chars', 'headerless')}
+    results.append(summarize("totale", sum(e['file'] for e in totals.values()), all_legacy, all_structured, args.batch_size))
+    for report in results:
+        print(json.dumps(report, ensure_ascii=False))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+# eval_retrieval.py
+# Confronto delle modalita' di recupero documenti (densa, bm25, ibrida, riordino) su un piccolo
+# insieme etichettato: recall@k, MRR e latenza della ricerca. Il file e' JSONL, una domanda per riga:
+#   {"domanda": "qual e' il codice articolo della vite M8?", "fonti": ["data/listino.txt"], "contiene": "VT-0815"}
+# Un chunk e' pertinente se viene da una delle "fonti" e (se indicato) contiene il testo "contiene".
+#
+#   python benchmark/eval_retrieval.py etichette.jsonl --k 3 --rerank-model cross-encoder/mmarco-mMiniLMv2-L12-H384-v1
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from doc_retriever import DocumentRetriever, CachedOllamaEmbeddings, CrossEncoderReranker
+from ollama_client import OllamaClientManager
+from run_benchmark import percentile
+
+MODES = ("densa", "bm25", "ibrida", "riordino")
+
+
+def load_labels(path):
+    labels = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                item = json.loads(line)
+                item['fonti'] = [os.path.normpath(s) for s in item.get('fonti', [])]
+                labels.append(item)
+    return labels
+
+
+def relevant(doc, label):
+    source = os.path.normpath(doc.metadata.get('source', ''))
+    if label['fonti'] and source not in label['fonti']:
+        return False
+    return not label.get('contiene') or label['contiene'].lower() in doc.page_content.lower()
+
+
+def recall(docs, label):
+    hits = [doc for doc in docs if relevant(doc, label)]
+    if not label['fonti']:
+        return 1.0 if hits else 0.0
+    found = set(os.path.normpath(doc.metadata.get('source', '')) for doc in hits)
+    return len(found) / len(label['fonti'])
+
+
+def evaluate(retriever, labels, k, mode):
+    recalls, reciprocal_ranks, latencies = [], [], []
+    for label in labels:
+        embedding = retriever.embeddings.embed_query(label['domanda'])  # fuori dal tempo: e' uguale per tutte le modalita'
+        start = time.perf_counter()
+        docs = retriever.search_by_vector(embedding, k=k, question=label['domanda'], mode=mode)
+        latencies.append(time.perf_counter() - start)
+        recalls.append(recall(docs, label))
+        rank = next((i for i, doc in enumerate(docs, start=1) if relevant(doc, label)), None)
+        reciprocal_ranks.append(1.0 / rank if rank else 0.0)
+    latencies.sort()
+    n = len(labels) or 1
+    return {
+        "modalita": mode,
+        "domande": len(labels),
+        f"recall@{k}": round(sum(recalls) / n, 3),
+        "mrr": round(sum(reciprocal_ranks) / n, 3),
+        "ricerca_p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "ricerca_p95_ms": round(percentile(latencies, 95) * 1000, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall@k e latenza delle modalita' di recupero documenti.")
+    parser.add_argument("labels", help="File JSONL con domande e fonti pertinenti")
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--candidates", type=int, default=20, help="Posizioni fuse dalla ricerca ibrida")
+    parser.add_argument("--vectorstore", default="vectorstore_docs")
+    parser.add_argument("--collection", default="rag_documents_collection")
+    parser.add_argument("--ollama-host", default=os.environ.get("OLLAMA_HOST", "http://localhost:11434"))
+    parser.add_argument("--embed-model", default=os.environ.get("OLLAMA_DOCS_EMBED_MODEL", "MariaCarla"),
+                        help="Lo stesso modello usato da create_vectorstore_docs.py")
+    parser.add_argument("--rerank-model", help="Cross-encoder per la modalita' riordino")
+    parser.add_argument("--backend", choices=("chroma", "locale"), default="chroma",
+                        help="Ricerca densa su Chroma o sull'indice locale (vector_index.py)")
+    parser.add_argument("--json", help="Salva i risultati in questo file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    manager = OllamaClientManager(args.ollama_host)
+    reranker = CrossEncoderReranker(args.rerank_model) if args.rerank_model else None
+    retriever = DocumentRetriever(args.vectorstore, args.collection, CachedOllamaEmbeddings(manager, args.embed_model),
+                                  k=args.k, candidates=args.candidates, reranker=reranker, backend=args.backend)
+    if not retriever.load():
+        sys.exit(1)
+    modes = [m for m in MODES if (m not in ("bm25", "ibrida", "riordino") or retriever.bm25_index is not None)
+             and (m != "riordino" or (reranker is not None and reranker.model is not None))]
+
+    labels = load_labels(args.labels)
+    results = [evaluate(retriever, labels, args.k, mode) for mode in modes]
+    for report in results:
+        print(json.dumps(report, ensure_ascii=False))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+# fake_ollama.py
+# Server HTTP che imita le API di Ollama usate da MariaCarla (/api/chat, /api/generate, /api/embed)
+# con latenza di prefill e velocita' di generazione configurabili. Per le domande SQL risponde
+# con un blocco <think> e una SELECT sulla tabella t_NNNN citata nella domanda; alla classificazione
+# dell'intento (router con confidenza bassa) risponde db se la domanda cita una tabella.
+import argparse
+import hashlib
+import json
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EMBEDDING_DIM = 256
+TABLE_PATTERN = re.compile(r"\bt_\d{4}\b")
+
+
+def canned_answer(messages):
+    system = next((m['content'] for m in messages if m['role'] == 'system'), "")
+    question = next((m['content'] for m in reversed(messages) if m['role'] == 'user'), "")
+    if system.startswith("Classifica la domanda"):
+        return "<think>\nCita una tabella?\n</think>\n\n" + ("db" if TABLE_PATTERN.search(question) else "documenti")
+    if "MySQL" in system:
+        tables = TABLE_PATTERN.findall(question) or ["t_0000"]
+        return (f"<think>\nL'utente chiede i dati della tabella {tables[0]}: basta una SELECT.\n</think>\n\n"
+                f"SELECT id, nome, valore FROM {tables[0]} WHERE valore > 10 ORDER BY valore DESC LIMIT 20")
+    return "<think>\nCerco nel contesto.\n</think>\n\nSecondo i documenti la risposta e' contenuta nel contesto fornito."
+
+
+def fake_embedding(text):
+    # Vettore deterministico dalle parole del testo: domande simili -> vettori simili
+    vector = [0.0] * EMBEDDING_DIM
+    for word in text.lower().split():
+        vector[int(hashlib.md5(word.encode('utf-8')).hexdigest(), 16) % EMBEDDING_DIM] += 1.0
+    return vector
+
+
+def split_tokens(text):
+    return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    prefill_seconds = 0.2
+    tokens_per_second = 50.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_json(self, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _timings(self, prompt_tokens, eval_count, eval_seconds):
+        return {
+            'total_duration': int((self.prefill_seconds + eval_seconds) * 1e9),
+            'load_duration': 0,
+            'prompt_eval_count': prompt_tokens,
+            'prompt_eval_duration': int(self.prefill_seconds * 1e9),
+            'eval_count': eval_count,
+            'eval_duration': int(eval_seconds * 1e9),
+        }
+
+    def do_GET(self):
+        self._send_json({'models': []})
+
+    def do_POST(self):
+        request = self._read_json()
+        model = request.get('model', '')
+        created_at = datetime.now(timezone.utc).isoformat()
+        if self.path == '/api/embed':
+            inputs = request.get('input') or ""
+            inputs = [inputs] if isinstance(inputs, str) else inputs
+            self._send_json({'model': model, 'embeddings': [fake_embedding(t) for t in inputs]})
+            return
+        if self.path == '/api/generate':
+            self._send_json({'model': model, 'created_at': created_at, 'response': '', 'done': True})
+            return
+        if self.path != '/api/chat':
+            self.send_error(404)
+            return
+
+        messages = request.get('messages') or []
+        prompt_tokens = sum(len(m.get('content', '')) for m in messages) // 4
+        tokens = split_tokens(canned_answer(messages))
+        token_delay = 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+        time.sleep(self.prefill_seconds)
+
+        if not request.get('stream', True):
+            time.sleep(token_delay * len(tokens))
+            self._send_json(dict(self._timings(prompt_tokens, len(tokens), token_delay * len(tokens)),
+                                 model=model, created_at=created_at, done=True,
+                                 message={'role': 'assistant', 'content': "".join(tokens)}))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def write_line(payload):
+            data = (json.dumps(payload) + "\n").encode('utf-8')
+            self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+            self.wfile.flush()
+
+        for token in tokens:
+            time.sleep(token_delay)
+            write_line({'model': model, 'created_at': created_at, 'done': False,
+                        'message': {'role': 'assistant', 'content': token}})
+        write_line(dict(self._timings(prompt_tokens, len(tokens), token_delay * len(tokens)),
+                        model=model, created_at=created_at, done=True,
+                        message={'role': 'assistant', 'content': ''}))
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def start_fake_ollama(host="127.0.0.1", port=0, prefill_seconds=0.2, tokens_per_second=50.0):
+    # Avvia il server in un thread e restituisce (server, url)
+    handler = type("ConfiguredFakeOllamaHandler", (FakeOllamaHandler,),
+                   {'prefill_seconds': prefill_seconds, 'tokens_per_second': tokens_per_second})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-ollama", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Finto server Ollama per benchmark offline.")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--prefill", type=float, default=0.2, help="Secondi di prefill per chiamata")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="Velocita' di generazione")
+    args = parser.parse_args()
+    server, url = start_fake_ollama(port=args.port, prefill_seconds=args.prefill, tokens_per_second=args.tokens_per_second)
+    print(f"Finto Ollama in ascolto su {url} (Ctrl+C per uscire)")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,199 @@
+# run_benchmark.py
+# Benchmark offline di /ask: finto Ollama + SQLite con schema sintetico da 10/100/1000 tabelle,
+# richieste concorrenti e report di latenza (p50/p95/p99) e throughput.
+#
+#   python benchmark/run_benchmark.py --tables 10,100,1000 --requests 200 --concurrency 8
+#   python benchmark/run_benchmark.py --url http://localhost:5000 --requests 100   (server gia' avviato)
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))  # moduli dell'app (MariaCarla, schema_catalog, ...)
+
+from fake_ollama import start_fake_ollama
+from sqlite_db import SQLiteDBPool, seed_database, table_name
+
+logger = logging.getLogger("benchmark")
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1)) # nearest-rank
+    return sorted_values[index]
+
+
+def make_questions(n_tables, distinct, seed=7):
+    rng = random.Random(seed)
+    templates = ["elenca da tabella {t} le righe con valore alto",
+                 "dati di {t}: quali elementi hanno il valore maggiore?",
+                 "query sulla tabella {t} ordinata per valore"]
+    return [rng.choice(templates).format(t=table_name(rng.randrange(n_tables))) for _ in range(distinct)]
+
+
+def post_ask(base_url, question, stream, timeout):
+    # Restituisce (secondi totali, secondi al primo token o None, ok)
+    path = "/ask/stream" if stream else "/ask"
+    body = json.dumps({"domanda": question}).encode('utf-8')
+    req = urllib.request.Request(base_url + path, data=body, headers={"Content-Type": "application/json"})
+    start = time.perf_counter()
+    first_token = None
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            if stream:
+                for line in response:
+                    if first_token is None and line.startswith(b"event: token"):
+                        first_token = time.perf_counter() - start
+            else:
+                json.loads(response.read())
+        return time.perf_counter() - start, first_token, True
+    except Exception as e:
+        logger.warning(f"Richiesta fallita: {e}")
+        return time.perf_counter() - start, first_token, False
+
+
+def run_load(base_url, questions, n_requests, concurrency, stream, timeout):
+    latencies, first_tokens, errors = [], [], 0
+    lock = threading.Lock()
+
+    def one(i):
+        nonlocal errors
+        elapsed, ttft, ok = post_ask(base_url, questions[i % len(questions)], stream, timeout)
+        with lock:
+            if ok:
+                latencies.append(elapsed)
+                if ttft is not None:
+                    first_tokens.append(ttft)
+            else:
+                errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(n_requests)))
+    wall = time.perf_counter() - start
+
+    latencies.sort()
+    first_tokens.sort()
+    report = {
+        "richieste": n_requests,
+        "errori": errors,
+        "concorrenza": concurrency,
+        "durata_s": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 2) if wall else 0.0,
+        "media_ms": round(sum(latencies) / len(latencies) * 1000, 1) if latencies else 0.0,
+    }
+    for p in (50, 95, 99):
+        report[f"p{p}_ms"] = round(percentile(latencies, p) * 1000, 1)
+    if first_tokens:
+        for p in (50, 95, 99):
+            report[f"primo_token_p{p}_ms"] = round(percentile(first_tokens, p) * 1000, 1)
+    return report
+
+
+def stage_totals(base_url):
+    # Somme e conteggi di mariacarla_stage_seconds letti da /metrics del server
+    sums, counts = {}, {}
+    try:
+        with urllib.request.urlopen(base_url + "/metrics", timeout=10) as response:
+            text = response.read().decode('utf-8')
+    except Exception:
+        return sums, counts
+    for line in text.splitlines():
+        for suffix, target in (("_sum", sums), ("_count", counts)):
+            prefix = f"mariacarla_stage_seconds{suffix}{{stage=\""
+            if line.startswith(prefix):
+                stage = line[len(prefix):line.index('"', len(prefix))]
+                target[stage] = float(line.rsplit(" ", 1)[1])
+    return sums, counts
+
+
+def stage_summary(before, after):
+    # Media per fase (ms) delle sole richieste dello scenario
+    (sums_before, counts_before), (sums_after, counts_after) = before, after
+    summary = {}
+    for stage, total in sums_after.items():
+        count = counts_after.get(stage, 0) - counts_before.get(stage, 0)
+        if count > 0:
+            summary[stage] = round((total - sums_before.get(stage, 0.0)) / count * 1000, 2)
+    return summary
+
+
+def start_local_app(workdir, ollama_url):
+    # Importa MariaCarla con Ollama finto; i percorsi relativi (vectorstore_*) finiscono in workdir
+    os.environ["OLLAMA_HOST"] = ollama_url
+    os.environ.setdefault("OLLAMA_KEEP_WARM_INTERVAL", "0")
+    os.chdir(workdir)
+    import MariaCarla
+    MariaCarla.init_worker()
+    from werkzeug.serving import make_server
+    server = make_server("127.0.0.1", 0, MariaCarla.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="mariacarla-benchmark", daemon=True).start()
+    return MariaCarla, server, f"http://127.0.0.1:{server.server_port}"
+
+
+def use_schema(app_module, db_path):
+    app_module.db_pool = SQLiteDBPool(db_path)
+    start = time.perf_counter()
+    app_module.preload_schema_catalog()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark offline di MariaCarla /ask.")
+    parser.add_argument("--url", help="Server gia' avviato da misurare (altrimenti app locale con Ollama finto e SQLite)")
+    parser.add_argument("--tables", default="10,100,1000", help="Dimensioni dello schema sintetico, separate da virgola")
+    parser.add_argument("--rows", type=int, default=200, help="Righe per tabella")
+    parser.add_argument("--requests", type=int, default=100, help="Richieste per scenario")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--distinct", type=int, default=50, help="Domande diverse (le ripetute colpiscono la cache SQL)")
+    parser.add_argument("--stream", action="store_true", help="Usa /ask/stream e misura anche il primo token")
+    parser.add_argument("--prefill", type=float, default=0.2, help="Secondi di prefill del finto Ollama")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="Velocita' di generazione del finto Ollama")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--json", help="Salva i risultati in questo file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    results = []
+    if args.url:
+        base_url = args.url.rstrip("/")
+        questions = make_questions(int(args.tables.split(",")[0]), args.distinct)
+        before = stage_totals(base_url)
+        report = run_load(base_url, questions, args.requests, args.concurrency, args.stream, args.timeout)
+        report["fasi_ms"] = stage_summary(before, stage_totals(base_url))
+        results.append(report)
+    else:
+        workdir = tempfile.mkdtemp(prefix="mariacarla_bench_")
+        _, ollama_url = start_fake_ollama(prefill_seconds=args.prefill, tokens_per_second=args.tokens_per_second)
+        app_module, _, base_url = start_local_app(workdir, ollama_url)
+        for n_tables in [int(t) for t in args.tables.split(",")]:
+            db_path = seed_database(os.path.join(workdir, f"schema_{n_tables}.sqlite"), n_tables, args.rows)
+            schema_load = use_schema(app_module, db_path)
+            questions = make_questions(n_tables, args.distinct)
+            before = stage_totals(base_url)
+            report = run_load(base_url, questions, args.requests, args.concurrency, args.stream, args.timeout)
+            report["tabelle"] = n_tables
+            report["caricamento_schema_s"] = round(schema_load, 3)
+            report["fasi_ms"] = stage_summary(before, stage_totals(base_url))
+            results.append(report)
+
+    for report in results:
+        print(json.dumps(report, ensure_ascii=False))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+
+
+if __name__ == "__main__":
+    main()
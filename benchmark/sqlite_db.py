@@ -0,0 +1,178 @@
+# sqlite_db.py
+# Sostituto locale del pool MySQL per i benchmark: un database SQLite con schema sintetico
+# (N tabelle collegate da chiavi esterne) e un adattatore che risponde alle query su
+# information_schema del catalogo e della cache risultati e a EXPLAIN come farebbe MySQL.
+import os
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from result_cache import TABLE_TIMES_QUERY
+from schema_catalog import FINGERPRINT_QUERY, TABLES_QUERY, COLUMNS_QUERY, FOREIGN_KEYS_QUERY
+
+MYSQL_VAR_STRING = 253
+
+
+def table_name(i):
+    return f"t_{i:04d}"
+
+
+def seed_database(path, n_tables, rows_per_table=200, seed=42):
+    # Tabelle t_0000..t_NNNN: id, nome, valore, creato e ref_id verso la tabella precedente
+    if os.path.exists(path):
+        os.remove(path)
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    try:
+        for i in range(n_tables):
+            ref = f", ref_id INTEGER REFERENCES {table_name(i - 1)}(id)" if i else ""
+            conn.execute(f"CREATE TABLE {table_name(i)} (id INTEGER PRIMARY KEY, nome TEXT NOT NULL, "
+                         f"valore REAL, creato TEXT{ref})")
+            rows = [(r, f"elemento {r} di {table_name(i)}", round(rng.uniform(0, 100), 2),
+                     f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}") + ((rng.randint(0, rows_per_table - 1),) if i else ())
+                    for r in range(rows_per_table)]
+            placeholders = ", ".join("?" * len(rows[0]))
+            conn.executemany(f"INSERT INTO {table_name(i)} VALUES ({placeholders})", rows)
+        conn.commit()
+    finally:
+        conn.close()
+    return path
+
+
+class SQLiteCursor:
+    # Cursore con l'interfaccia usata da MariaCarla (execute, fetchall, fetchmany, description, column_names)
+    def __init__(self, conn, path):
+        self.conn = conn
+        self.path = path
+        self.cursor = conn.cursor()
+        self.rows = None
+        self.description = None
+        self.column_names = ()
+        self.rowcount = -1
+
+    def _set_result(self, columns, rows):
+        self.description = [(c, MYSQL_VAR_STRING) for c in columns]
+        self.column_names = tuple(columns)
+        self.rows = list(rows)
+
+    def _tables(self):
+        return [r[0] for r in self.conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+
+    def _catalog(self, query):
+        tables = self._tables()
+        if query == FINGERPRINT_QUERY:
+            return ["TABLE_NAME", "CREATE_TIME", "UPDATE_TIME", "COLUMNS"], [
+                (t, None, None, len(self.conn.execute(f"PRAGMA table_info({t})").fetchall())) for t in tables]
+        if query == TABLES_QUERY:
+            return ["TABLE_NAME", "TABLE_COMMENT"], [(t, f"Tabella sintetica {t}") for t in tables]
+        if query == COLUMNS_QUERY:
+            rows = []
+            for t in tables:
+                for _, name, col_type, notnull, _, pk in self.conn.execute(f"PRAGMA table_info({t})"):
+                    rows.append((t, name, col_type.lower(), "PRI" if pk else "", "NO" if notnull or pk else "YES", ""))
+            return ["TABLE_NAME", "COLUMN_NAME", "COLUMN_TYPE", "COLUMN_KEY", "IS_NULLABLE", "COLUMN_COMMENT"], rows
+        rows = []
+        for t in tables:
+            for fk in self.conn.execute(f"PRAGMA foreign_key_list({t})"):
+                rows.append((t, fk[3], fk[2], fk[4]))
+        return ["TABLE_NAME", "COLUMN_NAME", "REFERENCED_TABLE_NAME", "REFERENCED_COLUMN_NAME"], rows
+
+    def _table_times(self):
+        # UPDATE_TIME per la cache risultati: il database si scrive solo in seed_database,
+        # quindi ogni tabella ha l'ora di modifica del file (un nuovo schema invalida la cache)
+        modified = os.path.getmtime(self.path)
+        update_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(modified))
+        age = int(time.time() - modified)
+        return ["TABLE_NAME", "UPDATE_TIME", "AGE"], [(t, update_time, age) for t in self._tables()]
+
+    def _explain(self, sql):
+        # EXPLAIN QUERY PLAN di SQLite tradotto nelle colonne di EXPLAIN MySQL usate da sql_guard
+        rows = []
+        for _, _, _, detail in self.conn.execute(f"EXPLAIN QUERY PLAN {sql}"):
+            words = detail.split()
+            if len(words) < 2 or words[0] not in ("SCAN", "SEARCH"):
+                continue
+            table = words[1]
+            count = self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] if words[0] == "SCAN" else 1
+            rows.append((1, "SIMPLE", table, "ALL" if words[0] == "SCAN" else "ref", count))
+        return ["id", "select_type", "table", "type", "rows"], rows
+
+    def execute(self, sql, params=None):
+        self.rows = None
+        if sql in (FINGERPRINT_QUERY, TABLES_QUERY, COLUMNS_QUERY, FOREIGN_KEYS_QUERY):
+            self._set_result(*self._catalog(sql))
+        elif sql == TABLE_TIMES_QUERY:
+            self._set_result(*self._table_times())
+        elif sql.startswith("SET SESSION "):
+            self.description = None  # Variabili di sessione MySQL: nulla da fare su SQLite
+        elif sql.startswith("EXPLAIN "):
+            self._set_result(*self._explain(sql[len("EXPLAIN "):]))
+        else:
+            self.cursor.execute(sql, params or ())
+            self.description = [(d[0], MYSQL_VAR_STRING) for d in self.cursor.description] if self.cursor.description else None
+            self.column_names = tuple(d[0] for d in self.description or ())
+            self.rowcount = self.cursor.rowcount
+
+    def fetchall(self):
+        if self.rows is not None:
+            rows, self.rows = self.rows, []
+            return rows
+        return self.cursor.fetchall()
+
+    def fetchmany(self, size=1):
+        if self.rows is not None:
+            rows, self.rows = self.rows[:size], self.rows[size:]
+            return rows
+        return self.cursor.fetchmany(size)
+
+    def close(self):
+        self.cursor.close()
+
+
+class SQLiteConnection:
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+
+    def cursor(self, *args, **kwargs):
+        return SQLiteCursor(self.conn, self.path)
+
+    def commit(self):
+        self.conn.commit()
+
+    def consume_results(self):
+        pass
+
+    def close(self):
+        self.conn.close()
+
+
+class SQLiteDBPool:
+    # Stessa interfaccia di db_pool.DBPool (connection(), stats()); una connessione SQLite per checkout
+    def __init__(self, path):
+        self.path = path
+        self.pool_size = 0
+        self.max_overflow = 0
+        self._lock = threading.Lock()
+        self._checkouts = 0
+        self._in_use = 0
+
+    @contextmanager
+    def connection(self):
+        conn = SQLiteConnection(self.path)
+        with self._lock:
+            self._checkouts += 1
+            self._in_use += 1
+        try:
+            yield conn
+        finally:
+            with self._lock:
+                self._in_use -= 1
+            conn.close()
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "sqlite", "checkouts": self._checkouts, "in_use": self._in_use}
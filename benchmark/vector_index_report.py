@@ -0,0 +1,125 @@
+# vector_index_report.py
+# Indice locale (vector_index.py) contro Chroma sulla stessa collezione: tempo di apertura,
+# memoria dei vettori, latenza della ricerca (p50/p95) e quanti dei primi k di Chroma ritrova.
+# Come domande usa embedding gia' presenti nella collezione con un po' di rumore: non serve Ollama.
+# L'indice locale ordina per coseno, Chroma (di default) per distanza L2: coincidono solo con
+# embedding normalizzati, come quelli dei modelli di embedding di Ollama.
+# Gli indici vengono esportati in una cartella temporanea, quello dell'app non viene toccato.
+#
+#   python benchmark/vector_index_report.py --dtypes float16,int8 --ivf-lists 0,256 --queries 200
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from langchain_community.vectorstores import Chroma
+from run_benchmark import percentile
+from vector_index import LocalVectorIndex, export_from_chroma
+
+
+def directory_mb(path):
+    total = 0
+    for root, _, filenames in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, name)) for name in filenames)
+    return round(total / 1e6, 2)
+
+
+def sample_queries(collection, n, seed=0):
+    rng = np.random.default_rng(seed)
+    count = collection.count()
+    offsets = rng.choice(count, min(n, count), replace=False)
+    queries = []
+    for offset in offsets:
+        vector = np.asarray(collection.get(include=['embeddings'], limit=1, offset=int(offset))['embeddings'][0],
+                            dtype=np.float32)
+        noise = rng.normal(0, np.abs(vector).mean() * 0.3, size=vector.shape).astype(np.float32)
+        queries.append((vector + noise).tolist())
+    return queries
+
+
+def measure(search_fn, queries, k):
+    latencies, results = [], []
+    for query in queries:
+        start = time.perf_counter()
+        results.append(search_fn(query, k))
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+    return results, {"ricerca_p50_ms": round(percentile(latencies, 50) * 1000, 3),
+                     "ricerca_p95_ms": round(percentile(latencies, 95) * 1000, 3)}
+
+
+def overlap(results, reference, k):
+    if not reference:
+        return 0.0
+    return round(sum(len(set(r[:k]) & set(ref[:k])) / k for r, ref in zip(results, reference)) / len(reference), 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Indice locale memory-mapped contro Chroma.")
+    parser.add_argument("--vectorstore", default="vectorstore_docs")
+    parser.add_argument("--collection", default="rag_documents_collection")
+    parser.add_argument("--dtypes", default="float16,int8")
+    parser.add_argument("--ivf-lists", default="0", help="Gruppi IVF da provare, separati da virgola (0 = esaustiva)")
+    parser.add_argument("--nprobe", type=int, default=8)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--json", help="Salva i risultati in questo file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    start = time.perf_counter()
+    collection = Chroma(persist_directory=args.vectorstore, collection_name=args.collection)._collection
+    count = collection.count()
+    chroma_open = time.perf_counter() - start
+    if not count:
+        print("Collezione vuota.")
+        return
+    queries = sample_queries(collection, args.queries)
+    reference, chroma_latency = measure(
+        lambda q, k: collection.query(query_embeddings=[q], n_results=k, include=[])['ids'][0], queries, args.k)
+    dim = len(queries[0])
+    results = [{"backend": "chroma", "chunk": count, "apertura_ms": round(chroma_open * 1000, 1),
+                "disco_mb": directory_mb(args.vectorstore), "vettori_mb": round(count * dim * 4 / 1e6, 2),
+                **chroma_latency, f"in_comune_top{args.k}": 1.0}]
+
+    work_dir = tempfile.mkdtemp(prefix="indice_locale_")
+    try:
+        for dtype in args.dtypes.split(","):
+            for ivf_lists in (int(n) for n in args.ivf_lists.split(",")):
+                index_dir = os.path.join(work_dir, f"{dtype}_{ivf_lists}")
+                export_start = time.perf_counter()
+                export_from_chroma(collection, index_dir, dtype, ivf_lists)
+                export_time = time.perf_counter() - export_start
+                index = LocalVectorIndex(index_dir, nprobe=args.nprobe)
+                start = time.perf_counter()
+                index.load()
+                load_time = time.perf_counter() - start
+                found, latency = measure(index.search, queries, args.k)
+                stats = index.stats()
+                results.append({"backend": f"locale {dtype}" + (f" ivf{ivf_lists}/{args.nprobe}" if ivf_lists else ""),
+                                "chunk": index.count, "apertura_ms": round(load_time * 1000, 1),
+                                "esportazione_s": round(export_time, 2), "disco_mb": directory_mb(index_dir),
+                                "vettori_mb": stats['vettori_mb'], **latency,
+                                f"in_comune_top{args.k}": overlap(found, reference, args.k)})
+                index.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    for report in results:
+        print(json.dumps(report, ensure_ascii=False))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+
+
+if __name__ == "__main__":
+    main()
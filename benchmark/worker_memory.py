@@ -0,0 +1,63 @@
+# worker_memory.py
+# Memoria di MariaCarla avviata con gunicorn.conf.py: master e worker con rss, pss e pagine
+# condivise. La somma dei pss e' la memoria realmente occupata (le pagine condivise dopo il
+# preload contano una volta sola), la somma degli rss quella che si avrebbe senza condivisione.
+# Solo Linux (/proc). I tempi di avvio sono nel log di gunicorn e in /stats ("processo").
+#
+#   python benchmark/worker_memory.py --pid <pid del master> --json memoria.json
+import argparse
+import json
+import os
+import sys
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+
+from metrics import process_memory
+
+
+def children(pid):
+    # Processi figli: dal campo ppid di /proc/<pid>/stat (dopo il nome tra parentesi)
+    found = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{name}/stat", encoding='ascii', errors='replace') as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            found.append(int(name))
+    return sorted(found)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Memoria per worker di MariaCarla sotto gunicorn.")
+    parser.add_argument("--pid", type=int, required=True, help="Pid del master gunicorn")
+    parser.add_argument("--json", help="Salva i risultati in questo file")
+    args = parser.parse_args()
+
+    processes = [{"ruolo": "master", "pid": args.pid, **process_memory(args.pid)}]
+    processes += [{"ruolo": "worker", "pid": pid, **process_memory(pid)} for pid in children(args.pid)]
+    if len(processes) == 1 and not processes[0].get("rss_mb"):
+        print(f"Processo {args.pid} non trovato o /proc non disponibile.")
+        return
+    workers = [p for p in processes if p["ruolo"] == "worker"]
+    summary = {
+        "ruolo": "totale",
+        "worker": len(workers),
+        "rss_mb": round(sum(p.get("rss_mb", 0.0) for p in processes), 1),
+        "pss_mb": round(sum(p.get("pss_mb", 0.0) for p in processes), 1),
+        "pss_medio_worker_mb": round(sum(p.get("pss_mb", 0.0) for p in workers) / len(workers), 1) if workers else None,
+    }
+    results = processes + [summary]
+    for report in results:
+        print(json.dumps(report, ensure_ascii=False))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+# bm25.py
+import math
+import re
+from collections import Counter
+
+TOKEN_RE = re.compile(r"[0-9a-zàèéìíòóùú_]+")
+
+
+def tokenize(text):
+    # Minuscolo, e gli identificatori tipo data_ordine valgono anche come "data" e "ordine"
+    tokens = []
+    for token in TOKEN_RE.findall(text.lower()):
+        tokens.append(token)
+        if '_' in token:
+            tokens.extend(part for part in token.split('_') if part)
+    return tokens
+
+
+class BM25Index:
+    # Indice invertito BM25 minimale: termine -> {id_documento: frequenza}
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_ids = []
+        self.doc_lengths = []
+        self.postings = {}
+
+    def add(self, doc_id, tokens):
+        doc_idx = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self.doc_lengths.append(len(tokens))
+        for term, tf in Counter(tokens).items():
+            self.postings.setdefault(term, {})[doc_idx] = tf
+
+    def score(self, query_tokens):
+        n_docs = len(self.doc_ids)
+        if not n_docs:
+            return {}
+        avg_len = sum(self.doc_lengths) / n_docs or 1.0
+        scores = {}
+        for term in set(query_tokens):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n_docs - len(posting) + 0.5) / (len(posting) + 0.5))
+            for doc_idx, tf in posting.items():
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[doc_idx] / avg_len)
+                scores[doc_idx] = scores.get(doc_idx, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return scores
+
+    def top_k(self, query_tokens, k):
+        scores = self.score(query_tokens)
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [(self.doc_ids[doc_idx], score) for doc_idx, score in best]
+
+    def to_dict(self):
+        return {
+            'k1': self.k1,
+            'b': self.b,
+            'doc_ids': self.doc_ids,
+            'doc_lengths': self.doc_lengths,
+            # JSON vuole chiavi stringa
+            'postings': {term: {str(i): tf for i, tf in posting.items()} for term, posting in self.postings.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        index = cls(k1=data['k1'], b=data['b'])
+        index.doc_ids = data['doc_ids']
+        index.doc_lengths = data['doc_lengths']
+        index.postings = {term: {int(i): tf for i, tf in posting.items()} for term, posting in data['postings'].items()}
+        return index
@@ -0,0 +1,244 @@
+# chat_sessions.py
+# Conversazioni lato server: lo storico delle domande di una sessione viene rimandato al modello
+# per le domande di seguito ("e solo quelli di Milano?"). Il prompt e' costruito perche' Ollama
+# possa riusare la cache del prefisso tra un turno e l'altro:
+#   [system: istruzioni fisse + schema fissato nella sessione] [riassunto] [turni precedenti] [turno attuale]
+# Istruzioni del compito, contesto RAG ecc. stanno solo nell'ultimo messaggio; nello storico
+# restano domanda e risposta. Oltre il budget di token i turni vecchi vengono riassunti.
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import SESSION_PREFILL_SECONDS
+from schema_retriever import estimate_tokens
+
+logger = logging.getLogger("chat_sessions")
+
+SESSION_ID_RE = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+SYSTEM_SESSION = ("Sei MariaCarla, un'assistente aziendale. Rispondi sempre in italiano. "
+                  "Usa i messaggi precedenti della conversazione per capire le domande di seguito. "
+                  "Segui le istruzioni contenute nell'ultimo messaggio dell'utente.")
+SYSTEM_SUMMARY = ("Riassumi in italiano, in poche frasi, la conversazione seguente: tieni domande, "
+                  "tabelle, filtri e risposte che potrebbero servire alle domande successive.")
+
+
+def valid_session_id(session_id):
+    return isinstance(session_id, str) and bool(SESSION_ID_RE.match(session_id))
+
+
+def prefill_info(response):
+    # Token del prompt valutati davvero (quelli in cache del prefisso non contano) e tempo di prefill
+    return {
+        "token_prompt": response.get('prompt_eval_count') or 0,
+        "prefill_ms": round((response.get('prompt_eval_duration') or 0) / 1e6, 1),
+    }
+
+
+class ChatSession:
+    def __init__(self, session_id, turns=None, summary="", schema="", schema_tables=None,
+                 schema_version=None, created=None, updated=None, last_prefix=None):
+        self.id = session_id
+        self.turns = turns or []  # {'domanda', 'risposta', 'intento', 'sql', 'prefill_ms', 'token_prompt'}
+        self.summary = summary
+        self.schema = schema
+        self.schema_tables = schema_tables or []
+        self.schema_version = schema_version
+        self.created = created or time.time()
+        self.updated = updated or self.created
+        self.last_prefix = last_prefix
+
+    def prefix(self):
+        # Parte fissa del prompt: cambia solo quando lo schema della sessione si allarga
+        if not self.schema:
+            return SYSTEM_SESSION
+        return f"{SYSTEM_SESSION}\n\n{self.schema}"
+
+    def prefix_hash(self):
+        return hashlib.sha1(self.prefix().encode('utf-8')).hexdigest()[:12]
+
+    def messages(self, user_content):
+        messages = [{'role': 'system', 'content': self.prefix()}]
+        if self.summary:
+            messages.append({'role': 'user', 'content': f"Riassunto della conversazione precedente:\n{self.summary}"})
+            messages.append({'role': 'assistant', 'content': "Va bene."})
+        for turn in self.turns:
+            messages.append({'role': 'user', 'content': turn['domanda']})
+            messages.append({'role': 'assistant', 'content': turn['risposta']})
+        messages.append({'role': 'user', 'content': user_content})
+        return messages
+
+    def history_tokens(self):
+        return estimate_tokens(self.summary) + sum(estimate_tokens(t['domanda']) + estimate_tokens(t['risposta'])
+                                                   for t in self.turns)
+
+    def sql_for(self, user_question):
+        # SQL gia' generato in questa sessione per la stessa domanda (richieste di altre pagine / CSV)
+        for turn in reversed(self.turns):
+            if turn['domanda'] == user_question and turn.get('sql'):
+                return turn['sql']
+        return None
+
+    def add_turn(self, user_question, answer, intent, sql=None, response=None):
+        # response: ultima risposta (o chunk finale) di Ollama, per misurare il prefill del turno
+        turn = {'domanda': user_question, 'risposta': answer, 'intento': intent, 'sql': sql}
+        prefix_hash = self.prefix_hash()
+        if response is not None:
+            turn.update(prefill_info(response))
+            reused = "riusato" if prefix_hash == self.last_prefix else "nuovo"
+            SESSION_PREFILL_SECONDS.observe(reused, value=(response.get('prompt_eval_duration') or 0) / 1e9)
+            logger.info(f"Sessione {self.id} turno {len(self.turns) + 1}: prefisso {reused}, "
+                        f"{turn['token_prompt']} token valutati, prefill {turn['prefill_ms']}ms")
+        self.last_prefix = prefix_hash
+        self.turns.append(turn)
+        self.updated = time.time()
+        return turn
+
+    def compaction(self, token_budget, keep_turns):
+        # Testo da riassumere e numero di turni coperti, o (None, 0) se lo storico sta nel budget
+        if self.history_tokens() <= token_budget or len(self.turns) <= keep_turns:
+            return None, 0
+        n_turns = len(self.turns) - keep_turns
+        parts = [f"Riassunto precedente: {self.summary}"] if self.summary else []
+        for turn in self.turns[:n_turns]:
+            parts.append(f"Utente: {turn['domanda']}\nMariaCarla: {turn['risposta']}")
+        return "\n\n".join(parts), n_turns
+
+    def apply_summary(self, summary, n_turns):
+        self.summary = summary.strip()
+        self.turns = self.turns[n_turns:]
+        logger.info(f"Sessione {self.id}: {n_turns} turni riassunti, storico ~{self.history_tokens()} token.")
+
+    def info(self):
+        last = self.turns[-1] if self.turns else {}
+        return {"id": self.id, "turni": len(self.turns), "riassunto": bool(self.summary),
+                "prefill_ms": last.get('prefill_ms'), "token_prompt": last.get('token_prompt')}
+
+    def to_dict(self):
+        return {"id": self.id, "turns": self.turns, "summary": self.summary, "schema": self.schema,
+                "schema_tables": self.schema_tables, "schema_version": self.schema_version,
+                "created": self.created, "updated": self.updated, "last_prefix": self.last_prefix}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['id'], data.get('turns'), data.get('summary', ""), data.get('schema', ""),
+                   data.get('schema_tables'), data.get('schema_version'), data.get('created'),
+                   data.get('updated'), data.get('last_prefix'))
+
+
+class SessionStore:
+    # Sessioni in memoria (LRU + scadenza) e, con session_dir, un file JSON per sessione:
+    # sopravvivono al riavvio e sono condivise tra piu' processi dello stesso server.
+    # Ogni purge_every salvataggi i file scaduti vengono cancellati (purge), altrimenti la
+    # cartella crescerebbe di un file per conversazione (0 = mai).
+    def __init__(self, session_dir=None, ttl_seconds=3600, max_sessions=1000, purge_every=100):
+        self.session_dir = session_dir
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.purge_every = purge_every
+        self.sessions = OrderedDict()  # id -> (sessione, mtime del file)
+        self._lock = threading.Lock()
+        self._saves = 0
+
+    def _path(self, session_id):
+        return os.path.join(self.session_dir, f"{session_id}.json")
+
+    def _expired(self, session, now):
+        return self.ttl_seconds and now - session.updated > self.ttl_seconds
+
+    def _read(self, session_id):
+        path = self._path(session_id)
+        try:
+            mtime = os.path.getmtime(path)
+            with open(path, 'r', encoding='utf-8') as f:
+                return ChatSession.from_dict(json.load(f)), mtime
+        except FileNotFoundError:
+            return None, None
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Sessione {session_id} illeggibile: {e}")
+            return None, None
+
+    def get(self, session_id):
+        # Sessione esistente o nuova; None se l'id non e' valido
+        if not valid_session_id(session_id):
+            return None
+        now = time.time()
+        with self._lock:
+            session, mtime = self.sessions.get(session_id, (None, None))
+            if self.session_dir:
+                try:
+                    disk_mtime = os.path.getmtime(self._path(session_id))
+                except OSError:
+                    disk_mtime = None
+                if disk_mtime is not None and disk_mtime != mtime:
+                    session, mtime = self._read(session_id)  # Aggiornata da un altro processo
+            if session is None or self._expired(session, now):
+                session, mtime = ChatSession(session_id), None
+            self.sessions[session_id] = (session, mtime)
+            self.sessions.move_to_end(session_id)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+            return session
+
+    def save(self, session):
+        mtime = None
+        if self.session_dir:
+            path = self._path(session.id)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                os.makedirs(self.session_dir, exist_ok=True)  # Al primo salvataggio, non all'import
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    json.dump(session.to_dict(), f, ensure_ascii=False)
+                os.replace(tmp_path, path)
+                mtime = os.path.getmtime(path)
+            except OSError as e:
+                logger.warning(f"Impossibile salvare la sessione {session.id}: {e}")
+        with self._lock:
+            self.sessions[session.id] = (session, mtime)
+            self.sessions.move_to_end(session.id)
+            self._saves += 1
+            purge = self.purge_every and self._saves % self.purge_every == 0
+        if purge:
+            removed = self.purge()
+            if removed:
+                logger.info(f"Rimosse {removed} sessioni scadute.")
+
+    def delete(self, session_id):
+        if not valid_session_id(session_id):
+            return
+        with self._lock:
+            self.sessions.pop(session_id, None)
+        if self.session_dir:
+            try:
+                os.remove(self._path(session_id))
+            except OSError:
+                pass
+
+    def purge(self):
+        # Rimuove le sessioni scadute (memoria e disco); restituisce quante
+        now = time.time()
+        removed = 0
+        with self._lock:
+            for session_id in [sid for sid, (s, _) in self.sessions.items() if self._expired(s, now)]:
+                del self.sessions[session_id]
+                if not self.session_dir:
+                    removed += 1
+        if self.session_dir and self.ttl_seconds and os.path.isdir(self.session_dir):
+            for name in os.listdir(self.session_dir):
+                path = os.path.join(self.session_dir, name)
+                try:
+                    if name.endswith(".json") and now - os.path.getmtime(path) > self.ttl_seconds:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    def stats(self):
+        with self._lock:
+            return {"in_memoria": len(self.sessions)}
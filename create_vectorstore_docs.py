@@ -1,17 +1,24 @@
 # create_vectorstore_docs.py
 import os
+import glob
+import json
+import hashlib
+import argparse
 import logging
 import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from langchain_community.document_loaders import (
     TextLoader,
-    PyPDFLoader, # Per leggere PDF
-    DirectoryLoader
+    PyPDFLoader # Per leggere PDF
 )
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import OllamaEmbeddings # Importante!
-import ollama # Per il check
+import chromadb
+import ollama # Per il check e per gli embedding
+
+from bm25 import BM25Index, tokenize
+from doc_retriever import DOCS_INDEX_FILENAME, MANIFEST_FILENAME, chunk_search_text, manifest_fingerprint
+from doc_chunking import CHUNKER_VERSION, split_documents
+from vector_index import DTYPES, LOCAL_INDEX_DIRNAME, export_from_chroma, read_meta
 
 # --- Configurazione ---
 # Directory che contiene i .txt pre-processati e potenzialmente i PDF
@@ -19,18 +26,141 @@ DATA_DIR_TXT = "data"
 # Directory che contiene i PDF originali (se non li sposti in DATA_DIR_TXT)
 DATA_DIR_PDF = "pre_data" # O DATA_DIR_TXT se i PDF sono lì
 VECTORSTORE_DIR = "vectorstore_docs"
-OLLAMA_MODEL_NAME = os.environ.get("OLLAMA_MODEL_NAME", "qwen2:0.5b") # Usa il tuo modello
+OLLAMA_MODEL_NAME = os.environ.get("OLLAMA_MODEL_NAME", "MariaCarla") # Usa il tuo modello
+OLLAMA_DOCS_EMBED_MODEL = os.environ.get("OLLAMA_DOCS_EMBED_MODEL", os.environ.get("OLLAMA_EMBED_MODEL", OLLAMA_MODEL_NAME)) # Come in MariaCarla.py: deve essere il modello con cui l'app embedda le domande
 OLLAMA_HOST = "http://localhost:11434"
 CHROMA_COLLECTION_NAME = "rag_documents_collection"
+EMBED_BATCH_SIZE = int(os.environ.get("EMBED_BATCH_SIZE", "64")) # Chunk per singola chiamata a /api/embed
+EMBED_WORKERS = int(os.environ.get("EMBED_WORKERS", "4")) # Chiamate di embedding contemporanee verso Ollama
+EMBED_MAX_RETRIES = 3 # Tentativi per batch fallito, con attesa esponenziale
+CHROMA_ADD_BATCH_SIZE = 5000 # Chunk scritti su Chroma per ogni collection.upsert
+LOCAL_INDEX_DTYPE = os.environ.get("LOCAL_INDEX_DTYPE", "") # "float16" o "int8": esporta anche l'indice locale per RAG_BACKEND=locale ("" = no)
+LOCAL_INDEX_IVF_LISTS = int(os.environ.get("LOCAL_INDEX_IVF_LISTS", "0")) # Gruppi IVF dell'indice locale (0 = ricerca esaustiva, va bene fino a ~100k chunk)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("create_vectorstore_docs")
 
-# get_ollama_embedding non serve più qui se usiamo OllamaEmbeddings con Chroma
+def embed_batch(client, texts):
+    for attempt in range(EMBED_MAX_RETRIES + 1):
+        try:
+            return client.embed(model=OLLAMA_DOCS_EMBED_MODEL, input=texts)['embeddings']
+        except Exception as e:
+            if attempt == EMBED_MAX_RETRIES:
+                raise
+            wait = 2 ** attempt
+            logger.warning(f"Embedding batch fallito ({e}), nuovo tentativo tra {wait}s...")
+            time.sleep(wait)
+
+def embed_and_store(collection, chunks, chunk_ids, batch_size, workers):
+    # Embedding in batch su un pool limitato di chiamate parallele a Ollama,
+    # scrittura su Chroma a blocchi grandi man mano che i batch arrivano
+    client = ollama.Client(host=OLLAMA_HOST)
+    batches = [range(i, min(i + batch_size, len(chunks))) for i in range(0, len(chunks), batch_size)]
+    pending_ids, pending_embeddings, pending_docs, pending_metas = [], [], [], []
+    done = 0
+    start = time.time()
+
+    def flush():
+        if pending_ids:
+            collection.upsert(ids=pending_ids, embeddings=pending_embeddings,
+                              documents=pending_docs, metadatas=pending_metas)
+            for pending in (pending_ids, pending_embeddings, pending_docs, pending_metas):
+                pending.clear()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(embed_batch, client, [chunks[i].page_content for i in batch]): batch
+                   for batch in batches}
+        for future in as_completed(futures):
+            batch = futures[future]
+            embeddings = future.result()
+            for i, embedding in zip(batch, embeddings):
+                pending_ids.append(chunk_ids[i])
+                pending_embeddings.append(embedding)
+                pending_docs.append(chunks[i].page_content)
+                pending_metas.append(chunks[i].metadata or {"source": "N/A"})
+            done += len(batch)
+            if len(pending_ids) >= CHROMA_ADD_BATCH_SIZE:
+                flush()
+            if done == len(chunks) or done // batch_size % 10 == 0:
+                elapsed = time.time() - start
+                logger.info(f"Embedding {done}/{len(chunks)} chunks ({done / elapsed if elapsed else 0:.1f} chunks/s)")
+        flush()
+    return time.time() - start
+
+def build_bm25_index(collection, index_path):
+    # Indice BM25 di tutti i chunk della collezione (gli id sono quelli di Chroma), riletto
+    # a blocchi dopo ogni aggiornamento: costa poco rispetto agli embedding
+    start = time.time()
+    index = BM25Index()
+    offset = 0
+    while True:
+        page = collection.get(include=['documents', 'metadatas'], limit=CHROMA_ADD_BATCH_SIZE, offset=offset)
+        if not page['ids']:
+            break
+        for doc_id, text, metadata in zip(page['ids'], page['documents'], page['metadatas']):
+            index.add(doc_id, tokenize(chunk_search_text(text or "", metadata)))
+        offset += len(page['ids'])
+    tmp_path = index_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump({'index': index.to_dict()}, f)
+    os.replace(tmp_path, index_path)
+    logger.info(f"Indice BM25 di {len(index.doc_ids)} chunk ({len(index.postings)} termini) "
+                f"creato in {time.time() - start:.2f} secondi.")
+    return index
 
-def build_document_vector_store():
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def list_source_files():
+    # .txt pre-processati da 'data', .pdf da 'pre_data' (anche nelle sottocartelle)
+    sources = []
+    for directory, pattern, loader_cls in ((DATA_DIR_TXT, "*.txt", TextLoader), (DATA_DIR_PDF, "*.pdf", PyPDFLoader)):
+        if not os.path.exists(directory):
+            logger.warning(f"Directory '{directory}' non trovata per i file {pattern}.")
+            continue
+        for path in sorted(glob.glob(os.path.join(directory, "**", pattern), recursive=True)):
+            sources.append((os.path.normpath(path), loader_cls))
+    return sources
+
+def load_manifest(manifest_path):
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Manifest illeggibile ({e}): ricostruzione completa.")
+        return None
+
+def save_manifest(manifest_path, manifest):
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+def load_documents(path, loader_cls):
+    try:
+        return loader_cls(path, encoding='utf-8').load() if loader_cls is TextLoader else loader_cls(path).load()
+    except Exception as e:
+        logger.error(f"Errore caricamento '{path}': {e}")
+        return None
+
+def load_and_split(path, loader_cls):
+    # Chunk secondo il formato (righe di fogli/CSV con intestazione, paragrafi, pagine PDF): vedi doc_chunking.py
+    documents = load_documents(path, loader_cls)
+    if documents is None:
+        return None
+    return split_documents(documents, path)
+
+def build_document_vector_store(full_rebuild=False, batch_size=EMBED_BATCH_SIZE, workers=EMBED_WORKERS,
+                                local_index_dtype=LOCAL_INDEX_DTYPE, ivf_lists=LOCAL_INDEX_IVF_LISTS):
     start_time = time.time()
     vector_store_path = os.path.abspath(VECTORSTORE_DIR)
+    manifest_path = os.path.join(vector_store_path, MANIFEST_FILENAME)
 
     logger.info(f"Verifica connessione a Ollama ({OLLAMA_HOST})...")
     try:
@@ -40,74 +170,135 @@ def build_document_vector_store():
         logger.error(f"CRITICO: Impossibile connettersi a Ollama: {e}. Interruzione.")
         return False
 
-    if os.path.exists(vector_store_path):
+    manifest = {} if full_rebuild else load_manifest(manifest_path)
+    if manifest is None:
+        full_rebuild = True
+        manifest = {}
+    elif not full_rebuild and os.path.exists(vector_store_path) and (
+            not manifest or '_embedding_model' not in manifest or '_chunker' not in manifest):
+        # Vector store della versione precedente (chunk con id UUID, senza manifest): aggiungendo
+        # i file con gli id path#n i vecchi chunk resterebbero e ogni documento comparirebbe due volte
+        logger.warning("Vector store senza manifest (versione precedente dello script): ricostruzione completa.")
+        full_rebuild = True
+        manifest = {}
+    elif manifest and manifest['_embedding_model'] != OLLAMA_DOCS_EMBED_MODEL:
+        logger.warning("Modello di embedding cambiato: ricostruzione completa.")
+        full_rebuild = True
+        manifest = {}
+    elif manifest and manifest['_chunker'] != CHUNKER_VERSION:
+        logger.warning("Divisione in chunk cambiata: ricostruzione completa.")
+        full_rebuild = True
+        manifest = {}
+    if full_rebuild and os.path.exists(vector_store_path):
         logger.warning(f"Rimozione vector store esistente in {vector_store_path}.")
         try:
             shutil.rmtree(vector_store_path)
         except OSError as e:
             logger.error(f"Errore rimozione {vector_store_path}: {e}. Interruzione.")
             return False
+    files = manifest.get('files', {})
 
-    documents = []
-    # Carica .TXT dalla directory 'data' (pre-processati)
-    logger.info(f"Caricamento file .txt da '{DATA_DIR_TXT}'...")
-    if os.path.exists(DATA_DIR_TXT):
-        loader_txt = DirectoryLoader(DATA_DIR_TXT, glob="**/*.txt", loader_cls=TextLoader, show_progress=True, use_multithreading=True, silent_errors=True)
-        documents.extend(loader_txt.load())
-    else:
-        logger.warning(f"Directory '{DATA_DIR_TXT}' non trovata per i file .txt.")
+    # Confronto tra i file presenti e quelli gia' indicizzati
+    sources = list_source_files()
+    to_index = []
+    current_paths = set()
+    unchanged = 0
+    for path, loader_cls in sources:
+        current_paths.add(path)
+        stat = os.stat(path)
+        entry = files.get(path)
+        if entry and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+            unchanged += 1
+            continue
+        file_hash = file_sha256(path)
+        if entry and entry['hash'] == file_hash:
+            entry['mtime'] = stat.st_mtime  # Solo toccato: aggiorna il manifest senza re-embedding
+            unchanged += 1
+            continue
+        to_index.append((path, loader_cls, file_hash, stat))
+    deleted = [path for path in files if path not in current_paths]
+    logger.info(f"File: {len(to_index)} nuovi/modificati, {len(deleted)} rimossi, {unchanged} invariati.")
 
-    # Carica .PDF dalla directory specificata (es. 'pre_data' o 'data')
-    logger.info(f"Caricamento file .pdf da '{DATA_DIR_PDF}'...")
-    if os.path.exists(DATA_DIR_PDF):
-        loader_pdf = DirectoryLoader(DATA_DIR_PDF, glob="**/*.pdf", loader_cls=PyPDFLoader, show_progress=True, use_multithreading=True, silent_errors=True)
-        documents.extend(loader_pdf.load())
-    else:
-        logger.warning(f"Directory '{DATA_DIR_PDF}' non trovata per i file .pdf.")
+    if not sources and not deleted:
+        logger.error("Nessun documento (.txt o .pdf) trovato. Impossibile creare il vector store.")
+        return False
 
+    try:
+        # Gli embedding li calcola embed_and_store: basta la collezione di chromadb, senza il wrapper di langchain
+        collection = chromadb.PersistentClient(path=vector_store_path).get_or_create_collection(CHROMA_COLLECTION_NAME)
 
-    if not documents:
-        logger.error("Nessun documento (.txt o .pdf) caricato. Impossibile creare il vector store.")
-        return False
-    logger.info(f"Caricati {len(documents)} documenti totali.")
+        # Chunk dei file modificati o cancellati: via dalla collezione
+        stale_ids = []
+        for path in deleted:
+            stale_ids.extend(files.pop(path)['chunk_ids'])
+        for path, _, _, _ in to_index:
+            if path in files:
+                stale_ids.extend(files[path]['chunk_ids'])
+        if stale_ids:
+            logger.info(f"Rimozione di {len(stale_ids)} chunk obsoleti...")
+            collection.delete(ids=stale_ids)
 
-    logger.info("Divisione documenti in chunks...")
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=750, chunk_overlap=150) # Chunk più piccoli per modelli piccoli
-    chunks = text_splitter.split_documents(documents)
-    logger.info(f"Documenti divisi in {len(chunks)} chunks.")
+        logger.info("Divisione documenti in chunks...")
+        chunks = []
+        chunk_ids = []
+        new_entries = {}
+        for path, loader_cls, file_hash, stat in to_index:
+            file_chunks = load_and_split(path, loader_cls)
+            if file_chunks is None:
+                files.pop(path, None)
+                continue
+            ids = [f"{path}#{i}" for i in range(len(file_chunks))]
+            chunks.extend(file_chunks)
+            chunk_ids.extend(ids)
+            new_entries[path] = {'hash': file_hash, 'mtime': stat.st_mtime, 'size': stat.st_size, 'chunk_ids': ids}
+        logger.info(f"Nuovi chunks da indicizzare: {len(chunks)}.")
 
-    if not chunks:
-        logger.error("Nessun chunk generato.")
-        return False
+        if chunks:
+            logger.info(f"Creazione embeddings e vector store (Modello: {OLLAMA_DOCS_EMBED_MODEL}, "
+                        f"batch {batch_size}, {workers} chiamate parallele)...")
+            embeddings_duration = embed_and_store(collection, chunks, chunk_ids, batch_size, workers)
+            logger.info(f"Embedding di {len(chunks)} chunks completato in {embeddings_duration:.2f} secondi "
+                        f"({len(chunks) / embeddings_duration if embeddings_duration else 0:.1f} chunks/s).")
 
-    logger.info(f"Creazione embeddings e vector store (Modello: {OLLAMA_MODEL_NAME})...")
-    embeddings_start_time = time.time()
-    try:
-        # Usa OllamaEmbeddings direttamente con Chroma
-        embedding_function = OllamaEmbeddings(
-            model=OLLAMA_MODEL_NAME,
-            base_url=OLLAMA_HOST
-        )
-        vector_store = Chroma.from_documents(
-            documents=chunks, # Passa i chunks direttamente
-            embedding=embedding_function, # Lascia che Chroma gestisca gli embedding
-            persist_directory=vector_store_path,
-            collection_name=CHROMA_COLLECTION_NAME
-        )
-        # vector_store.persist() # from_documents dovrebbe già persistere se persist_directory è specificato
-
-        embeddings_duration = time.time() - embeddings_start_time
-        logger.info(f"Creazione vector store completata in {embeddings_duration:.2f} secondi.")
+        files.update(new_entries)
+        manifest = {'_embedding_model': OLLAMA_DOCS_EMBED_MODEL, '_chunker': CHUNKER_VERSION, 'files': files}
+        save_manifest(manifest_path, manifest)
+        if chunks or stale_ids or not os.path.exists(os.path.join(vector_store_path, DOCS_INDEX_FILENAME)):
+            build_bm25_index(collection, os.path.join(vector_store_path, DOCS_INDEX_FILENAME))
+        # Indice locale: richiesto ora o gia' esportato in passato (allora con il suo dtype e i suoi gruppi IVF),
+        # riesportato se la collezione e' cambiata dall'ultimo export
+        local_index_dir = os.path.join(vector_store_path, LOCAL_INDEX_DIRNAME)
+        meta = read_meta(local_index_dir)
+        if local_index_dtype or meta is not None:
+            if not local_index_dtype:
+                local_index_dtype, ivf_lists = meta['dtype'], meta['ivf_lists']
+            fingerprint = manifest_fingerprint(manifest)
+            if (meta is None or meta.get('impronta') != fingerprint or meta['dtype'] != local_index_dtype
+                    or meta['ivf_lists'] != ivf_lists):
+                if export_from_chroma(collection, local_index_dir, local_index_dtype, ivf_lists,
+                                      page_size=CHROMA_ADD_BATCH_SIZE, fingerprint=fingerprint) is None:
+                    # Niente da esportare: meglio nessun indice che uno con chunk non piu' presenti
+                    shutil.rmtree(local_index_dir, ignore_errors=True)
         total_duration = time.time() - start_time
-        logger.info(f"Processo completato in {total_duration:.2f} secondi.")
+        logger.info(f"Processo completato in {total_duration:.2f} secondi. Elementi nella collezione: {collection.count()}")
         return True
     except Exception as e:
         logger.error(f"ERRORE CRITICO durante creazione vector store: {e}", exc_info=True)
         return False
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crea o aggiorna il vector store dei documenti.")
+    parser.add_argument("--full", action="store_true", help="Ricostruisce da zero invece di indicizzare solo i file nuovi/modificati")
+    parser.add_argument("--batch-size", type=int, default=EMBED_BATCH_SIZE, help="Chunk per chiamata di embedding")
+    parser.add_argument("--workers", type=int, default=EMBED_WORKERS, help="Chiamate di embedding parallele verso Ollama")
+    parser.add_argument("--local-index", choices=DTYPES, default=LOCAL_INDEX_DTYPE or None,
+                        help="Esporta anche l'indice locale memory-mapped con vettori in questo formato")
+    parser.add_argument("--ivf-lists", type=int, default=LOCAL_INDEX_IVF_LISTS, help="Gruppi IVF dell'indice locale (0 = nessuno)")
+    args = parser.parse_args()
+
     logger.info("--- Avvio Script Creazione Vector Store Documenti ---")
-    if build_document_vector_store():
+    if build_document_vector_store(full_rebuild=args.full, batch_size=args.batch_size, workers=args.workers,
+                                   local_index_dtype=args.local_index, ivf_lists=args.ivf_lists):
         logger.info("--- Script completato con successo ---")
     else:
-        logger.error("--- Script terminato con errori ---")
\ No newline at end of file
+        logger.error("--- Script terminato con errori ---")
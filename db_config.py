@@ -3,5 +3,8 @@ DB_CONFIG = {
     'host': 'localhost',
     'user': 'mariacarla',      
     'password': 'passwordMariaCarla', 
-    'database': 'mariacarla'
+    'database': 'mariacarla',
+    'pool_size': 5,            # Connessioni persistenti nel pool
+    'pool_max_overflow': 2,    # Connessioni extra temporanee nei picchi
+    'pool_wait_timeout': 10    # Secondi di attesa massima per una connessione libera
 }
\ No newline at end of file
@@ -0,0 +1,140 @@
+# db_pool.py
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import mysql.connector
+from mysql.connector import pooling
+from mysql.connector.errors import PoolError
+
+logger = logging.getLogger("db_pool")
+
+# Chiavi di DB_CONFIG che riguardano il pool e non vanno passate a mysql.connector
+POOL_CONFIG_KEYS = ('pool_name', 'pool_size', 'pool_max_overflow', 'pool_wait_timeout')
+
+
+class PoolTimeoutError(PoolError):
+    pass
+
+
+class DBPool:
+    # Pool di connessioni MySQL thread-safe sopra mysql.connector.pooling:
+    # - pool_size connessioni persistenti, fino a pool_max_overflow connessioni extra temporanee
+    # - oltre il limite si attende al massimo pool_wait_timeout secondi, poi PoolTimeoutError
+    # - ogni connessione viene verificata (ping) prima di essere consegnata
+    def __init__(self, db_config):
+        pool_config = {k: db_config[k] for k in POOL_CONFIG_KEYS if k in db_config}
+        self.connect_config = {k: v for k, v in db_config.items() if k not in POOL_CONFIG_KEYS}
+        self.pool_size = int(pool_config.get('pool_size', 5))
+        self.max_overflow = int(pool_config.get('pool_max_overflow', 2))
+        self.wait_timeout = float(pool_config.get('pool_wait_timeout', 10))
+        self._pool = pooling.MySQLConnectionPool(
+            pool_name=pool_config.get('pool_name', 'mariacarla'),
+            pool_size=self.pool_size,
+            pool_reset_session=True,
+            **self.connect_config
+        )
+        self._slots = threading.BoundedSemaphore(self.pool_size + self.max_overflow)
+        self._stats_lock = threading.Lock()
+        self._in_use = 0
+        self._overflow_in_use = 0
+        self._checkouts = 0
+        self._waits = 0
+        self._timeouts = 0
+        self._reconnects = 0
+        self._wait_time_total = 0.0
+        self._wait_time_max = 0.0
+
+    def _acquire_slot(self):
+        if self._slots.acquire(blocking=False):
+            return
+        start = time.monotonic()
+        acquired = self._slots.acquire(timeout=self.wait_timeout)
+        waited = time.monotonic() - start
+        with self._stats_lock:
+            self._waits += 1
+            self._wait_time_total += waited
+            self._wait_time_max = max(self._wait_time_max, waited)
+            if not acquired:
+                self._timeouts += 1
+        if not acquired:
+            raise PoolTimeoutError(f"Nessuna connessione MySQL libera dopo {self.wait_timeout:.1f}s.")
+
+    def _checkout(self):
+        try:
+            return self._pool.get_connection(), False
+        except PoolError:
+            # Pool pieno ma c'e' ancora uno slot di overflow: connessione temporanea
+            return mysql.connector.connect(**self.connect_config), True
+
+    def _health_check(self, conn):
+        if conn.is_connected():
+            return
+        logger.warning("Connessione MySQL dal pool non valida, riconnessione...")
+        conn.reconnect(attempts=2, delay=0.5)
+        with self._stats_lock:
+            self._reconnects += 1
+
+    @contextmanager
+    def connection(self):
+        self._acquire_slot()
+        conn = None
+        overflow = False
+        try:
+            conn, overflow = self._checkout()
+            self._health_check(conn)
+            with self._stats_lock:
+                self._checkouts += 1
+                self._in_use += 1
+                if overflow:
+                    self._overflow_in_use += 1
+            try:
+                yield conn
+            finally:
+                with self._stats_lock:
+                    self._in_use -= 1
+                    if overflow:
+                        self._overflow_in_use -= 1
+        finally:
+            if conn is not None:
+                try:
+                    conn.close()  # Per le connessioni del pool equivale a restituirla
+                except mysql.connector.Error as err:
+                    logger.warning(f"Errore chiusura connessione MySQL: {err}")
+            self._slots.release()
+
+    def close(self):
+        # Chiude le connessioni libere (es. nel master prima del fork dei worker, che non devono
+        # ereditare i socket MySQL). Si svuota il pool con get_connection() e si chiude il socket di
+        # ognuna; le connessioni in uso in quel momento restano aperte. Dopo close() il pool non va piu' usato.
+        closed = 0
+        while True:
+            try:
+                conn = self._pool.get_connection()
+            except PoolError:
+                break
+            except mysql.connector.Error as err:
+                logger.warning(f"Errore chiusura pool MySQL: {err}")
+                break
+            try:
+                conn.disconnect()
+                closed += 1
+            except mysql.connector.Error as err:
+                logger.warning(f"Errore chiusura connessione MySQL: {err}")
+        logger.info(f"Pool MySQL chiuso ({closed} connessioni).")
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "pool_size": self.pool_size,
+                "max_overflow": self.max_overflow,
+                "in_use": self._in_use,
+                "overflow_in_use": self._overflow_in_use,
+                "checkouts": self._checkouts,
+                "waits": self._waits,
+                "timeouts": self._timeouts,
+                "reconnects": self._reconnects,
+                "wait_time_total_s": round(self._wait_time_total, 4),
+                "wait_time_max_s": round(self._wait_time_max, 4),
+            }
@@ -0,0 +1,125 @@
+# doc_chunking.py
+# Divisione in chunk secondo il formato del documento, al posto di un unico
+# RecursiveCharacterTextSplitter con il 20% di sovrapposizione su tutto:
+#   - fogli Excel e CSV (i .txt di preprocess_files.py): righe mai tagliate, ogni chunk ripete
+#     foglio e intestazione delle colonne; foglio e righe finiscono nei metadati
+#   - DOCX e testo: paragrafi interi accorpati fino a CHUNK_SIZE
+#   - PDF: come il testo, pagina per pagina, con il numero di pagina nei metadati
+# Solo un paragrafo piu' lungo di CHUNK_SIZE viene tagliato, con una piccola sovrapposizione.
+import re
+
+from langchain_core.documents import Document
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+CHUNK_SIZE = 750 # Caratteri massimi per chunk (modelli di embedding piccoli)
+CHUNK_OVERLAP = 150 # Sovrapposizione dello splitter generico usato prima (solo per il confronto)
+LONG_PARAGRAPH_OVERLAP = 50 # Sovrapposizione quando un paragrafo troppo lungo va tagliato
+CHUNKER_VERSION = 1 # Salvata nel manifest dell'indice: se cambia, i documenti vengono ridivisi
+TABLE_FORMATS = ("excel", "csv")
+
+SOURCE_LINE_RE = re.compile(r"^Fonte_(Excel|CSV|DOCX): (.*)$")
+SECTION_RE = re.compile(r"^--- Foglio: (.*) \(righe (\d+)-\d+\) ---$")
+
+
+def legacy_splitter():
+    # Lo splitter di prima, per confrontare numero di chunk ed embedding
+    return RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+
+
+def source_format(text):
+    # (formato, corpo) dalla prima riga scritta da preprocess_files.py ("Fonte_Excel: nome.xlsx")
+    first_line, _, body = text.partition("\n")
+    match = SOURCE_LINE_RE.match(first_line.strip())
+    if not match:
+        return "testo", text
+    return match.group(1).lower(), body
+
+
+def split_paragraphs(text, single_line=False):
+    # DOCX: ogni riga e' un paragrafo di Word; altrove i paragrafi sono separati da righe vuote
+    parts = text.split("\n") if single_line else re.split(r"\n\s*\n", text)
+    return [part.strip() for part in parts if part.strip()]
+
+
+def split_prose(text, metadata, chunk_size=CHUNK_SIZE, single_line=False):
+    long_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=LONG_PARAGRAPH_OVERLAP)
+    texts = []
+    current = []
+    size = 0
+    for paragraph in split_paragraphs(text, single_line):
+        if current and size + len(paragraph) > chunk_size:
+            texts.append("\n\n".join(current))
+            current, size = [], 0
+        if len(paragraph) > chunk_size:
+            texts.extend(long_splitter.split_text(paragraph))
+            continue
+        current.append(paragraph)
+        size += len(paragraph) + 2
+    if current:
+        texts.append("\n\n".join(current))
+    return [Document(page_content=t, metadata=dict(metadata)) for t in texts]
+
+
+def split_table_text(text, metadata, chunk_size=CHUNK_SIZE):
+    # Righe intere accorpate fino a chunk_size, anche oltre i gruppi di preprocess_files.py,
+    # finche' foglio e intestazione restano gli stessi. Una riga da sola piu' lunga resta intera.
+    chunks = []
+    section = header = None
+    expect_header = False
+    rows = []
+    first_row = row_number = 0
+    size = 0
+
+    def flush():
+        if rows:
+            last_row = first_row + len(rows) - 1
+            content = f"Foglio: {section} (righe {first_row}-{last_row})\n{header}\n" + "\n".join(rows)
+            chunks.append(Document(page_content=content, metadata={
+                **metadata, 'foglio': section, 'riga_inizio': first_row, 'riga_fine': last_row}))
+            rows.clear()
+
+    for line in text.splitlines():
+        match = SECTION_RE.match(line)
+        if match:
+            if match.group(1) != section:
+                flush()
+                section = match.group(1)
+            row_number = int(match.group(2)) - 1
+            expect_header = True
+            continue
+        if section is None or not line.strip():
+            continue
+        if expect_header:
+            expect_header = False
+            if line != header:
+                flush()
+                header = line
+            continue
+        row_number += 1
+        prefix_size = len(section) + len(header) + 30
+        if rows and (row_number != first_row + len(rows) or prefix_size + size + len(line) > chunk_size):
+            flush()
+        if not rows:
+            first_row, size = row_number, 0
+        rows.append(line)
+        size += len(line) + 1
+    flush()
+    return chunks
+
+
+def split_documents(documents, path, chunk_size=CHUNK_SIZE):
+    # documents: quelli del loader (uno per file .txt, uno per pagina con PyPDFLoader)
+    chunks = []
+    for document in documents:
+        if 'page' in document.metadata:
+            metadata = {'source': path, 'formato': "pdf", 'pagina': int(document.metadata['page']) + 1}
+            chunks.extend(split_prose(document.page_content, metadata, chunk_size))
+            continue
+        file_format, body = source_format(document.page_content)
+        metadata = {'source': path, 'formato': file_format}
+        if file_format in TABLE_FORMATS:
+            # .txt di una versione precedente di preprocess_files.py (senza gruppi di righe): come testo
+            chunks.extend(split_table_text(body, metadata, chunk_size) or split_prose(body, metadata, chunk_size))
+        else:
+            chunks.extend(split_prose(body, metadata, chunk_size, single_line=file_format == "docx"))
+    return chunks
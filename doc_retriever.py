@@ -0,0 +1,288 @@
+# doc_retriever.py
+import os
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_community.vectorstores import Chroma
+
+from bm25 import BM25Index, tokenize
+from metrics import STAGE_SECONDS
+from vector_index import LOCAL_INDEX_DIRNAME, LocalVectorIndex
+
+logger = logging.getLogger("doc_retriever")
+
+SYSTEM_RAG_DOCS = "Rispondi in italiano basandoti ESCLUSIVAMENTE sul contesto. Se l'info non c'è, dillo."
+DOCS_INDEX_FILENAME = "docs_bm25.json" # Indice BM25 dei chunk, scritto da create_vectorstore_docs.py accanto a Chroma
+MANIFEST_FILENAME = "index_manifest.json" # File indicizzati e modello di embedding usato, scritto da create_vectorstore_docs.py
+RRF_K = 60 # Costante della reciprocal rank fusion: smorza il peso delle prime posizioni
+
+
+class CachedOllamaEmbeddings(Embeddings):
+    # Embeddings LangChain sopra il client Ollama condiviso: le domande passano per la LRU
+    # del client manager, i documenti (indicizzazione) vanno dritti a Ollama
+    def __init__(self, ollama_manager, model):
+        self.ollama_manager = ollama_manager
+        self.model = model
+
+    def embed_documents(self, texts):
+        return self.ollama_manager.embed(self.model, texts)['embeddings']
+
+    def embed_query(self, text):
+        return self.ollama_manager.embed_query(self.model, text)
+
+
+def manifest_fingerprint(manifest):
+    # Impronta dei file indicizzati (percorso, hash, numero di chunk): cambia quando cambiano i chunk
+    # della collezione, non quando un file viene solo toccato. Salvata nell'indice locale esportato.
+    files = sorted((path, entry['hash'], len(entry['chunk_ids'])) for path, entry in manifest.get('files', {}).items())
+    return hashlib.sha256(json.dumps(files).encode('utf-8')).hexdigest()
+
+
+def chunk_search_text(text, metadata):
+    # Testo indicizzato da BM25: il chunk piu' il nome del file di origine
+    source = (metadata or {}).get('source', "")
+    return f"{text} {os.path.basename(source)}"
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    # Fonde piu' classifiche di id: punteggio = somma di 1 / (k + posizione)
+    scores = {}
+    for ranking in rankings:
+        for position, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + position)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class CrossEncoderReranker:
+    # Riordino locale opzionale con un cross-encoder (sentence-transformers, es.
+    # "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"): valuta domanda e chunk insieme.
+    # Se il pacchetto o il modello mancano resta disattivo e si usa l'ordine della fusione.
+    def __init__(self, model_name, max_length=512):
+        self.model_name = model_name
+        self.max_length = max_length
+        self.model = None
+
+    def load(self):
+        try:
+            from sentence_transformers import CrossEncoder
+            start = time.time()
+            self.model = CrossEncoder(self.model_name, max_length=self.max_length)
+            logger.info(f"Cross-encoder '{self.model_name}' caricato in {time.time() - start:.2f}s.")
+            return True
+        except Exception as e:
+            logger.warning(f"Cross-encoder '{self.model_name}' non disponibile, niente riordino: {e}")
+            self.model = None
+            return False
+
+    def rerank(self, question, docs):
+        if self.model is None or len(docs) < 2:
+            return docs
+        scores = self.model.predict([(question, doc.page_content) for doc in docs])
+        order = sorted(range(len(docs)), key=lambda i: float(scores[i]), reverse=True)
+        return [docs[i] for i in order]
+
+
+def build_rag_prompts(user_question, retrieved_docs):
+    if not retrieved_docs:
+        context = "Nessuna informazione pertinente trovata nei documenti."
+    else:
+        context = "\n\n---\n\n".join([doc.page_content for doc in retrieved_docs])
+    prompt_rag_docs = f"Contesto:\n{context}\n\nDomanda: {user_question}\n\nRisposta:"
+    return SYSTEM_RAG_DOCS, prompt_rag_docs
+
+
+class DocumentRetriever:
+    # Servizio di recupero documenti: la collezione Chroma creata da create_vectorstore_docs.py
+    # viene aperta una volta sola all'avvio e la funzione di embedding viene riusata.
+    # Tempi di recupero (embedding domanda + ricerca) misurati a parte rispetto alla generazione.
+    # Ricerca ibrida: se accanto a Chroma c'e' l'indice BM25 dei chunk, le prime `candidates`
+    # posizioni densa e BM25 vengono fuse (RRF) e, con un reranker, riordinate prima del top k.
+    # backend "locale": ricerca e testi dall'indice memory-mapped esportato accanto a Chroma
+    # (vector_index.py), senza aprire Chroma; se l'indice manca si torna a Chroma.
+    def __init__(self, persist_dir, collection_name, embeddings, k=3, candidates=20, reranker=None,
+                 backend="chroma", nprobe=8):
+        self.persist_dir = persist_dir
+        self.collection_name = collection_name
+        self.embeddings = embeddings
+        self.k = k
+        self.candidates = candidates
+        self.reranker = reranker
+        self.backend = backend
+        self.nprobe = nprobe
+        self.vector_store = None
+        self.local_index = None
+        self.bm25_index = None
+        self._stats_lock = threading.Lock()
+        self._retrievals = 0
+        self._embed_time_total = 0.0
+        self._search_time_total = 0.0
+
+    @property
+    def ready(self):
+        return self.vector_store is not None or self.local_index is not None
+
+    def load(self, chroma=True):
+        # chroma=False: solo indice locale e BM25, che si possono condividere tra processi dopo un
+        # fork; Chroma (SQLite e thread propri) va aperto nel processo che lo usa
+        if not os.path.exists(self.persist_dir):
+            logger.error(f"'{self.persist_dir}' non trovato. Esegui 'create_vectorstore_docs.py'.")
+            return False
+        manifest = self._load_manifest()
+        if not self._check_embedding_model(manifest):
+            return False
+        count = self._load_local_index(manifest) if self.backend == "locale" else None
+        if count is None and not chroma:
+            return False
+        if count is None:
+            try:
+                start = time.time()
+                self.vector_store = Chroma(
+                    persist_directory=self.persist_dir,
+                    embedding_function=self.embeddings,
+                    collection_name=self.collection_name
+                )
+                count = self.vector_store._collection.count()
+                logger.info(f"Vector store documenti caricato in {time.time() - start:.2f}s. Elementi: {count}")
+            except Exception as e:
+                logger.error(f"Errore caricamento vector store documenti: {e}", exc_info=True)
+                self.vector_store = None
+                return False
+        self.bm25_index = self._load_bm25(count)
+        if self.reranker is not None and self.reranker.model is None:
+            self.reranker.load()
+        return True
+
+    def _load_manifest(self):
+        path = os.path.join(self.persist_dir, MANIFEST_FILENAME)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Manifest documenti illeggibile ({path}): {e}")
+            return None
+
+    def _check_embedding_model(self, manifest):
+        # Le domande vanno embeddate con lo stesso modello dei chunk: con un altro la ricerca densa
+        # restituisce chunk a caso (o fallisce per dimensioni diverse) senza nessun errore visibile
+        model = getattr(self.embeddings, 'model', None)
+        if model is None or manifest is None:
+            return True
+        indexed_model = manifest.get('_embedding_model')
+        if indexed_model and indexed_model != model:
+            logger.error(f"Documenti indicizzati con il modello '{indexed_model}', domande con '{model}': "
+                         f"imposta OLLAMA_DOCS_EMBED_MODEL={indexed_model} o riesegui 'create_vectorstore_docs.py'. "
+                         f"Documenti non caricati.")
+            return False
+        return True
+
+    def _load_local_index(self, manifest):
+        # Con il manifest l'indice deve essere stato esportato dalla stessa versione della collezione
+        index = LocalVectorIndex(os.path.join(self.persist_dir, LOCAL_INDEX_DIRNAME), nprobe=self.nprobe)
+        if not index.load(manifest_fingerprint(manifest) if manifest else None):
+            logger.warning("Indice locale non disponibile: ricerca su Chroma. "
+                           "Esegui 'create_vectorstore_docs.py --local-index float16'.")
+            return None
+        self.local_index = index
+        return index.count
+
+    def _load_bm25(self, count):
+        path = os.path.join(self.persist_dir, DOCS_INDEX_FILENAME)
+        if not os.path.exists(path):
+            logger.warning(f"Indice BM25 documenti non trovato ({path}): solo ricerca densa.")
+            return None
+        try:
+            start = time.time()
+            with open(path, 'r', encoding='utf-8') as f:
+                index = BM25Index.from_dict(json.load(f)['index'])
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"Indice BM25 documenti illeggibile ({path}): {e}")
+            return None
+        if len(index.doc_ids) != count:
+            # Indice di un'altra versione della collezione: meglio nessun BM25 che id inesistenti
+            logger.warning(f"Indice BM25 con {len(index.doc_ids)} chunk, collezione con {count}: "
+                           f"riesegui 'create_vectorstore_docs.py'. Solo ricerca densa.")
+            return None
+        logger.info(f"Indice BM25 documenti caricato in {time.time() - start:.2f}s ({len(index.postings)} termini).")
+        return index
+
+    def retrieve(self, question, k=None, mode=None):
+        embed_start = time.time()
+        query_embedding = self.embeddings.embed_query(question)
+        return self.search_by_vector(query_embedding, k=k, embed_time=time.time() - embed_start,
+                                     question=question, mode=mode)
+
+    def dense_ids(self, query_embedding, n):
+        if self.local_index is not None:
+            return self.local_index.search(query_embedding, n)
+        result = self.vector_store._collection.query(query_embeddings=[query_embedding], n_results=n, include=[])
+        return result['ids'][0]
+
+    def bm25_ids(self, question, n):
+        if self.bm25_index is None or not question:
+            return []
+        return [doc_id for doc_id, _ in self.bm25_index.top_k(tokenize(question), n)]
+
+    def fetch(self, ids):
+        # Chunk nell'ordine degli id richiesti
+        if not ids:
+            return []
+        if self.local_index is not None:
+            result = self.local_index.get(ids)
+        else:
+            result = self.vector_store._collection.get(ids=ids, include=['documents', 'metadatas'])
+        found = {doc_id: Document(page_content=text or "", metadata=metadata or {})
+                 for doc_id, text, metadata in zip(result['ids'], result['documents'], result['metadatas'])}
+        return [found[doc_id] for doc_id in ids if doc_id in found]
+
+    def search_by_vector(self, query_embedding, k=None, embed_time=0.0, question=None, mode=None):
+        # mode: "densa", "bm25", "ibrida" o "riordino" (ibrida + cross-encoder); di default
+        # la migliore disponibile. La domanda serve per BM25 e riordino.
+        k = k or self.k
+        if mode is None:
+            mode = "ibrida" if self.bm25_index is not None and question else "densa"
+            if mode == "ibrida" and self.reranker is not None and self.reranker.model is not None:
+                mode = "riordino"
+        search_start = time.time()
+        if mode == "densa":
+            ids = self.dense_ids(query_embedding, k)
+        elif mode == "bm25":
+            ids = self.bm25_ids(question, k)
+        else:
+            ids = reciprocal_rank_fusion([self.dense_ids(query_embedding, self.candidates),
+                                          self.bm25_ids(question, self.candidates)])
+        if mode == "riordino" and self.reranker is not None:
+            retrieved_docs = self.reranker.rerank(question, self.fetch(ids[:self.candidates]))[:k]
+        else:
+            retrieved_docs = self.fetch(ids[:k])
+        search_time = time.time() - search_start
+        STAGE_SECONDS.observe("embedding_domanda", value=embed_time)
+        STAGE_SECONDS.observe("ricerca_documenti", value=search_time)
+        with self._stats_lock:
+            self._retrievals += 1
+            self._embed_time_total += embed_time
+            self._search_time_total += search_time
+        sources = list(set(doc.metadata.get('source', 'N/A') for doc in retrieved_docs))
+        logger.info(f"Recupero documenti ({mode}): {len(retrieved_docs)} chunk in {(embed_time + search_time) * 1000:.1f}ms "
+                    f"(embedding {embed_time * 1000:.1f}ms, ricerca {search_time * 1000:.1f}ms). Fonti: {sources}")
+        return retrieved_docs
+
+    def stats(self):
+        with self._stats_lock:
+            n = self._retrievals or 1
+            return {
+                "ready": self.ready,
+                "backend": "locale" if self.local_index is not None else "chroma",
+                "indice_locale": self.local_index.stats() if self.local_index is not None else None,
+                "bm25": self.bm25_index is not None,
+                "reranker": self.reranker.model_name if self.reranker is not None and self.reranker.model is not None else None,
+                "retrievals": self._retrievals,
+                "avg_embed_ms": round(self._embed_time_total / n * 1000, 2),
+                "avg_search_ms": round(self._search_time_total / n * 1000, 2),
+            }
@@ -0,0 +1,68 @@
+# gunicorn.conf.py
+# Avvio in produzione su tutti i core:
+#   gunicorn -c gunicorn.conf.py                         MariaCarla.py (WSGI, thread in ogni worker)
+#   MARIACARLA_APP=async gunicorn -c gunicorn.conf.py    mariacarla_async.py (worker uvicorn)
+# Il master importa l'app e chiama preload() una sola volta: indice locale dei documenti e BM25,
+# catalogo e indice dello schema, router e warm-up dei modelli vengono condivisi copy-on-write
+# dai worker. Ogni worker apre dopo il fork le proprie connessioni verso MySQL e Ollama.
+# Il tetto di chiamate verso Ollama (OLLAMA_NUM_PARALLEL) viene diviso tra i worker.
+#
+# Ricarica senza interrompere il servizio:
+#   kill -HUP <pid master>   il master ripete preload() (nuovi documenti, schema, esempi del router),
+#                            avvia i nuovi worker e chiude i vecchi dopo le richieste in corso
+#   kill -USR2 <pid master>  nuovo master con il codice aggiornato; poi kill -TERM al vecchio master
+import gc
+import importlib
+import logging
+import multiprocessing
+import os
+import time
+
+import metrics
+
+MARIACARLA_APP = os.environ.get("MARIACARLA_APP", "sync")
+MODULE_NAME = "mariacarla_async" if MARIACARLA_APP == "async" else "MariaCarla"
+
+bind = os.environ.get("MARIACARLA_BIND", "0.0.0.0:5000")
+workers = int(os.environ.get("WEB_CONCURRENCY", str(multiprocessing.cpu_count())))
+os.environ["WEB_CONCURRENCY"] = str(workers)  # Letto dall'app per dividere il tetto verso Ollama
+wsgi_app = f"{MODULE_NAME}:app"
+if MARIACARLA_APP == "async":
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    worker_class = "gthread"
+    threads = int(os.environ.get("MARIACARLA_THREADS", "16"))  # Richieste contemporanee per worker
+preload_app = True
+timeout = int(os.environ.get("MARIACARLA_TIMEOUT", "300"))  # Le risposte in stream possono durare minuti
+graceful_timeout = int(os.environ.get("MARIACARLA_GRACEFUL_TIMEOUT", "120"))
+keepalive = 5
+max_requests = int(os.environ.get("MARIACARLA_MAX_REQUESTS", "0"))  # >0: worker riciclati dopo tante richieste
+max_requests_jitter = max_requests // 10
+
+logger = logging.getLogger("gunicorn.error")
+config_loaded = time.perf_counter()
+
+
+def preload_shared_state(server):
+    module = importlib.import_module(MODULE_NAME)
+    module.preload()
+    # Oggetti gia' creati fuori dal garbage collector: i worker non ne toccano le pagine e restano condivise
+    gc.freeze()
+
+
+def when_ready(server):
+    preload_shared_state(server)
+    logger.info(f"Master {os.getpid()} pronto in {time.perf_counter() - config_loaded:.2f}s, {workers} worker "
+                f"{worker_class}, memoria {metrics.process_memory()}.")
+
+
+def on_reload(server):
+    start = time.perf_counter()
+    preload_shared_state(server)
+    logger.info(f"Stato condiviso ricaricato in {time.perf_counter() - start:.2f}s, avvio dei nuovi worker.")
+
+
+def post_worker_init(worker):
+    # L'app asincrona si inizializza in before_serving, dentro il proprio event loop
+    if MARIACARLA_APP != "async":
+        importlib.import_module(MODULE_NAME).init_worker()
@@ -0,0 +1,218 @@
+# intent_router.py
+# Instradamento della domanda (database / documenti / chiacchiera) senza una chiamata LLM:
+# similarita' coseno tra l'embedding della domanda (lo stesso usato da cache SQL e RAG)
+# e degli esempi etichettati. Solo sotto INTENT_MIN_CONFIDENCE si chiede al modello.
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+from metrics import INTENT_DECISIONS
+from sql_assistant import is_db_question
+
+logger = logging.getLogger("intent_router")
+
+INTENT_DB = "db"
+INTENT_DOCS = "documenti"
+INTENT_CHAT = "chiacchiera"
+INTENTS = (INTENT_DB, INTENT_DOCS, INTENT_CHAT)
+
+SEED_EXAMPLES = {
+    INTENT_DB: [
+        "elenca i clienti", "quanti ordini ci sono stati questo mese", "mostrami le prime 10 righe della tabella",
+        "totale fatturato per anno", "quali prodotti hanno prezzo maggiore di 100", "dati di vendita per regione",
+        "record della tabella utenti creati ieri", "conta le fatture non pagate", "media degli importi per cliente",
+        "elenca da database gli articoli in magazzino", "ultimi 5 movimenti registrati", "query sui dipendenti assunti nel 2023",
+        "quante righe ha la tabella ordini", "somma delle quantita' per prodotto", "chi sono i fornitori di Milano",
+    ],
+    INTENT_DOCS: [
+        "cosa dice il regolamento sulle ferie", "come si configura la stampante", "qual e' la procedura per il rimborso spese",
+        "riassumi il documento sulla sicurezza", "cosa prevede il contratto in caso di recesso", "spiegami le istruzioni del manuale",
+        "quali sono le norme aziendali sullo smart working", "secondo i documenti come si richiede un permesso",
+        "cosa c'e' scritto nella circolare", "quali requisiti servono per il bando", "dove trovo le linee guida per i fornitori",
+        "come funziona il processo di approvazione", "cosa dice la policy sulla privacy", "descrivi la procedura di emergenza",
+    ],
+    INTENT_CHAT: [
+        "ciao", "buongiorno", "come stai", "chi sei", "grazie", "grazie mille, perfetto", "cosa sai fare",
+        "come ti chiami", "buonasera MariaCarla", "ok", "arrivederci", "sei un robot?", "aiutami", "salve",
+    ],
+}
+
+# Parole che da sole rendono molto piu' probabile una domanda sul database: alzano a priori
+# le probabilita' (odds) della classe db prima della soglia di confidenza
+DB_STRONG_KEYWORDS = re.compile(r"\b(tabella|tabelle|query|sql|database)\b", re.IGNORECASE)
+DB_KEYWORD_ODDS = 9.0
+SCALE_GRID = (1.0, 2.0, 3.0, 5.0, 8.0, 12.0, 20.0, 30.0, 50.0) # Scale provate dalla calibrazione
+
+SYSTEM_INTENT = ("Classifica la domanda dell'utente. Rispondi con UNA sola parola: "
+                 "'db' se chiede dati presenti nel database aziendale, 'documenti' se riguarda il contenuto "
+                 "di documenti/manuali/regolamenti, 'chiacchiera' se e' un saluto o una conversazione generica.")
+SYSTEM_CHAT = "Sei MariaCarla, un'assistente aziendale. Rispondi in italiano, in modo breve e cordiale."
+
+
+def build_intent_prompts(user_question):
+    return SYSTEM_INTENT, f"Domanda: {user_question}\nClasse:"
+
+
+def parse_llm_intent(text):
+    text = text.lower()
+    if "</think>" in text:
+        text = text.split("</think>", 1)[1]
+    for intent in INTENTS:
+        if intent in text:
+            return intent
+    return None
+
+
+def keyword_intent(user_question):
+    return INTENT_DB if is_db_question(user_question) else INTENT_DOCS
+
+
+class IntentRouter:
+    # Classificatore a vicini: per ogni classe la similarita' con l'esempio piu' vicino,
+    # poi softmax (scale = 1 / temperatura) per avere una confidenza tra 0 e 1.
+    # Con scale=None la scala si calibra sugli esempi a ogni train().
+    # Esempi: SEED_EXAMPLES + file JSONL {"domanda", "intento"} (es. ricavato da log_path).
+    # Oltre log_max_bytes il log delle decisioni passa a log_path + ".1" e ricomincia (0 = nessun limite).
+    def __init__(self, embed_many_fn, examples_path=None, log_path=None, min_confidence=0.6, scale=None,
+                 log_max_bytes=10 * 1024 * 1024):
+        self.embed_many_fn = embed_many_fn
+        self.examples_path = examples_path
+        self.log_path = log_path
+        self.log_max_bytes = log_max_bytes
+        self.min_confidence = min_confidence
+        self.scale = scale
+        self.fixed_scale = scale is not None
+        self.matrix = None
+        self.labels = None
+        self._log_lock = threading.Lock()
+
+    @property
+    def trained(self):
+        return self.matrix is not None
+
+    def load_examples(self):
+        examples = [(q, intent) for intent, questions in SEED_EXAMPLES.items() for q in questions]
+        if self.examples_path and os.path.exists(self.examples_path):
+            with open(self.examples_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    item = json.loads(line)
+                    if item.get('intento') in INTENTS and item.get('domanda'):
+                        examples.append((item['domanda'], item['intento']))
+        return examples
+
+    def train(self):
+        examples = self.load_examples()
+        start = time.time()
+        try:
+            vectors = np.asarray(self.embed_many_fn([q for q, _ in examples]), dtype=np.float32)
+        except Exception as e:
+            logger.warning(f"Router non addestrato (embedding non disponibili), uso le parole chiave: {e}")
+            return False
+        if vectors.ndim != 2 or len(vectors) != len(examples):
+            logger.warning(f"Router non addestrato: {len(vectors)} embedding per {len(examples)} esempi.")
+            return False
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.matrix = vectors / np.where(norms == 0, 1.0, norms)
+        self.labels = np.array([INTENTS.index(intent) for _, intent in examples])
+        if not self.fixed_scale:
+            self.scale = self.calibrate_scale()
+        digest = hashlib.md5(repr(examples).encode('utf-8')).hexdigest()[:8]
+        logger.info(f"Router addestrato su {len(examples)} esempi in {time.time() - start:.2f}s "
+                    f"(esempi {digest}, scala {self.scale:g}).")
+        return True
+
+    def calibrate_scale(self):
+        # Ogni esempio classificato dagli altri (leave-one-out): si tiene la scala con la log-verosimiglianza
+        # migliore. Una scala fissa troppo alta da' ~0.99 anche ai vicini sbagliati e il fallback non parte mai.
+        similarities = self.matrix @ self.matrix.T
+        np.fill_diagonal(similarities, -1.0)
+        best = np.stack([similarities[:, self.labels == c].max(axis=1) if (self.labels == c).any()
+                         else np.full(len(self.labels), -1.0) for c in range(len(INTENTS))], axis=1)
+        best -= best.max(axis=1, keepdims=True)
+        rows = np.arange(len(self.labels))
+        losses = []
+        for scale in SCALE_GRID:
+            log_probabilities = best * scale - np.log(np.exp(best * scale).sum(axis=1, keepdims=True))
+            losses.append(-log_probabilities[rows, self.labels].mean())
+        return SCALE_GRID[int(np.argmin(losses))]
+
+    def classify(self, embedding, user_question=None):
+        # (intento, confidenza) in meno di un millisecondo: un prodotto matrice-vettore.
+        # Con la domanda, le parole chiave forti del database fanno da prior sulla classe db.
+        vector = np.asarray(embedding, dtype=np.float32)
+        if vector.shape[-1] != self.matrix.shape[1]:
+            return None, 0.0
+        vector = vector / (np.linalg.norm(vector) or 1.0)
+        similarities = self.matrix @ vector
+        best = np.full(len(INTENTS), -1.0, dtype=np.float32)
+        np.maximum.at(best, self.labels, similarities)
+        scores = np.exp((best - best.max()) * self.scale)
+        if user_question and DB_STRONG_KEYWORDS.search(user_question):
+            scores[INTENTS.index(INTENT_DB)] *= DB_KEYWORD_ODDS
+        probabilities = scores / scores.sum()
+        index = int(probabilities.argmax())
+        return INTENTS[index], float(probabilities[index])
+
+    def uncertain(self, intent, confidence):
+        return intent is None or confidence < self.min_confidence
+
+    def needs_llm(self, intent, confidence, source):
+        # Il modello serve solo quando l'embedding non basta; senza esempi (router non addestrato)
+        # decidono le parole chiave, invece di una chiamata LLM per ogni domanda
+        return intent is None or (source == "embedding" and self.uncertain(intent, confidence))
+
+    def first_pass(self, user_question, embedding):
+        # (intento, confidenza, fonte, ms) dal solo embedding; se needs_llm() serve la risposta del modello
+        start = time.perf_counter()
+        intent, confidence, source = None, 0.0, "parole_chiave"
+        if not self.trained:
+            intent = keyword_intent(user_question)
+        elif embedding is not None:
+            intent, confidence = self.classify(embedding, user_question)
+            source = "embedding"
+        return intent, confidence, source, (time.perf_counter() - start) * 1000
+
+    def finish(self, user_question, intent, confidence, source, llm_answer=None):
+        # Restituisce (intento, confidenza, fonte); fonte = embedding / llm / parole_chiave.
+        # Il log della decisione (log()) lo scrive chi chiama, fuori dall'event loop nell'app asincrona.
+        llm_intent = parse_llm_intent(llm_answer) if llm_answer else None
+        if llm_intent:
+            intent, source = llm_intent, "llm"
+        elif self.uncertain(intent, confidence):
+            intent, source = keyword_intent(user_question), "parole_chiave"
+        return intent, confidence, source
+
+    def log(self, user_question, intent, confidence, source, classify_ms):
+        logger.info(f"Intento '{intent}' (confidenza {confidence:.2f}, fonte {source}, {classify_ms:.2f}ms)")
+        INTENT_DECISIONS.inc(intent, source)
+        if not self.log_path:
+            return
+        # Log delle decisioni: rivisto ed etichettato diventa il file di esempi. Serve solo per
+        # l'analisi: se il disco e' pieno o la cartella non e' scrivibile la domanda va avanti lo stesso.
+        record = {"domanda": user_question, "intento": intent, "confidenza": round(confidence, 3),
+                  "fonte": source, "ts": int(time.time())}
+        with self._log_lock:
+            try:
+                self._rotate_log()
+                with open(self.log_path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            except OSError as e:
+                logger.warning(f"Log delle decisioni non scritto ({self.log_path}): {e}")
+
+    def _rotate_log(self):
+        if not self.log_max_bytes:
+            return
+        try:
+            if os.path.getsize(self.log_path) > self.log_max_bytes:
+                os.replace(self.log_path, self.log_path + ".1")
+        except FileNotFoundError:
+            pass  # Ancora nessun log, o gia' ruotato da un altro processo
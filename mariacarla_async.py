@@ -0,0 +1,532 @@
+# mariacarla_async.py
+# Versione asincrona (ASGI) di MariaCarla.py: stesse route, ma un solo processo tiene
+# molte domande in volo senza un thread per richiesta.
+# Avvio: uvicorn mariacarla_async:app --host 0.0.0.0 --port 5000
+# Su piu' processi: MARIACARLA_APP=async gunicorn -c gunicorn.conf.py
+import os
+import asyncio
+import logging
+import json
+import time
+
+from quart import Quart, request, jsonify, render_template, Response, g
+import aiomysql
+import mysql.connector
+
+from db_pool import DBPool
+from ollama_client import OllamaClientManager, log_ollama_timings
+from ollama_scheduler import (OllamaScheduler, AsyncEmbeddingBatcher, QueueFullError,
+                              PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND)
+from answer_cache import SQLCache
+from result_cache import ResultCache, page_of
+from sql_examples import SQLExampleStore
+from schema_catalog import SchemaCatalog
+from schema_retriever import SchemaRetriever
+from doc_retriever import DocumentRetriever, CachedOllamaEmbeddings, CrossEncoderReranker
+from intent_router import IntentRouter
+from chat_sessions import SessionStore
+import metrics
+from metrics import observe_stage, timed
+from sql_guard import SQLRejected, prepare_sql, check_explain
+from sql_assistant import ResultCollector, column_types, result_window, sql_result_to_csv
+from ask_flow import (AskFlow, SchemaUnavailable, aanswer, arun_steps, sse_event, with_session, BUSY_MESSAGE,
+                      EMBEDDING, COMPLETION, CHAT, CHAT_STREAM, SCHEMA, SQL, DOCUMENTS, CALL)
+
+try:
+    from db_config import DB_CONFIG
+except ImportError:
+    DB_CONFIG = None
+
+# --- Configurazione ---
+OLLAMA_MODEL_NAME = os.environ.get("OLLAMA_MODEL_NAME", "MariaCarla")
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+OLLAMA_EMBED_MODEL = os.environ.get("OLLAMA_EMBED_MODEL", OLLAMA_MODEL_NAME)
+OLLAMA_DOCS_EMBED_MODEL = os.environ.get("OLLAMA_DOCS_EMBED_MODEL", OLLAMA_EMBED_MODEL)
+VECTORSTORE_DOCS_DIR = "vectorstore_docs"
+CHROMA_DOCS_COLLECTION_NAME = "rag_documents_collection"
+RAG_TOP_K = int(os.environ.get("RAG_TOP_K", "3"))
+RAG_CANDIDATES = int(os.environ.get("RAG_CANDIDATES", "20"))
+RAG_RERANK_MODEL = os.environ.get("RAG_RERANK_MODEL", "")
+RAG_BACKEND = os.environ.get("RAG_BACKEND", "chroma")
+RAG_IVF_NPROBE = int(os.environ.get("RAG_IVF_NPROBE", "8"))
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "1024"))
+SCHEMA_CATALOG_TTL = int(os.environ.get("SCHEMA_CATALOG_TTL", "300"))
+SCHEMA_INDEX_DIR = "vectorstore_schema"
+SCHEMA_TOP_K = int(os.environ.get("SCHEMA_TOP_K", "8"))
+SCHEMA_TOKEN_BUDGET = int(os.environ.get("SCHEMA_TOKEN_BUDGET", "2000"))
+SQL_CACHE_MAX_ENTRIES = int(os.environ.get("SQL_CACHE_MAX_ENTRIES", "500"))
+SQL_CACHE_TTL = int(os.environ.get("SQL_CACHE_TTL", "3600"))
+SQL_CACHE_SIMILARITY = float(os.environ.get("SQL_CACHE_SIMILARITY", "0.95"))
+SQL_EXAMPLES_FILE = os.environ.get("SQL_EXAMPLES_FILE", "sql_examples.sqlite3")
+SQL_EXAMPLES_MAX = int(os.environ.get("SQL_EXAMPLES_MAX", "2000"))
+SQL_FEW_SHOT = int(os.environ.get("SQL_FEW_SHOT", "3"))
+SQL_FEW_SHOT_SIMILARITY = float(os.environ.get("SQL_FEW_SHOT_SIMILARITY", "0.6"))
+INTENT_MIN_CONFIDENCE = float(os.environ.get("INTENT_MIN_CONFIDENCE", "0.6"))
+INTENT_EXAMPLES_FILE = os.environ.get("INTENT_EXAMPLES_FILE", "intent_examples.jsonl")
+INTENT_LOG_FILE = os.environ.get("INTENT_LOG_FILE", "intent_log.jsonl")
+INTENT_LOG_MAX_MB = float(os.environ.get("INTENT_LOG_MAX_MB", "10"))
+SESSION_DIR = os.environ.get("SESSION_DIR", "sessions")
+SESSION_TTL = int(os.environ.get("SESSION_TTL", "7200"))
+SESSION_TOKEN_BUDGET = int(os.environ.get("SESSION_TOKEN_BUDGET", "1500"))
+SESSION_KEEP_TURNS = int(os.environ.get("SESSION_KEEP_TURNS", "4"))
+SESSION_PURGE_EVERY = int(os.environ.get("SESSION_PURGE_EVERY", "100"))
+SQL_PAGE_SIZE = int(os.environ.get("SQL_PAGE_SIZE", "100"))
+SQL_MAX_ROWS = int(os.environ.get("SQL_MAX_ROWS", "1000"))
+SQL_FETCH_BATCH = int(os.environ.get("SQL_FETCH_BATCH", "200"))
+SQL_MAX_EXECUTION_MS = int(os.environ.get("SQL_MAX_EXECUTION_MS", "10000"))
+SQL_EXPLAIN_MAX_ROWS = int(os.environ.get("SQL_EXPLAIN_MAX_ROWS", "5000000"))
+SQL_FULL_SCAN_MAX_ROWS = int(os.environ.get("SQL_FULL_SCAN_MAX_ROWS", "1000000"))
+RESULT_CACHE_MB = float(os.environ.get("RESULT_CACHE_MB", "64"))
+RESULT_CACHE_TTL = int(os.environ.get("RESULT_CACHE_TTL", "300"))
+RESULT_CACHE_CHECK_SECONDS = float(os.environ.get("RESULT_CACHE_CHECK_SECONDS", "2"))
+RESULT_CACHE_DIR = os.environ.get("RESULT_CACHE_DIR", "")
+RESULT_CACHE_DISK_MB = float(os.environ.get("RESULT_CACHE_DISK_MB", "256"))
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", "1"))
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4"))
+OLLAMA_MAX_CONCURRENCY = int(os.environ.get("OLLAMA_MAX_CONCURRENCY", str(max(1, -(-OLLAMA_NUM_PARALLEL // WEB_CONCURRENCY)))))
+OLLAMA_MAX_QUEUE = int(os.environ.get("OLLAMA_MAX_QUEUE", "32"))
+OLLAMA_MAX_BACKGROUND = int(os.environ.get("OLLAMA_MAX_BACKGROUND", "0"))
+EMBED_BATCH_WINDOW_MS = float(os.environ.get("EMBED_BATCH_WINDOW_MS", "5"))
+EMBED_BATCH_MAX = int(os.environ.get("EMBED_BATCH_MAX", "32"))
+OLLAMA_DEFAULT_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_KEEP_ALIVE = {
+    OLLAMA_MODEL_NAME: OLLAMA_DEFAULT_KEEP_ALIVE,
+}
+OLLAMA_KEEP_WARM_INTERVAL = int(os.environ.get("OLLAMA_KEEP_WARM_INTERVAL", "240"))
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("mariacarla_async")
+
+app = Quart(__name__)
+ollama_manager = OllamaClientManager(OLLAMA_HOST, keep_alive=OLLAMA_KEEP_ALIVE, default_keep_alive=OLLAMA_DEFAULT_KEEP_ALIVE,
+                                     max_connections=OLLAMA_MAX_CONCURRENCY * 2, embedding_cache_size=EMBEDDING_CACHE_SIZE)
+document_retriever = DocumentRetriever(VECTORSTORE_DOCS_DIR, CHROMA_DOCS_COLLECTION_NAME,
+                                       CachedOllamaEmbeddings(ollama_manager, OLLAMA_DOCS_EMBED_MODEL), k=RAG_TOP_K,
+                                       candidates=RAG_CANDIDATES,
+                                       reranker=CrossEncoderReranker(RAG_RERANK_MODEL) if RAG_RERANK_MODEL else None,
+                                       backend=RAG_BACKEND, nprobe=RAG_IVF_NPROBE)
+db_pool = None
+# Tempi di avvio e processo che ha fatto preload() / startup(), riportati in /stats
+startup_info = {"preload_pid": None, "preload_s": None, "worker_pid": None, "worker_init_s": None, "started": None}
+
+
+# Tetto allineato a OLLAMA_NUM_PARALLEL del server (diviso tra i worker): oltre, Ollama accoderebbe
+# per conto suo senza priorita'. I ping di keep-warm e l'addestramento del router passano in background.
+ollama_scheduler = OllamaScheduler(OLLAMA_MAX_CONCURRENCY, OLLAMA_MAX_QUEUE, OLLAMA_MAX_BACKGROUND or None)
+ollama_manager.scheduler = ollama_scheduler
+
+
+def get_sync_db_connection():
+    # Catalogo schema e UPDATE_TIME della cache risultati, letti di rado e in un thread a parte:
+    # bastano connessioni sincrone
+    if not DB_CONFIG:
+        raise ConnectionError("Connessione DB non disponibile.")
+    global catalog_db_pool
+    if catalog_db_pool is None:
+        catalog_db_pool = DBPool({**DB_CONFIG, 'pool_name': 'mariacarla_catalog', 'pool_size': 1, 'pool_max_overflow': 1})
+    return catalog_db_pool.connection()
+
+def embed_many_background(model, texts):
+    # Dal thread di avvio: gli esempi del router non devono rubare slot alle domande
+    with ollama_scheduler.slot(PRIORITY_BACKGROUND):
+        return ollama_manager.embed(model, texts)['embeddings']
+
+catalog_db_pool = None
+schema_catalog = SchemaCatalog(get_sync_db_connection, ttl_seconds=SCHEMA_CATALOG_TTL)
+result_cache = ResultCache(get_sync_db_connection, max_bytes=int(RESULT_CACHE_MB * 1024 * 1024), ttl_seconds=RESULT_CACHE_TTL,
+                           check_seconds=RESULT_CACHE_CHECK_SECONDS, spill_dir=RESULT_CACHE_DIR or None,
+                           max_disk_bytes=int(RESULT_CACHE_DISK_MB * 1024 * 1024)) if RESULT_CACHE_MB > 0 else None
+schema_retriever = SchemaRetriever(schema_catalog, SCHEMA_INDEX_DIR, top_k=SCHEMA_TOP_K, token_budget=SCHEMA_TOKEN_BUDGET)
+intent_router = IntentRouter(lambda texts: embed_many_background(OLLAMA_EMBED_MODEL, texts),
+                             examples_path=INTENT_EXAMPLES_FILE, log_path=INTENT_LOG_FILE or None,
+                             min_confidence=INTENT_MIN_CONFIDENCE, log_max_bytes=int(INTENT_LOG_MAX_MB * 1024 * 1024))
+sql_cache = SQLCache(None, max_entries=SQL_CACHE_MAX_ENTRIES,
+                     ttl_seconds=SQL_CACHE_TTL, similarity_threshold=SQL_CACHE_SIMILARITY)
+sql_examples = SQLExampleStore(SQL_EXAMPLES_FILE, max_examples=SQL_EXAMPLES_MAX,
+                              min_similarity=SQL_FEW_SHOT_SIMILARITY) if SQL_EXAMPLES_FILE else None
+session_store = SessionStore(SESSION_DIR or None, ttl_seconds=SESSION_TTL, purge_every=SESSION_PURGE_EVERY)
+
+
+async def refresh_schema_catalog_loop():
+    # Aggiorna catalogo e indice in un thread prima che scada il TTL,
+    # cosi' le richieste li trovano sempre freschi e non fanno I/O sincrono sull'event loop
+    while True:
+        try:
+            await asyncio.to_thread(schema_retriever.ensure_index)
+        except (ConnectionError, mysql.connector.Error) as err:
+            logger.error(f"Aggiornamento catalogo schema fallito: {err}")
+        await asyncio.sleep(max(SCHEMA_CATALOG_TTL / 2, 1))
+
+
+def close_catalog_pool():
+    global catalog_db_pool
+    if catalog_db_pool:
+        catalog_db_pool.close()
+        catalog_db_pool = None
+
+
+def preload():
+    # Stato in sola lettura condiviso dai worker: con gunicorn.conf.py gira una volta nel master prima
+    # del fork (e di nuovo a ogni kill -HUP). Le connessioni MySQL aperte qui vengono chiuse.
+    start = time.perf_counter()
+    logger.info(f"Avvio App asincrona con modello Ollama: {OLLAMA_MODEL_NAME} su {OLLAMA_HOST}")
+    document_retriever.load(chroma=False)
+    try:
+        schema_retriever.ensure_index()
+    except (ConnectionError, mysql.connector.Error) as err:
+        logger.error(f"Catalogo schema non precaricato: {err}")
+    close_catalog_pool()
+    ollama_manager.warm_up([OLLAMA_MODEL_NAME], [OLLAMA_EMBED_MODEL, OLLAMA_DOCS_EMBED_MODEL])
+    intent_router.train()
+    startup_info["preload_pid"] = os.getpid()
+    startup_info["preload_s"] = round(time.perf_counter() - start, 2)
+    logger.info(f"Precaricamento completato in {startup_info['preload_s']}s, memoria {metrics.process_memory()}.")
+
+
+def process_info():
+    info = {"pid": os.getpid(), "workers": WEB_CONCURRENCY, "preload_s": startup_info["preload_s"],
+            "worker_init_s": startup_info["worker_init_s"]}
+    if startup_info["started"]:
+        info["uptime_s"] = round(time.time() - startup_info["started"])
+    return {**info, **metrics.process_memory()}
+
+
+@app.before_serving
+async def startup():
+    # In ogni worker. Dopo un fork si riaprono le connessioni verso MySQL e Ollama; senza preload()
+    # nel master (uvicorn da solo) lo si fa qui. Le API sincrone vanno in un thread.
+    global db_pool, catalog_db_pool
+    start = time.perf_counter()
+    if startup_info["preload_pid"] is None:
+        await asyncio.to_thread(preload)
+    elif startup_info["preload_pid"] != os.getpid():
+        catalog_db_pool = None
+        ollama_manager.after_fork()
+    if not document_retriever.ready:
+        await asyncio.to_thread(document_retriever.load)
+    ollama_manager.start_keep_warm([OLLAMA_MODEL_NAME], [OLLAMA_EMBED_MODEL, OLLAMA_DOCS_EMBED_MODEL],
+                                   interval=OLLAMA_KEEP_WARM_INTERVAL)
+    if DB_CONFIG:
+        try:
+            pool_size = int(DB_CONFIG.get('pool_size', 5)) + int(DB_CONFIG.get('pool_max_overflow', 2))
+            db_pool = await aiomysql.create_pool(
+                host=DB_CONFIG['host'], port=int(DB_CONFIG.get('port', 3306)),
+                user=DB_CONFIG['user'], password=DB_CONFIG['password'], db=DB_CONFIG['database'],
+                minsize=1, maxsize=pool_size, autocommit=True, pool_recycle=3600
+            )
+            logger.info(f"Pool aiomysql OK (max {pool_size} connessioni).")
+        except Exception as e:
+            logger.error(f"Errore connessione MySQL (aiomysql): {e}")
+            db_pool = None
+    else:
+        logger.error("db_config.py non trovato o DB_CONFIG non definito.")
+    app.add_background_task(refresh_schema_catalog_loop)
+    startup_info["worker_pid"] = os.getpid()
+    startup_info["worker_init_s"] = round(time.perf_counter() - start, 2)
+    startup_info["started"] = time.time()
+    logger.info(f"Worker {os.getpid()} pronto in {startup_info['worker_init_s']}s, memoria {metrics.process_memory()}.")
+
+
+@app.after_serving
+async def shutdown():
+    ollama_manager.stop()
+    if db_pool:
+        db_pool.close()
+        await db_pool.wait_closed()
+
+
+@observe_stage("llm")
+async def get_ollama_completion(prompt_text, system_message=None, temperature=0.3):
+    messages = []
+    if system_message:
+        messages.append({'role': 'system', 'content': system_message})
+    messages.append({'role': 'user', 'content': prompt_text})
+    try:
+        response = await ollama_manager.async_client.chat(
+            model=OLLAMA_MODEL_NAME, messages=messages, options={'temperature': temperature},
+            keep_alive=ollama_manager.keep_alive_for(OLLAMA_MODEL_NAME))
+        log_ollama_timings(OLLAMA_MODEL_NAME, response)
+        return response['message']['content']
+    except Exception as e:
+        logger.error(f"Errore Ollama ({OLLAMA_MODEL_NAME}): {e}", exc_info=True)
+        raise
+
+
+@observe_stage("llm")
+async def get_ollama_chat(messages, temperature=0.3):
+    # Risposta completa di Ollama (testo, token e tempi), per i turni di cui si misura il prefill
+    try:
+        response = await ollama_manager.async_client.chat(
+            model=OLLAMA_MODEL_NAME, messages=messages, options={'temperature': temperature},
+            keep_alive=ollama_manager.keep_alive_for(OLLAMA_MODEL_NAME))
+        log_ollama_timings(OLLAMA_MODEL_NAME, response)
+        return response
+    except Exception as e:
+        logger.error(f"Errore Ollama ({OLLAMA_MODEL_NAME}): {e}", exc_info=True)
+        raise
+
+
+async def get_ollama_chat_stream(messages, done, temperature=0.3):
+    # L'ultimo chunk (token e tempi) finisce in done['response']
+    try:
+        async for chunk in await ollama_manager.async_client.chat(
+                model=OLLAMA_MODEL_NAME, messages=messages, options={'temperature': temperature},
+                keep_alive=ollama_manager.keep_alive_for(OLLAMA_MODEL_NAME), stream=True):
+            if chunk.get('done'):
+                log_ollama_timings(OLLAMA_MODEL_NAME, chunk)
+                done['response'] = chunk
+            content = chunk['message']['content']
+            if content:
+                yield content
+    except Exception as e:
+        logger.error(f"Errore Ollama stream ({OLLAMA_MODEL_NAME}): {e}", exc_info=True)
+        raise
+
+
+async def embed_many(model, texts):
+    async with ollama_scheduler.aslot(PRIORITY_INTERACTIVE):
+        response = await ollama_manager.async_client.embed(
+            model=model, input=texts, keep_alive=ollama_manager.keep_alive_for(model))
+    return response['embeddings']
+
+
+# Domande arrivate insieme: un solo /api/embed per tutte (EMBED_BATCH_WINDOW_MS = 0 disattiva)
+embedding_batcher = AsyncEmbeddingBatcher(embed_many, max_batch=EMBED_BATCH_MAX,
+                                          window=EMBED_BATCH_WINDOW_MS / 1000) if EMBED_BATCH_WINDOW_MS > 0 else None
+
+
+async def get_ollama_embedding(text, model=OLLAMA_EMBED_MODEL):
+    vector = ollama_manager.cached_query_embedding(model, text)
+    if vector is not None:
+        return vector
+    try:
+        if embedding_batcher is not None:
+            vector = await embedding_batcher.embed(model, text)
+        else:
+            vector = (await embed_many(model, [text]))[0]
+    except QueueFullError:
+        raise
+    except Exception as e:
+        logger.warning(f"Embedding domanda non disponibile ({model}): {e}")
+        return None
+    ollama_manager.cache_query_embedding(model, text, vector)
+    return vector
+
+
+async def retrieve_documents(user_question):
+    embed_start = time.time()
+    query_embedding = await get_ollama_embedding(user_question, OLLAMA_DOCS_EMBED_MODEL)
+    if query_embedding is None:
+        return []
+    # La ricerca Chroma e' sincrona ma locale e breve: thread a parte per non fermare l'event loop
+    return await asyncio.to_thread(document_retriever.search_by_vector, query_embedding,
+                                   embed_time=time.time() - embed_start, question=user_question)
+
+
+@observe_stage("esecuzione_sql")
+async def execute_sql_query(sql_query, offset=0, page_size=SQL_PAGE_SIZE):
+    logger.info(f"Esecuzione SQL: {sql_query}")
+    try:
+        sql_query = prepare_sql(sql_query, SQL_MAX_ROWS, SQL_MAX_EXECUTION_MS)
+    except SQLRejected as err:
+        logger.warning(f"Query bloccata: {err} ({sql_query})")
+        return {"error": str(err)}
+    if not db_pool:
+        return {"error": "Connessione DB non disponibile."}
+    ticket = None
+    if result_cache:
+        with timed("cache_risultati"):
+            cached, ticket = await asyncio.to_thread(result_cache.lookup, sql_query)
+        if cached is not None:
+            logger.info(f"Risultato da cache ({cached['rowcount']} righe).")
+            return page_of(cached, offset, page_size)
+    try:
+        collector = ResultCollector(0, SQL_MAX_ROWS, SQL_MAX_ROWS) if ticket else ResultCollector(offset, page_size, SQL_MAX_ROWS)
+        columns = []
+        async with db_pool.acquire() as conn:
+            if SQL_EXPLAIN_MAX_ROWS or SQL_FULL_SCAN_MAX_ROWS:
+                async with conn.cursor() as cursor:
+                    await cursor.execute(f"EXPLAIN {sql_query}")
+                    rejection = check_explain([desc[0] for desc in cursor.description], await cursor.fetchall(),
+                                              SQL_EXPLAIN_MAX_ROWS, SQL_FULL_SCAN_MAX_ROWS, sql_query)
+                if rejection:
+                    logger.warning(f"Query bloccata da EXPLAIN: {rejection} ({sql_query})")
+                    return {"error": rejection}
+            # SSCursor non bufferizza: le righe arrivano dal server a blocchi di fetchmany,
+            # quelle oltre SQL_MAX_ROWS vengono scartate alla chiusura del cursore
+            async with conn.cursor(aiomysql.SSCursor) as cursor:
+                await cursor.execute(sql_query)
+                if cursor.description:
+                    columns = column_types(cursor.description)
+                    while True:
+                        batch = await cursor.fetchmany(SQL_FETCH_BATCH)
+                        if not batch or not collector.add(batch):
+                            break
+        logger.info(f"Query OK, {collector.seen} righe lette{' (troncato)' if collector.truncated else ''}.")
+        if ticket:
+            result = collector.result(columns)
+            await asyncio.to_thread(result_cache.store, ticket, result)
+            return page_of(result, offset, page_size)
+        return collector.result(columns)
+    except aiomysql.Error as err:
+        logger.error(f"Errore MySQL query '{sql_query}': {err}")
+        return {"error": f"Errore MySQL: {err}"}
+    except Exception as e:
+        logger.error(f"Errore imprevisto query '{sql_query}': {e}")
+        return {"error": f"Errore imprevisto: {e}"}
+
+
+@observe_stage("schema")
+def get_db_schema_string(question, session=None):
+    # Catalogo e indice sono tenuti aggiornati da refresh_schema_catalog_loop
+    if schema_catalog.schema_string is None:
+        raise SchemaUnavailable("Errore: Impossibile connettersi al database.")
+    if not schema_catalog.schema_string:
+        return "Database vuoto o tabelle non trovate."
+    if session is not None:
+        # In una conversazione lo schema resta quello dei turni prima, piu' le eventuali tabelle nuove
+        pinned = session.schema_tables if session.schema_version == schema_catalog.version else ()
+        schema_string, tables = schema_retriever.get_session_schema(question, pinned)
+        if schema_string:
+            session.schema, session.schema_tables, session.schema_version = schema_string, tables, schema_catalog.version
+    else:
+        schema_string = schema_retriever.get_schema_string(question)
+    return schema_string or "Database vuoto o tabelle non trovate."
+
+
+async def completion_in_slot(prompt_text, system_message):
+    async with ollama_scheduler.aslot():
+        return await get_ollama_completion(prompt_text, system_message=system_message)
+
+
+async def chat_in_slot(messages):
+    async with ollama_scheduler.aslot():
+        return await get_ollama_chat(messages)
+
+
+async def chat_stream_in_slot(messages, done):
+    # Prima la posizione in coda (se si e' atteso), poi i pezzi di testo; lo slot resta occupato fino all'ultimo
+    async with ollama_scheduler.aslot() as position:
+        if position:
+            yield ("coda", {"posizione": position})
+        async for chunk in get_ollama_chat_stream(messages, done):
+            yield chunk
+
+
+ask_flow = AskFlow(intent_router, sql_cache, sql_examples, schema_catalog, document_retriever, session_store,
+                   page_size=SQL_PAGE_SIZE, few_shot=SQL_FEW_SHOT, session_token_budget=SESSION_TOKEN_BUDGET,
+                   session_keep_turns=SESSION_KEEP_TURNS)
+# Come si esegue ogni passo di ask_flow in questa app: coroutine, e I/O locale sincrono in un thread
+ask_handlers = {
+    EMBEDDING: get_ollama_embedding,
+    COMPLETION: completion_in_slot,
+    CHAT: chat_in_slot,
+    CHAT_STREAM: chat_stream_in_slot,
+    SCHEMA: get_db_schema_string,
+    SQL: execute_sql_query,
+    DOCUMENTS: retrieve_documents,
+    CALL: asyncio.to_thread,
+}
+
+
+def queue_full_response(err):
+    response = jsonify({"risposta": BUSY_MESSAGE, "posizione_coda": err.waiting + 1})
+    return response, 429, {"Retry-After": "5"}
+
+
+@app.route('/')
+async def index():
+    return await render_template('index.html')
+
+
+@app.route('/ask', methods=['POST'])
+async def ask_assistant():
+    data = await request.get_json()
+    user_question = data.get('domanda')
+    if not user_question:
+        return jsonify({"risposta": "Domanda mancante."}), 400
+    logger.info(f"Ricevuta domanda: {user_question}")
+    offset, page_size, as_csv = result_window(data, SQL_PAGE_SIZE, SQL_MAX_ROWS)
+    session = ask_flow.get_session(data)
+    try:
+        ollama_scheduler.check()
+        payload, query_results = await aanswer(ask_flow.steps(user_question, session, offset, page_size), ask_handlers)
+    except QueueFullError as err:
+        logger.warning(str(err))
+        return queue_full_response(err)
+    if as_csv and query_results is not None:
+        return Response(sql_result_to_csv(query_results), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=risultato.csv'})
+    return jsonify(payload)
+
+
+@app.route('/ask/stream', methods=['POST'])
+async def ask_assistant_stream():
+    data = await request.get_json()
+    user_question = data.get('domanda')
+    if not user_question:
+        return jsonify({"risposta": "Domanda mancante."}), 400
+    logger.info(f"Ricevuta domanda (stream): {user_question}")
+    session = ask_flow.get_session(data)
+    try:
+        ollama_scheduler.check()
+    except QueueFullError as err:
+        logger.warning(str(err))
+        return queue_full_response(err)
+
+    async def generate():
+        done = {}
+        try:
+            async for event, payload in arun_steps(ask_flow.steps(user_question, session, stream=True), ask_handlers, done):
+                yield sse_event(event, payload)
+        except QueueFullError as err:
+            logger.warning(str(err))
+            done['payload'] = with_session({"risposta": BUSY_MESSAGE}, session)
+        yield sse_event("done", done['payload'])
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/sessione/<session_id>', methods=['DELETE'])
+async def delete_session(session_id):
+    session_store.delete(session_id)
+    return jsonify({"ok": True})
+
+
+@app.before_request
+async def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+async def observe_request(response):
+    start = getattr(g, 'request_start', None)
+    if start is not None:
+        route = request.url_rule.rule if request.url_rule else "altro"
+        metrics.REQUEST_SECONDS.observe(route, str(response.status_code), value=time.perf_counter() - start)
+    return response
+
+
+@app.route('/metrics')
+async def metrics_endpoint():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/stats')
+async def stats():
+    return jsonify({
+        "processo": process_info(),
+        "ollama": ollama_scheduler.stats(),
+        "db_pool": {"size": db_pool.size, "free": db_pool.freesize, "max": db_pool.maxsize} if db_pool else None,
+        "sql_cache": sql_cache.stats(),
+        "result_cache": result_cache.stats() if result_cache else None,
+        "esempi_sql": sql_examples.stats() if sql_examples else None,
+        "embedding_cache": ollama_manager.embedding_cache_stats(),
+        "documenti": document_retriever.stats(),
+        "sessioni": session_store.stats(),
+    })
+
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5000)
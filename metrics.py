@@ -0,0 +1,195 @@
+# metrics.py
+# Metriche in memoria (contatori e istogrammi) esposte in formato testo Prometheus su /metrics,
+# senza dipendenze e senza collector esterni.
+import functools
+import inspect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+_registry = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    return "{" + ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(self.labels, label_values)} {value}")
+        return lines
+
+
+class Gauge:
+    # Valore istantaneo (profondita' della coda, chiamate in corso...)
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def set(self, *label_values, value):
+        with self._lock:
+            self._values[label_values] = value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_text(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # valori delle label -> [conteggi per bucket..., somma, conteggio]
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def observe(self, *label_values, value):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    labels = _label_text(self.labels + ("le",), label_values + (bound,))
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _label_text(self.labels + ("le",), label_values + ("+Inf",))
+                lines.append(f"{self.name}_bucket{labels} {series[-1]}")
+                labels = _label_text(self.labels, label_values)
+                lines.append(f"{self.name}_sum{labels} {series[-2]}")
+                lines.append(f"{self.name}_count{labels} {series[-1]}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("mariacarla_stage_seconds", "Durata delle fasi di una domanda", ["stage"])
+REQUEST_SECONDS = Histogram("mariacarla_request_seconds", "Durata delle richieste HTTP", ["route", "status"])
+OLLAMA_SECONDS = Histogram("mariacarla_ollama_seconds", "Tempi riportati da Ollama per fase", ["model", "phase"])
+OLLAMA_PROMPT_TOKENS = Histogram("mariacarla_ollama_prompt_tokens", "Token del prompt per chiamata", ["model"],
+                                 buckets=TOKEN_BUCKETS)
+OLLAMA_TOKENS = Counter("mariacarla_ollama_tokens_total", "Token elaborati da Ollama", ["model", "kind"])
+STAGE_ERRORS = Counter("mariacarla_stage_errors_total", "Eccezioni per fase", ["stage"])
+INTENT_DECISIONS = Counter("mariacarla_intent_total", "Decisioni del router per intento e fonte", ["intent", "source"])
+OLLAMA_QUEUE_DEPTH = Gauge("mariacarla_ollama_queue_depth", "Chiamate a Ollama in attesa per priorita'", ["priority"])
+OLLAMA_ACTIVE = Gauge("mariacarla_ollama_active", "Chiamate a Ollama in corso per priorita'", ["priority"])
+OLLAMA_QUEUE_WAIT_SECONDS = Histogram("mariacarla_ollama_queue_wait_seconds", "Attesa in coda prima della chiamata a Ollama",
+                                      ["priority"])
+OLLAMA_REJECTED = Counter("mariacarla_ollama_rejected_total", "Chiamate rifiutate con la coda piena", ["priority"])
+EMBEDDING_BATCH_SIZE = Histogram("mariacarla_embedding_batch_size", "Testi per chiamata di embedding raggruppata", [],
+                                 buckets=(1, 2, 4, 8, 16, 32, 64))
+SESSION_PREFILL_SECONDS = Histogram("mariacarla_session_prefill_seconds", "Prefill per turno di conversazione", ["prefix"])
+
+
+@contextmanager
+def timed(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.inc(stage)
+        raise
+    finally:
+        STAGE_SECONDS.observe(stage, value=time.perf_counter() - start)
+
+
+def observe_stage(stage):
+    # Decoratore per funzioni sincrone e coroutine (i generatori vanno misurati con timed())
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with timed(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_ollama_response(model, response, ns=1e9):
+    # Campi finali di una risposta Ollama (anche l'ultimo chunk di uno stream)
+    for phase, field in (("load", 'load_duration'), ("prompt_eval", 'prompt_eval_duration'),
+                         ("eval", 'eval_duration'), ("total", 'total_duration')):
+        if response.get(field):
+            OLLAMA_SECONDS.observe(model, phase, value=response[field] / ns)
+    prompt_tokens = response.get('prompt_eval_count') or 0
+    if prompt_tokens:
+        OLLAMA_PROMPT_TOKENS.observe(model, value=prompt_tokens)
+        OLLAMA_TOKENS.inc(model, "prompt", amount=prompt_tokens)
+    if response.get('eval_count'):
+        OLLAMA_TOKENS.inc(model, "eval", amount=response['eval_count'])
+
+
+def process_memory(pid=None):
+    # Memoria di un processo (di default questo) in MB (Linux): rss, pss (le pagine condivise divise tra i processi che le
+    # usano: la somma dei pss dei worker e' la memoria reale) e condivisa. {} dove /proc manca.
+    fields = {"Rss": "rss_mb", "Pss": "pss_mb", "Shared_Clean": "shared_mb", "Shared_Dirty": "shared_mb"}
+    memory = {}
+    try:
+        with open(f"/proc/{pid or os.getpid()}/smaps_rollup", encoding='ascii') as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in fields:
+                    key = fields[name]
+                    memory[key] = memory.get(key, 0.0) + int(value.split()[0]) / 1024
+    except (OSError, ValueError):
+        return {}
+    return {key: round(value, 1) for key, value in memory.items()}
+
+
+def render():
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,198 @@
+# ollama_client.py
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import httpx
+import ollama
+
+from metrics import record_ollama_response
+from ollama_scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+
+logger = logging.getLogger("ollama_client")
+
+NS = 1e9  # Ollama restituisce le durate in nanosecondi
+
+
+def log_ollama_timings(model, response):
+    # Separa il tempo di caricamento del modello (cold start) da prefill e generazione
+    record_ollama_response(model, response, NS)
+    load = (response.get('load_duration') or 0) / NS
+    prompt_eval = (response.get('prompt_eval_duration') or 0) / NS
+    eval_time = (response.get('eval_duration') or 0) / NS
+    total = (response.get('total_duration') or 0) / NS
+    eval_count = response.get('eval_count') or 0
+    tokens_per_s = eval_count / eval_time if eval_time else 0.0
+    logger.info(f"Ollama {model}: caricamento {load:.2f}s, prompt {response.get('prompt_eval_count') or 0} token "
+                f"in {prompt_eval:.2f}s, generazione {eval_count} token in {eval_time:.2f}s "
+                f"({tokens_per_s:.1f} tok/s), totale {total:.2f}s")
+    if load > 1.0:
+        logger.warning(f"Modello {model} caricato a freddo ({load:.2f}s): valutare un keep_alive piu' lungo.")
+
+
+class OllamaClientManager:
+    # Un solo client Ollama per processo (connessioni HTTP keep-alive riusate),
+    # keep_alive configurabile per modello, warm-up all'avvio e ping periodico
+    # per evitare che Ollama scarichi il modello dopo l'inattivita'.
+    def __init__(self, host, keep_alive=None, default_keep_alive="30m", max_connections=16, embedding_cache_size=1024):
+        self.host = host
+        self.keep_alive = dict(keep_alive or {})
+        self.default_keep_alive = default_keep_alive
+        self.max_connections = max_connections
+        self._client = None
+        self._async_client = None
+        self._lock = threading.Lock()
+        self._keep_warm_thread = None
+        self._stop = threading.Event()
+        # LRU degli embedding delle domande: la stessa domanda serve a cache SQL, router e RAG
+        self.embedding_cache_size = embedding_cache_size
+        self._embedding_cache = OrderedDict()
+        self._embedding_cache_lock = threading.Lock()
+        self.embedding_cache_hits = 0
+        self.embedding_cache_misses = 0
+        # Impostati dall'app: coda verso Ollama (i ping di keep-warm passano in background) e
+        # raggruppamento degli embedding delle domande
+        self.scheduler = None
+        self.embedding_batcher = None
+
+    def _limits(self):
+        return httpx.Limits(max_connections=self.max_connections,
+                            max_keepalive_connections=self.max_connections,
+                            keepalive_expiry=300)
+
+    @property
+    def client(self):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = ollama.Client(host=self.host, limits=self._limits())
+        return self._client
+
+    @property
+    def async_client(self):
+        # Da usare sempre dallo stesso event loop (quello dell'app asincrona)
+        if self._async_client is None:
+            self._async_client = ollama.AsyncClient(host=self.host, limits=self._limits())
+        return self._async_client
+
+    def keep_alive_for(self, model):
+        return self.keep_alive.get(model, self.default_keep_alive)
+
+    def chat(self, model, messages, **kwargs):
+        response = self.client.chat(model=model, messages=messages, keep_alive=self.keep_alive_for(model), **kwargs)
+        log_ollama_timings(model, response)
+        return response
+
+    def chat_stream(self, model, messages, **kwargs):
+        for chunk in self.client.chat(model=model, messages=messages, keep_alive=self.keep_alive_for(model),
+                                      stream=True, **kwargs):
+            if chunk.get('done'):
+                log_ollama_timings(model, chunk)
+            yield chunk
+
+    def embed(self, model, input):
+        return self.client.embed(model=model, input=input, keep_alive=self.keep_alive_for(model))
+
+    def embed_query(self, model, text):
+        key = (model, text)
+        with self._embedding_cache_lock:
+            vector = self._embedding_cache.get(key)
+            if vector is not None:
+                self._embedding_cache.move_to_end(key)
+                self.embedding_cache_hits += 1
+                return vector
+            self.embedding_cache_misses += 1
+        if self.embedding_batcher is not None:
+            vector = self.embedding_batcher.embed(model, text)
+        elif self.scheduler is not None:
+            # Senza raggruppamento la domanda passa comunque dalla coda (priorita', tetto, 429)
+            with self.scheduler.slot(PRIORITY_INTERACTIVE):
+                vector = self.embed(model, text)['embeddings'][0]
+        else:
+            vector = self.embed(model, text)['embeddings'][0]
+        self.cache_query_embedding(model, text, vector)
+        return vector
+
+    def cached_query_embedding(self, model, text):
+        # Solo lettura della cache (per chi calcola l'embedding da se', es. con il client asincrono)
+        with self._embedding_cache_lock:
+            vector = self._embedding_cache.get((model, text))
+            if vector is not None:
+                self._embedding_cache.move_to_end((model, text))
+                self.embedding_cache_hits += 1
+            else:
+                self.embedding_cache_misses += 1
+            return vector
+
+    def cache_query_embedding(self, model, text, vector):
+        with self._embedding_cache_lock:
+            self._embedding_cache[(model, text)] = vector
+            self._embedding_cache.move_to_end((model, text))
+            while len(self._embedding_cache) > self.embedding_cache_size:
+                self._embedding_cache.popitem(last=False)
+
+    def embedding_cache_stats(self):
+        with self._embedding_cache_lock:
+            return {"entries": len(self._embedding_cache), "hits": self.embedding_cache_hits,
+                    "misses": self.embedding_cache_misses}
+
+    def _ping(self, model, embedding=False):
+        # Una richiesta senza prompt carica il modello (o ne rinnova il keep_alive) senza generare
+        if embedding:
+            self.client.embed(model=model, input="ping", keep_alive=self.keep_alive_for(model))
+        else:
+            self.client.generate(model=model, prompt="", keep_alive=self.keep_alive_for(model))
+
+    def warm_up(self, chat_models, embed_models=()):
+        for model in chat_models:
+            self._warm(model, embedding=False)
+        for model in embed_models:
+            if model not in chat_models:
+                self._warm(model, embedding=True)
+
+    def _warm(self, model, embedding):
+        start = time.time()
+        try:
+            self._ping(model, embedding=embedding)
+            logger.info(f"Modello {model} pronto in {time.time() - start:.2f}s (keep_alive {self.keep_alive_for(model)}).")
+        except Exception as e:
+            logger.warning(f"Warm-up del modello {model} fallito: {e}")
+
+    def start_keep_warm(self, chat_models, embed_models=(), interval=240):
+        if self._keep_warm_thread or interval <= 0:
+            return
+
+        def loop():
+            while not self._stop.wait(interval):
+                for model in chat_models:
+                    self._quiet_ping(model, False)
+                for model in embed_models:
+                    if model not in chat_models:
+                        self._quiet_ping(model, True)
+
+        self._keep_warm_thread = threading.Thread(target=loop, name="ollama-keep-warm", daemon=True)
+        self._keep_warm_thread.start()
+
+    def _quiet_ping(self, model, embedding):
+        try:
+            if self.scheduler is not None:
+                with self.scheduler.slot(PRIORITY_BACKGROUND):
+                    self._ping(model, embedding=embedding)
+            else:
+                self._ping(model, embedding=embedding)
+        except Exception as e:
+            logger.warning(f"Keep-warm del modello {model} fallito: {e}")
+
+    def stop(self):
+        self._stop.set()
+
+    def after_fork(self):
+        # Nel worker appena creato: client HTTP, lock e keep-warm del processo padre non valgono.
+        # La cache degli embedding resta (copiata dal padre).
+        self._client = None
+        self._async_client = None
+        self._lock = threading.Lock()
+        self._embedding_cache_lock = threading.Lock()
+        self._keep_warm_thread = None
+        self._stop = threading.Event()
@@ -0,0 +1,255 @@
+# ollama_scheduler.py
+# Coda davanti a Ollama condivisa da thread e coroutine: al massimo max_concurrency chiamate
+# insieme (da allineare a OLLAMA_NUM_PARALLEL del server, cosi' gli slot di Ollama restano pieni
+# senza code interne), priorita' interattiva prima di quella di background, coda limitata.
+# Le richieste di embedding che arrivano insieme vengono raggruppate in una sola chiamata.
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import asynccontextmanager, contextmanager
+
+from metrics import (OLLAMA_QUEUE_DEPTH, OLLAMA_ACTIVE, OLLAMA_QUEUE_WAIT_SECONDS, OLLAMA_REJECTED,
+                     EMBEDDING_BATCH_SIZE)
+
+logger = logging.getLogger("ollama_scheduler")
+
+PRIORITY_INTERACTIVE = 0  # Domande degli utenti
+PRIORITY_BACKGROUND = 1   # Keep-warm, addestramento del router, lavori che possono aspettare
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interattiva", PRIORITY_BACKGROUND: "background"}
+
+
+class QueueFullError(Exception):
+    def __init__(self, waiting):
+        super().__init__(f"Coda verso Ollama piena ({waiting} domande in attesa).")
+        self.waiting = waiting
+
+
+class _ThreadWaiter:
+    def __init__(self):
+        self.event = threading.Event()
+
+    def wake(self):
+        self.event.set()
+
+
+class _AsyncWaiter:
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+
+class OllamaScheduler:
+    # slot() per il codice sincrono (Flask, thread di keep-warm), aslot() per quello asincrono.
+    # Il background non occupa mai piu' di max_background slot (di default meta'), il resto e' delle domande.
+    def __init__(self, max_concurrency, max_queue, max_background=None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.max_background = max_background or max(1, max_concurrency // 2)
+        self.active = {PRIORITY_INTERACTIVE: 0, PRIORITY_BACKGROUND: 0}
+        self.rejected = 0
+        self.started = 0
+        self.wait_total = 0.0
+        self._waiters = []  # heap di [priorita', sequenza, waiter]
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    def _queued(self, priority):
+        return sum(1 for entry in self._waiters if entry[0] == priority)
+
+    def _can_start(self, priority):
+        if sum(self.active.values()) >= self.max_concurrency:
+            return False
+        return priority == PRIORITY_INTERACTIVE or self.active[PRIORITY_BACKGROUND] < self.max_background
+
+    def _publish(self):
+        for priority, name in PRIORITY_NAMES.items():
+            OLLAMA_QUEUE_DEPTH.set(name, value=self._queued(priority))
+            OLLAMA_ACTIVE.set(name, value=self.active[priority])
+
+    def check(self, priority=PRIORITY_INTERACTIVE):
+        # Rifiuto immediato (backpressure) se la domanda dovrebbe aspettare e la coda e' piena
+        with self._lock:
+            self._check(priority)
+
+    def _check(self, priority):
+        if priority == PRIORITY_INTERACTIVE and not self._can_start(priority) \
+                and self._queued(PRIORITY_INTERACTIVE) >= self.max_queue:
+            self.rejected += 1
+            OLLAMA_REJECTED.inc(PRIORITY_NAMES[priority])
+            raise QueueFullError(self.waiting)
+
+    def _acquire(self, priority, waiter_cls):
+        # (posizione, waiter): posizione 0 = si parte subito, altrimenti si aspetta il waiter
+        with self._lock:
+            ahead = any(entry[0] <= priority for entry in self._waiters)
+            if not ahead and self._can_start(priority):
+                self.active[priority] += 1
+                self._publish()
+                return 0, None
+            self._check(priority)
+            waiter = waiter_cls()
+            heapq.heappush(self._waiters, [priority, next(self._sequence), waiter])
+            position = sum(1 for entry in self._waiters if entry[0] <= priority)
+            self._publish()
+        logger.info(f"Chiamata a Ollama in coda ({PRIORITY_NAMES[priority]}), posizione {position}.")
+        return position, waiter
+
+    def _dispatch(self):
+        # Con il lock: sveglia i primi in coda (per priorita', poi ordine di arrivo) che possono partire
+        for entry in sorted(self._waiters):
+            priority, _, waiter = entry
+            if self._can_start(priority):
+                self._waiters.remove(entry)
+                self.active[priority] += 1
+                waiter.wake()
+        heapq.heapify(self._waiters)
+
+    def _release(self, priority):
+        with self._lock:
+            self.active[priority] -= 1
+            self._dispatch()
+            self._publish()
+
+    def _cancel(self, priority, waiter):
+        # Rinuncia mentre era in coda; se lo slot era appena stato assegnato va restituito
+        with self._lock:
+            for entry in self._waiters:
+                if entry[2] is waiter:
+                    self._waiters.remove(entry)
+                    heapq.heapify(self._waiters)
+                    self._publish()
+                    return
+        self._release(priority)
+
+    def _started(self, priority, start):
+        wait = time.perf_counter() - start
+        OLLAMA_QUEUE_WAIT_SECONDS.observe(PRIORITY_NAMES[priority], value=wait)
+        with self._lock:
+            self.started += 1
+            self.wait_total += wait
+
+    @contextmanager
+    def slot(self, priority=PRIORITY_INTERACTIVE):
+        start = time.perf_counter()
+        position, waiter = self._acquire(priority, _ThreadWaiter)
+        if waiter is not None:
+            waiter.event.wait()
+        self._started(priority, start)
+        try:
+            yield position
+        finally:
+            self._release(priority)
+
+    @asynccontextmanager
+    async def aslot(self, priority=PRIORITY_INTERACTIVE):
+        start = time.perf_counter()
+        position, waiter = self._acquire(priority, _AsyncWaiter)
+        if waiter is not None:
+            try:
+                await waiter.future
+            except asyncio.CancelledError:
+                self._cancel(priority, waiter)
+                raise
+        self._started(priority, start)
+        try:
+            yield position
+        finally:
+            self._release(priority)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "max_concurrency": self.max_concurrency, "max_queue": self.max_queue,
+                "max_background": self.max_background,
+                "active": sum(self.active.values()), "waiting": self.waiting, "rejected": self.rejected,
+                "avg_wait_ms": round(self.wait_total / (self.started or 1) * 1000, 2),
+                "per_priorita": {name: {"active": self.active[p], "waiting": self._queued(p)}
+                                 for p, name in PRIORITY_NAMES.items()},
+            }
+
+
+class EmbeddingBatcher:
+    # Embedding delle domande raggruppati: il primo che arriva aspetta `window` secondi, poi
+    # manda in una sola chiamata (embed_many_fn(model, testi) -> vettori) tutto quello che si e'
+    # accumulato per quel modello, a blocchi di max_batch. Gli altri aspettano il proprio risultato.
+    def __init__(self, embed_many_fn, max_batch=32, window=0.005):
+        self.embed_many_fn = embed_many_fn
+        self.max_batch = max_batch
+        self.window = window
+        self._pending = {}  # modello -> [(testo, future)]
+        self._lock = threading.Lock()
+
+    def embed(self, model, text):
+        future = Future()
+        with self._lock:
+            leader = model not in self._pending
+            self._pending.setdefault(model, []).append((text, future))
+        if leader:
+            time.sleep(self.window)
+            with self._lock:
+                batch = self._pending.pop(model)
+            self._run(model, batch)
+        return future.result()
+
+    def _run(self, model, batch):
+        for i in range(0, len(batch), self.max_batch):
+            chunk = batch[i:i + self.max_batch]
+            texts = list(dict.fromkeys(text for text, _ in chunk))  # domande uguali: un solo embedding
+            try:
+                vectors = dict(zip(texts, self.embed_many_fn(model, texts)))
+            except Exception as e:
+                for _, future in chunk:
+                    future.set_exception(e)
+                continue
+            EMBEDDING_BATCH_SIZE.observe(value=len(texts))
+            for text, future in chunk:
+                future.set_result(vectors[text])
+
+
+class AsyncEmbeddingBatcher:
+    # Come EmbeddingBatcher ma per l'event loop: embed_many_fn e' una coroutine
+    def __init__(self, embed_many_fn, max_batch=32, window=0.005):
+        self.embed_many_fn = embed_many_fn
+        self.max_batch = max_batch
+        self.window = window
+        self._pending = {}
+
+    async def embed(self, model, text):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if model not in self._pending:
+            # Il gruppo parte in un task a se': se chi l'ha aperto viene cancellato gli altri non restano appesi
+            loop.call_later(self.window, lambda: loop.create_task(self._run(model, self._pending.pop(model))))
+        self._pending.setdefault(model, []).append((text, future))
+        return await future
+
+    async def _run(self, model, batch):
+        for i in range(0, len(batch), self.max_batch):
+            chunk = batch[i:i + self.max_batch]
+            texts = list(dict.fromkeys(text for text, _ in chunk))
+            try:
+                vectors = dict(zip(texts, await self.embed_many_fn(model, texts)))
+            except Exception as e:
+                for _, future in chunk:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            EMBEDDING_BATCH_SIZE.observe(value=len(texts))
+            for text, future in chunk:
+                if not future.done():
+                    future.set_result(vectors[text])
@@ -1,13 +1,25 @@
 # preprocess_files.py
 import os
+import sys
+import json
+import hashlib
+import argparse
 import pandas as pd
+import openpyxl
 import logging
 import shutil
+from concurrent.futures import ProcessPoolExecutor
 from docx import Document as DocxDocument # Per file .doc
 
 INPUT_DIR = "pre_data"
 OUTPUT_DIR = "data" # Qui verranno messi i .txt
-CLEAN_OUTPUT_DIR_FIRST = True # Imposta a False se vuoi mantenere i file in 'data'
+CLEAN_OUTPUT_DIR_FIRST = False # True (o --clean) per ripartire da zero; altrimenti si salta cio' che non e' cambiato
+PREPROCESS_WORKERS = int(os.environ.get("PREPROCESS_WORKERS", str(os.cpu_count() or 1))) # Processi paralleli
+MANIFEST_FILENAME = ".preprocess_manifest.json" # mtime/hash dei file gia' convertiti, dentro OUTPUT_DIR
+SUPPORTED_EXTENSIONS = ('.xlsx', '.docx', '.csv')
+ROWS_PER_GROUP = 50 # Righe per gruppo (con intestazione ripetuta) nei .txt da fogli e CSV
+MAX_ROWS_PER_FILE = 20000 # Oltre, l'output continua in un nuovo file _parteN
+CSV_CHUNK_ROWS = 10000 # Righe CSV lette per volta da pandas
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger("preprocess_files")
@@ -21,8 +33,153 @@ def extract_text_from_docx(docx_path):
         logger.error(f"Errore nell'estrazione testo da {docx_path}: {e}")
         return ""
 
-def convert_files_to_text(input_folder, output_folder, clean_output=False):
-    logger.info(f"Avvio pre-processamento da '{input_folder}' a '{output_folder}'")
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+class TextOutputWriter:
+    # Scrive l'output riga per riga, senza tenere in memoria il foglio/CSV intero.
+    # Le righe tabellari vanno in gruppi di ROWS_PER_GROUP, ognuno con la propria intestazione,
+    # cosi' ogni gruppo si capisce anche da solo; oltre MAX_ROWS_PER_FILE righe si apre
+    # un nuovo file (_parte2, _parte3...). Tutto su .tmp finche' non si chiama commit().
+    def __init__(self, output_dir, base_name, source_line):
+        self.output_dir = output_dir
+        self.base_name = base_name
+        self.source_line = source_line
+        self.paths = []
+        self.f_out = None
+        self.rows_in_file = 0
+        self.section = None
+        self.header = None
+        self.rows_in_section = 0
+
+    def _open_next_file(self):
+        if self.f_out:
+            self.f_out.close()
+        part = len(self.paths) + 1
+        suffix = "" if part == 1 else f"_parte{part}"
+        path = os.path.join(self.output_dir, f"{self.base_name}{suffix}.txt")
+        self.paths.append(path)
+        self.f_out = open(path + ".tmp", 'w', encoding='utf-8')
+        self.f_out.write(f"{self.source_line}\n\n")
+        self.rows_in_file = 0
+
+    def write_text(self, text):
+        if not self.f_out:
+            self._open_next_file()
+        self.f_out.write(text)
+
+    def start_section(self, title, header):
+        self.section = title
+        self.header = [clean_cell(v) for v in header]
+        self.rows_in_section = 0
+
+    def write_row(self, values):
+        if not self.f_out or self.rows_in_file >= MAX_ROWS_PER_FILE:
+            self._open_next_file()
+        if self.rows_in_section % ROWS_PER_GROUP == 0 or self.rows_in_file == 0:
+            first = self.rows_in_section + 1
+            self.f_out.write(f"\n--- Foglio: {self.section} (righe {first}-{first + ROWS_PER_GROUP - 1}) ---\n")
+            self.f_out.write("\t".join(self.header) + "\n")
+        self.f_out.write("\t".join(clean_cell(v) for v in values) + "\n")
+        self.rows_in_file += 1
+        self.rows_in_section += 1
+
+    def commit(self):
+        if self.f_out:
+            self.f_out.close()
+        for path in self.paths:
+            os.replace(path + ".tmp", path)
+        return self.paths
+
+    def abort(self):
+        if self.f_out:
+            self.f_out.close()
+        for path in self.paths:
+            if os.path.exists(path + ".tmp"):
+                os.remove(path + ".tmp")
+
+def clean_cell(value):
+    # Tab e a capo dentro una cella romperebbero la riga TSV
+    if value is None:
+        return ""
+    text = str(value)
+    if '\t' in text or '\n' in text or '\r' in text:
+        text = " ".join(text.split())
+    return text
+
+def write_excel_as_text(input_filepath, out):
+    # openpyxl in sola lettura: le righe vengono lette in streaming, un foglio alla volta
+    workbook = openpyxl.load_workbook(input_filepath, read_only=True, data_only=True)
+    try:
+        for worksheet in workbook.worksheets:
+            rows = worksheet.iter_rows(values_only=True)
+            header = next(rows, None)
+            if header is None:
+                continue
+            out.start_section(worksheet.title, header)
+            for row in rows:
+                if any(v is not None and v != '' for v in row):
+                    out.write_row(row)
+    finally:
+        workbook.close()
+
+def write_csv_as_text(input_filepath, out):
+    section = os.path.basename(input_filepath)
+    reader = pd.read_csv(input_filepath, dtype=str, encoding='utf-8', on_bad_lines='skip',
+                         chunksize=CSV_CHUNK_ROWS, keep_default_na=False)
+    for i, df in enumerate(reader):
+        if i == 0:
+            out.start_section(section, list(df.columns))
+        for row in df.itertuples(index=False, name=None):
+            out.write_row(row)
+
+def process_file(input_filepath, output_dir):
+    # Eseguita in un processo del pool: converte un file e restituisce (file di output o None, messaggio di errore)
+    filename = os.path.basename(input_filepath)
+    output_filename_base = os.path.splitext(filename)[0]
+    lower = filename.lower()
+    os.makedirs(output_dir, exist_ok=True)
+    if lower.endswith('.xlsx'):
+        out = TextOutputWriter(output_dir, f"{output_filename_base}_excel", f"Fonte_Excel: {filename}")
+        writer = write_excel_as_text
+    elif lower.endswith('.docx'):
+        doc_text = extract_text_from_docx(input_filepath)
+        if not doc_text:
+            return None, "nessun testo estratto"
+        out = TextOutputWriter(output_dir, f"{output_filename_base}_docx", f"Fonte_DOCX: {filename}")
+        writer = lambda path, out: out.write_text(doc_text)
+    elif lower.endswith('.csv'):
+        out = TextOutputWriter(output_dir, f"{output_filename_base}_csv", f"Fonte_CSV: {filename}")
+        writer = write_csv_as_text
+    else:
+        return None, "formato non gestito"
+
+    try:
+        writer(input_filepath, out)
+        return out.commit(), None
+    except Exception as e:
+        out.abort()
+        return None, str(e)
+
+def load_manifest(manifest_path):
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(manifest_path, manifest):
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+def convert_files_to_text(input_folder, output_folder, clean_output=False, workers=PREPROCESS_WORKERS):
+    logger.info(f"Avvio pre-processamento da '{input_folder}' a '{output_folder}' ({workers} processi)")
     if not os.path.isdir(input_folder):
         logger.error(f"'{input_folder}' non trovata.")
         return False
@@ -31,75 +188,80 @@ def convert_files_to_text(input_folder, output_folder, clean_output=False):
         if os.path.exists(output_folder):
             logger.warning(f"Pulizia di '{output_folder}'...")
             shutil.rmtree(output_folder)
-        os.makedirs(output_folder, exist_ok=True)
-    else:
-        os.makedirs(output_folder, exist_ok=True)
+    os.makedirs(output_folder, exist_ok=True)
     logger.info(f"Directory di output '{output_folder}' assicurata.")
+    manifest_path = os.path.join(output_folder, MANIFEST_FILENAME)
+    manifest = load_manifest(manifest_path)
+
+    # Visita ricorsiva: le sottocartelle di input vengono replicate nell'output
+    to_process = []
+    seen = set()
+    skipped = 0
+    for root, _, filenames in os.walk(input_folder):
+        for filename in sorted(filenames):
+            input_filepath = os.path.join(root, filename)
+            rel_path = os.path.relpath(input_filepath, input_folder)
+            if not filename.lower().endswith(SUPPORTED_EXTENSIONS):
+                if not filename.lower().endswith('.pdf'): # PDF gestiti direttamente da create_vectorstore_docs.py
+                    logger.warning(f"    File '{rel_path}' non processato (formato non gestito per conversione a TXT).")
+                continue
+            seen.add(rel_path)
+            stat = os.stat(input_filepath)
+            entry = manifest.get(rel_path)
+            if entry and entry.get('outputs') and all(os.path.exists(o) for o in entry['outputs']):
+                if entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                    skipped += 1
+                    continue
+                file_hash = file_sha256(input_filepath)
+                if entry['hash'] == file_hash:
+                    entry['mtime'], entry['size'] = stat.st_mtime, stat.st_size
+                    skipped += 1
+                    continue
+            else:
+                file_hash = file_sha256(input_filepath)
+            output_dir = os.path.join(output_folder, os.path.dirname(rel_path))
+            to_process.append((rel_path, input_filepath, output_dir, file_hash, stat))
+
+    # Input cancellati: via anche il loro .txt
+    for rel_path in [p for p in manifest if p not in seen]:
+        for output in manifest.pop(rel_path).get('outputs', []):
+            if os.path.exists(output):
+                os.remove(output)
+                logger.info(f"    -> Rimosso file: {output} (sorgente '{rel_path}' non piu' presente)")
 
     files_processed = 0
     text_files_created = 0
+    with ProcessPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [(item, executor.submit(process_file, item[1], item[2])) for item in to_process]
+        for (rel_path, input_filepath, output_dir, file_hash, stat), future in futures:
+            logger.info(f"--- Processando file: {rel_path} ---")
+            output_filepaths, error = future.result()
+            files_processed += 1
+            if output_filepaths:
+                for output_filepath in output_filepaths:
+                    logger.info(f"    -> Creato/Aggiornato file: {os.path.relpath(output_filepath, output_folder)}")
+                text_files_created += len(output_filepaths)
+                # Parti in piu' rimaste da una conversione precedente piu' lunga
+                for old_output in manifest.get(rel_path, {}).get('outputs', []):
+                    if old_output not in output_filepaths and os.path.exists(old_output):
+                        os.remove(old_output)
+                manifest[rel_path] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'hash': file_hash, 'outputs': output_filepaths}
+            else:
+                logger.error(f"  ! Errore nell'elaborazione del file '{rel_path}': {error}")
+                manifest.pop(rel_path, None)
 
-    for filename in os.listdir(input_folder):
-        input_filepath = os.path.join(input_folder, filename)
-        if not os.path.isfile(input_filepath):
-            continue
-
-        logger.info(f"--- Processando file: {filename} ---")
-        output_content = None
-        output_filename_base = os.path.splitext(filename)[0]
-        target_output_filename = None
-
-        try:
-            if filename.lower().endswith('.xlsx'):
-                xls = pd.ExcelFile(input_filepath)
-                temp_content = f"Fonte_Excel: {filename}\n\n"
-                for i, sheet_name in enumerate(xls.sheet_names):
-                    df = pd.read_excel(xls, sheet_name=sheet_name, dtype=str).fillna('')
-                    separator = '\t'
-                    csv_content = df.to_csv(sep=separator, index=False, encoding='utf-8')
-                    temp_content += f"--- Foglio: {sheet_name} ---\n{csv_content}\n\n"
-                output_content = temp_content.strip()
-                target_output_filename = f"{output_filename_base}_excel.txt"
-
-            elif filename.lower().endswith('.docx'):
-                doc_text = extract_text_from_docx(input_filepath)
-                if doc_text:
-                    output_content = f"Fonte_DOCX: {filename}\n\n{doc_text}"
-                    target_output_filename = f"{output_filename_base}_docx.txt"
-
-            elif filename.lower().endswith('.csv'):
-                df = pd.read_csv(input_filepath, dtype=str, encoding='utf-8', on_bad_lines='skip').fillna('')
-                separator = '\t' # Convertiamo CSV in TSV per coerenza, o lo lasciamo così?
-                                  # Per ora, lo rendiamo testo semplice.
-                # Potresti voler semplicemente copiare il CSV o convertirlo in un formato testuale diverso
-                # Qui lo convertiamo in una rappresentazione testuale semplice
-                csv_as_text = df.to_string(index=False)
-                output_content = f"Fonte_CSV: {filename}\n\n{csv_as_text}"
-                target_output_filename = f"{output_filename_base}_csv.txt"
-
-            # PDF non viene convertito in .txt qui, create_vectorstore_docs.py lo gestirà direttamente
-
-            if output_content and target_output_filename:
-                output_filepath = os.path.join(output_folder, target_output_filename)
-                with open(output_filepath, 'w', encoding='utf-8') as f_out:
-                    f_out.write(output_content)
-                logger.info(f"    -> Creato/Aggiornato file: {target_output_filename}")
-                text_files_created += 1
-            elif not filename.lower().endswith('.pdf'): # Ignora PDF per ora, ma logga altri non gestiti
-                logger.warning(f"    File '{filename}' non processato (formato non gestito per conversione a TXT o errore).")
-
-            files_processed +=1
-
-        except Exception as e:
-            logger.error(f"  ! Errore nell'elaborazione del file '{filename}': {e}")
-
+    save_manifest(manifest_path, manifest)
     logger.info("--- Pre-processamento completato ---")
-    logger.info(f"File totali analizzati: {files_processed}")
+    logger.info(f"File totali analizzati: {files_processed + skipped} (invariati, saltati: {skipped})")
     logger.info(f"File di testo creati/aggiornati: {text_files_created}")
     return True
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Converte xlsx/docx/csv di pre_data in .txt per il vector store.")
+    parser.add_argument("--workers", type=int, default=PREPROCESS_WORKERS, help="Processi paralleli")
+    parser.add_argument("--clean", action="store_true", default=CLEAN_OUTPUT_DIR_FIRST, help="Svuota la cartella di output prima di iniziare")
+    args = parser.parse_args()
     if not os.path.exists(INPUT_DIR):
          logger.warning(f"'{INPUT_DIR}' non esiste. Creala e mettici i file.")
-         exit(1)
-    convert_files_to_text(INPUT_DIR, OUTPUT_DIR, clean_output=CLEAN_OUTPUT_DIR_FIRST)
\ No newline at end of file
+         sys.exit(1)
+    convert_files_to_text(INPUT_DIR, OUTPUT_DIR, clean_output=args.clean, workers=args.workers)
@@ -0,0 +1,301 @@
+# result_cache.py
+# Cache dei risultati delle query SQL gia' eseguite, chiave = SQL normalizzato (dopo prepare_sql).
+# Si tiene il risultato intero (fino a SQL_MAX_ROWS): le pagine successive e il CSV escono dalla cache.
+# Invalidazione per tabella: a ogni risultato si associano le tabelle citate nell'SQL con il loro
+# information_schema.TABLES.UPDATE_TIME al momento dell'esecuzione; se una cambia, il risultato
+# non vale piu'. Dove UPDATE_TIME non c'e' (viste, alcuni motori) resta solo il TTL.
+# In memoria: LRU limitata in byte; con spill_dir i risultati tolti dalla memoria finiscono su
+# disco (JSON) e tornano in memoria al primo uso, entro un secondo limite in byte.
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger("result_cache")
+
+TABLE_TIMES_QUERY = """
+SELECT TABLE_NAME, UPDATE_TIME, TIMESTAMPDIFF(SECOND, UPDATE_TIME, NOW())
+FROM information_schema.TABLES
+WHERE TABLE_SCHEMA = DATABASE()
+"""
+
+# Stringhe, identificatori tra backtick e parole dell'SQL
+SQL_TOKEN_RE = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`([^`]*)`|([A-Za-z_][A-Za-z0-9_$]*)|(\s+)")
+
+# Funzioni il cui risultato cambia senza che cambino le tabelle: query mai messe in cache.
+# Le prime si scrivono anche senza parentesi, le altre solo come chiamata.
+VOLATILE_RE = re.compile(
+    r"\b(?:CURRENT_DATE|CURRENT_TIME|CURRENT_TIMESTAMP|LOCALTIME|LOCALTIMESTAMP|UTC_DATE|UTC_TIME|UTC_TIMESTAMP)\b"
+    r"|\b(?:NOW|CURDATE|CURTIME|SYSDATE|UNIX_TIMESTAMP|RAND|UUID|UUID_SHORT|CONNECTION_ID|LAST_INSERT_ID"
+    r"|FOUND_ROWS|ROW_COUNT)\s*\(", re.IGNORECASE)
+
+# UPDATE_TIME ha la granularita' del secondo: una tabella scritta da meno di cosi' potrebbe
+# cambiare ancora nello stesso secondo senza che UPDATE_TIME se ne accorga
+RECENT_WRITE_SECONDS = 2
+
+
+def normalize_sql(sql):
+    # Spazi compressi fuori dalle stringhe, senza ';' finale: stesso SQL, stessa chiave
+    sql = sql.strip().rstrip(';').strip()
+    return SQL_TOKEN_RE.sub(lambda m: " " if m.group(3) else m.group(0), sql)
+
+
+def volatile_sql(sql):
+    # True se l'SQL, tolte stringhe e identificatori quotati, usa una funzione volatile
+    return bool(VOLATILE_RE.search(SQL_TOKEN_RE.sub(lambda m: m.group(0) if m.group(2) or m.group(3) else " ''", sql)))
+
+
+def sql_identifiers(sql):
+    # Parole e identificatori fuori dalle stringhe, in minuscolo (db.tabella -> tabella)
+    names = set()
+    for match in SQL_TOKEN_RE.finditer(sql):
+        name = match.group(1) if match.group(1) is not None else match.group(2)
+        if name:
+            names.add(name.lower())
+    return names
+
+
+def page_of(result, offset, page_size):
+    # La pagina richiesta da un risultato completo in cache (stesso formato di ResultCollector.result)
+    return {**result, "rows": result['rows'][offset:offset + page_size], "offset": offset, "page_size": page_size}
+
+
+class ResultCache:
+    # connection_factory: context manager che fornisce una connessione (es. dal pool), usato
+    # per leggere gli UPDATE_TIME al massimo ogni check_seconds
+    def __init__(self, connection_factory, max_bytes=64 * 1024 * 1024, ttl_seconds=300, check_seconds=2,
+                 spill_dir=None, max_disk_bytes=256 * 1024 * 1024):
+        self.connection_factory = connection_factory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.check_seconds = check_seconds
+        self.spill_dir = spill_dir
+        self.max_disk_bytes = max_disk_bytes
+        self.entries = OrderedDict()  # chiave -> {'result', 'tables', 'created', 'bytes'}
+        self.bytes = 0
+        self.counters = {"hits": 0, "disk_hits": 0, "misses": 0, "stored": 0, "not_cacheable": 0,
+                         "invalidated": 0, "expired": 0, "evicted": 0, "spilled": 0}
+        self._lock = threading.Lock()
+        self._times_lock = threading.Lock()
+        self._times = None  # ({tabella: (update_time, secondi dall'ultima scrittura)}, letto alle)
+        self._disk_lock = threading.Lock()  # Per _disk_bytes: i file si scrivono e tolgono fuori da _lock
+        self._disk_bytes = 0
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+            self._disk_bytes = sum(entry.stat().st_size for entry in os.scandir(spill_dir)
+                                   if entry.name.endswith('.json'))
+
+    def _table_times(self):
+        # UPDATE_TIME di tutte le tabelle, riletti al massimo ogni check_seconds; None se il DB non risponde
+        with self._times_lock:
+            now = time.monotonic()
+            if self._times is not None and now - self._times[1] < self.check_seconds:
+                return self._times
+            try:
+                with self.connection_factory() as conn:
+                    cursor = conn.cursor()
+                    try:
+                        try:
+                            # MySQL 8 tiene in cache le statistiche di information_schema (24 ore di default)
+                            cursor.execute("SET SESSION information_schema_stats_expiry = 0")
+                        except Exception:
+                            pass  # MariaDB e MySQL 5.7: variabile assente, UPDATE_TIME gia' aggiornato
+                        cursor.execute(TABLE_TIMES_QUERY)
+                        rows = cursor.fetchall()
+                    finally:
+                        cursor.close()
+            except Exception as e:
+                logger.warning(f"UPDATE_TIME delle tabelle non disponibili, cache risultati saltata: {e}")
+                return None
+            times = {}
+            for name, update_time, age in rows:
+                name = name.decode('utf-8') if isinstance(name, (bytes, bytearray)) else name
+                times[name.lower()] = (str(update_time) if update_time is not None else None,
+                                       int(age) if age is not None else None)
+            self._times = (times, time.monotonic())
+            return self._times
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _valid(self, entry, now):
+        if now - entry['created'] > self.ttl_seconds:
+            self._count("expired")
+            return False
+        snapshot = self._table_times()
+        if snapshot is None:
+            return False
+        times = snapshot[0]
+        for name, update_time in entry['tables'].items():
+            if name not in times or times[name][0] != update_time:
+                self._count("invalidated")
+                logger.info(f"Risultato in cache invalidato: tabella {name} modificata.")
+                return False
+        return True
+
+    def lookup(self, sql):
+        # (risultato completo o None, ticket da ripassare a store() dopo l'esecuzione, o None se
+        # la query non va messa in cache). Il ticket fissa gli UPDATE_TIME prima di eseguire:
+        # una scrittura durante l'esecuzione rende il risultato gia' vecchio alla prossima lettura.
+        key = normalize_sql(sql)
+        now = time.time()
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        source = "hits"
+        if entry is None and self.spill_dir:
+            entry = self._read_spilled(key)
+            source = "disk_hits"
+        if entry is not None:
+            if self._valid(entry, now):
+                with self._lock:
+                    self.counters[source] += 1
+                    evicted = self._insert(key, entry) if source == "disk_hits" else []
+                self._spill_all(evicted)
+                return entry['result'], None
+            self._discard(key)
+        with self._lock:
+            self.counters["misses"] += 1
+        return None, self._ticket(key)
+
+    def _ticket(self, key):
+        if volatile_sql(key):
+            self._count("not_cacheable")
+            return None
+        snapshot = self._table_times()
+        if snapshot is None:
+            return None
+        times, read_at = snapshot
+        tables = {name: times[name] for name in sql_identifiers(key) if name in times}
+        elapsed = time.monotonic() - read_at
+        if not tables or any(age is not None and age + elapsed < RECENT_WRITE_SECONDS
+                             for _, age in tables.values()):
+            self._count("not_cacheable")
+            return None
+        return {'key': key, 'tables': {name: update_time for name, (update_time, _) in tables.items()},
+                'created': time.time()}
+
+    def store(self, ticket, result):
+        if ticket is None or "error" in result:
+            return
+        entry = {'result': result, 'tables': ticket['tables'], 'created': ticket['created']}
+        entry['bytes'] = len(json.dumps(result, ensure_ascii=False).encode('utf-8'))  # Byte, non caratteri: le lettere accentate ne occupano 2
+        if entry['bytes'] > self.max_bytes:
+            self._count("not_cacheable")
+            return
+        with self._lock:
+            evicted = self._insert(ticket['key'], entry)
+            self.counters["stored"] += 1
+        self._spill_all(evicted)
+
+    def _insert(self, key, entry):
+        # Con il lock preso. Oltre max_bytes escono dalla memoria i meno usati: [(chiave, entry)]
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.bytes -= old['bytes']
+        self.entries[key] = entry
+        self.bytes += entry['bytes']
+        evicted = []
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            evicted_key, evicted_entry = self.entries.popitem(last=False)
+            self.bytes -= evicted_entry['bytes']
+            self.counters["evicted"] += 1
+            evicted.append((evicted_key, evicted_entry))
+        return evicted
+
+    def _spill_all(self, evicted):
+        # Fuori dal lock: la scrittura su disco non blocca le altre letture
+        if self.spill_dir:
+            for key, entry in evicted:
+                self._spill(key, entry)
+
+    def _discard(self, key):
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry['bytes']
+        if self.spill_dir:
+            self._remove_spilled(self._path(key))
+
+    def _path(self, key):
+        return os.path.join(self.spill_dir, hashlib.md5(key.encode('utf-8')).hexdigest() + ".json")
+
+    def _spill(self, key, entry):
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'key': key, **entry}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+        except OSError as e:
+            logger.warning(f"Impossibile salvare su disco il risultato in cache: {e}")
+            return
+        self._count("spilled")
+        with self._disk_lock:
+            self._disk_bytes += size
+            over = self._disk_bytes > self.max_disk_bytes
+        if over:
+            self._trim_disk()
+
+    def _trim_disk(self):
+        # I file meno recenti per primi, fino a tornare sotto max_disk_bytes. Tutto sotto _disk_lock:
+        # il conteggio riparte dai file presenti e due pulizie insieme non tolgono il doppio
+        with self._disk_lock:
+            try:
+                files = sorted((entry.stat().st_mtime, entry.path, entry.stat().st_size)
+                               for entry in os.scandir(self.spill_dir) if entry.name.endswith('.json'))
+            except OSError:
+                return
+            self._disk_bytes = sum(size for _, _, size in files)
+            for _, path, size in files:
+                if self._disk_bytes <= self.max_disk_bytes:
+                    break
+                try:
+                    os.remove(path)
+                    self._disk_bytes -= size
+                except OSError:
+                    pass
+
+    def _remove_spilled(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self._disk_lock:
+            self._disk_bytes -= size
+
+    def _read_spilled(self, key):
+        # Il risultato torna in memoria: il file non serve piu'
+        path = self._path(key)
+        try:
+            with open(path, encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Risultato in cache su disco illeggibile ({path}): {e}")
+            return None
+        if entry.pop('key', None) != key:
+            return None
+        self._remove_spilled(path)
+        return entry
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            lookups = stats["hits"] + stats["disk_hits"] + stats["misses"]
+            stats["hit_rate"] = round((stats["hits"] + stats["disk_hits"]) / lookups, 3) if lookups else None
+            stats["entries"] = len(self.entries)
+            stats["bytes"] = self.bytes
+        if self.spill_dir:
+            with self._disk_lock:
+                stats["disk_bytes"] = max(self._disk_bytes, 0)
+        return stats
@@ -0,0 +1,149 @@
+# schema_catalog.py
+import logging
+import hashlib
+import threading
+import time
+
+logger = logging.getLogger("schema_catalog")
+
+# Impronta economica delle tabelle: serve solo a capire se ricaricare il catalogo
+FINGERPRINT_QUERY = """
+SELECT t.TABLE_NAME, t.CREATE_TIME, t.UPDATE_TIME,
+       (SELECT COUNT(*) FROM information_schema.COLUMNS c
+         WHERE c.TABLE_SCHEMA = t.TABLE_SCHEMA AND c.TABLE_NAME = t.TABLE_NAME)
+FROM information_schema.TABLES t
+WHERE t.TABLE_SCHEMA = DATABASE()
+ORDER BY t.TABLE_NAME
+"""
+
+TABLES_QUERY = """
+SELECT TABLE_NAME, TABLE_COMMENT
+FROM information_schema.TABLES
+WHERE TABLE_SCHEMA = DATABASE()
+ORDER BY TABLE_NAME
+"""
+
+# Una sola query per tutte le colonne di tutte le tabelle (al posto di un DESCRIBE per tabella)
+COLUMNS_QUERY = """
+SELECT TABLE_NAME, COLUMN_NAME, COLUMN_TYPE, COLUMN_KEY, IS_NULLABLE, COLUMN_COMMENT
+FROM information_schema.COLUMNS
+WHERE TABLE_SCHEMA = DATABASE()
+ORDER BY TABLE_NAME, ORDINAL_POSITION
+"""
+
+FOREIGN_KEYS_QUERY = """
+SELECT TABLE_NAME, COLUMN_NAME, REFERENCED_TABLE_NAME, REFERENCED_COLUMN_NAME
+FROM information_schema.KEY_COLUMN_USAGE
+WHERE TABLE_SCHEMA = DATABASE() AND REFERENCED_TABLE_NAME IS NOT NULL
+ORDER BY TABLE_NAME, ORDINAL_POSITION
+"""
+
+
+def render_table(table):
+    lines = [f"Tabella: {table['name']}"]
+    if table.get('comment'):
+        lines.append(f"Descrizione: {table['comment']}")
+    lines.append("Colonne:")
+    for col in table['columns']:
+        extra = ""
+        if col['key'] == 'PRI':
+            extra = ", chiave primaria"
+        fk = table['foreign_keys'].get(col['name'])
+        if fk:
+            extra += f", riferimento a {fk[0]}.{fk[1]}"
+        line = f"  - {col['name']} ({col['type']}{extra})"
+        if col.get('comment'):
+            line += f" -- {col['comment']}"
+        lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+class SchemaCatalog:
+    # Catalogo dello schema tenuto in memoria e ricaricato solo quando serve:
+    # ogni ttl_seconds si ricalcola l'impronta (TABLES.CREATE_TIME/UPDATE_TIME + numero colonne)
+    # e il catalogo completo viene riletto solo se l'impronta e' cambiata.
+    # connection_factory: context manager che fornisce una connessione (es. dal pool)
+    def __init__(self, connection_factory, ttl_seconds=300):
+        self.connection_factory = connection_factory
+        self.ttl_seconds = ttl_seconds
+        self.tables = {}
+        self.schema_string = None
+        self.version = None  # hash del catalogo renderizzato, cambia solo se cambia lo schema
+        self._fingerprint = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def _fetch_fingerprint(self, cursor):
+        cursor.execute(FINGERPRINT_QUERY)
+        rows = cursor.fetchall()
+        return hashlib.md5(repr(rows).encode('utf-8')).hexdigest()
+
+    def _load(self, cursor):
+        tables = {}
+        cursor.execute(TABLES_QUERY)
+        for table_name, table_comment in cursor.fetchall():
+            tables[table_name] = {
+                'name': table_name,
+                'comment': table_comment or "",
+                'columns': [],
+                'primary_key': [],
+                'foreign_keys': {},  # colonna -> (tabella_riferita, colonna_riferita)
+            }
+
+        cursor.execute(COLUMNS_QUERY)
+        for table_name, col_name, col_type, col_key, nullable, col_comment in cursor.fetchall():
+            table = tables.get(table_name)
+            if table is None:
+                continue
+            table['columns'].append({
+                'name': col_name,
+                'type': col_type,
+                'key': col_key or "",
+                'nullable': nullable == 'YES',
+                'comment': col_comment or "",
+            })
+            if col_key == 'PRI':
+                table['primary_key'].append(col_name)
+
+        cursor.execute(FOREIGN_KEYS_QUERY)
+        for table_name, col_name, ref_table, ref_col in cursor.fetchall():
+            if table_name in tables:
+                tables[table_name]['foreign_keys'][col_name] = (ref_table, ref_col)
+
+        for table in tables.values():
+            table['rendered'] = render_table(table)
+        return tables
+
+    def refresh(self, force=False):
+        with self._lock:
+            now = time.monotonic()
+            if not force and self.schema_string is not None and now - self._checked_at < self.ttl_seconds:
+                return False
+            with self.connection_factory() as conn:
+                cursor = conn.cursor()
+                try:
+                    fingerprint = self._fetch_fingerprint(cursor)
+                    self._checked_at = now
+                    if not force and fingerprint == self._fingerprint:
+                        return False
+                    load_start = time.time()
+                    tables = self._load(cursor)
+                finally:
+                    cursor.close()
+
+            if tables:
+                schema_string = "Schema Database:\n\n" + "\n".join(t['rendered'] for t in tables.values())
+            else:
+                schema_string = ""
+            self.tables = tables
+            self.schema_string = schema_string
+            self._fingerprint = fingerprint
+            old_version = self.version
+            self.version = hashlib.md5(schema_string.encode('utf-8')).hexdigest()
+            logger.info(f"Catalogo schema caricato: {len(tables)} tabelle in {time.time() - load_start:.3f}s"
+                        f"{' (schema cambiato)' if old_version and old_version != self.version else ''}.")
+            return True
+
+    def get_schema_string(self):
+        self.refresh()
+        return self.schema_string
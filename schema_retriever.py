@@ -0,0 +1,140 @@
+# schema_retriever.py
+import os
+import json
+import logging
+import threading
+
+from bm25 import BM25Index, tokenize
+
+logger = logging.getLogger("schema_retriever")
+
+SCHEMA_INDEX_FILENAME = "schema_bm25.json"
+
+
+def estimate_tokens(text):
+    # Stima grezza (~4 caratteri per token), sufficiente per rispettare un budget
+    return len(text) // 4 + 1
+
+
+def table_search_text(table):
+    parts = [table['name'], table.get('comment', "")]
+    for col in table['columns']:
+        parts.append(col['name'])
+        parts.append(col.get('comment', ""))
+    for ref_table, _ in table['foreign_keys'].values():
+        parts.append(ref_table)
+    return " ".join(parts)
+
+
+class SchemaRetriever:
+    # Seleziona solo le tabelle rilevanti per la domanda (BM25 su nomi e commenti di
+    # tabelle/colonne) piu' le tabelle collegate via chiave esterna.
+    # L'indice viene costruito una volta per versione del catalogo e salvato su disco.
+    def __init__(self, catalog, index_dir, top_k=8, token_budget=2000):
+        self.catalog = catalog
+        self.index_dir = index_dir
+        self.top_k = top_k
+        self.token_budget = token_budget
+        self.index = None
+        self.index_version = None
+        self._lock = threading.Lock()
+
+    def _index_path(self):
+        return os.path.join(self.index_dir, SCHEMA_INDEX_FILENAME)
+
+    def _load_from_disk(self, version):
+        path = self._index_path()
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Indice schema su disco illeggibile ({path}): {e}")
+            return None
+        if data.get('catalog_version') != version:
+            return None
+        return BM25Index.from_dict(data['index'])
+
+    def _build(self, version):
+        index = BM25Index()
+        for table in self.catalog.tables.values():
+            index.add(table['name'], tokenize(table_search_text(table)))
+        try:
+            os.makedirs(self.index_dir, exist_ok=True)
+            with open(self._index_path(), 'w', encoding='utf-8') as f:
+                json.dump({'catalog_version': version, 'index': index.to_dict()}, f)
+        except OSError as e:
+            logger.warning(f"Impossibile salvare l'indice schema: {e}")
+        logger.info(f"Indice schema costruito: {len(index.doc_ids)} tabelle.")
+        return index
+
+    def ensure_index(self):
+        self.catalog.refresh()
+        version = self.catalog.version
+        with self._lock:
+            if self.index is None or self.index_version != version:
+                index = self._load_from_disk(version)
+                if index is None:
+                    index = self._build(version)
+                self.index = index
+                self.index_version = version
+            return self.index
+
+    def select_tables(self, question):
+        index = self.ensure_index()
+        tables = self.catalog.tables
+        hits = [name for name, _ in index.top_k(tokenize(question), self.top_k)]
+        selected = list(hits)
+        # Vicini via chiave esterna, in entrambe le direzioni
+        hit_set = set(hits)
+        for name in hits:
+            for ref_table, _ in tables[name]['foreign_keys'].values():
+                if ref_table in tables and ref_table not in selected:
+                    selected.append(ref_table)
+        for name, table in tables.items():
+            if name in selected:
+                continue
+            if any(ref_table in hit_set for ref_table, _ in table['foreign_keys'].values()):
+                selected.append(name)
+        return selected
+
+    def get_schema_string(self, question):
+        full_schema = self.catalog.get_schema_string()
+        if not full_schema:
+            return full_schema
+        full_tokens = estimate_tokens(full_schema)
+        if full_tokens <= self.token_budget:
+            return full_schema
+
+        selected = self.select_tables(question) or list(self.catalog.tables)
+        return self.render_tables(selected, full_tokens)
+
+    def get_session_schema(self, question, pinned_tables=()):
+        # Schema per una conversazione: le tabelle gia' usate restano, nello stesso ordine, e le
+        # nuove si aggiungono in coda. Se non ne servono di nuove il testo e' identico al turno prima.
+        # Restituisce (schema, tabelle incluse).
+        full_schema = self.catalog.get_schema_string()
+        tables = self.catalog.tables
+        if not full_schema or estimate_tokens(full_schema) <= self.token_budget:
+            return full_schema, list(tables)
+        selected = [name for name in pinned_tables if name in tables]
+        selected += [name for name in self.select_tables(question) if name not in selected]
+        schema_string = self.render_tables(selected or list(tables), estimate_tokens(full_schema))
+        return schema_string, [name for name in selected if tables[name]['rendered'] in schema_string]
+
+    def render_tables(self, selected, full_tokens):
+        tables = self.catalog.tables
+        parts = ["Schema Database (tabelle pertinenti):\n"]
+        used_tokens = estimate_tokens(parts[0])
+        for name in selected:
+            rendered = tables[name]['rendered']
+            cost = estimate_tokens(rendered)
+            if used_tokens + cost > self.token_budget and len(parts) > 1:
+                continue
+            parts.append(rendered)
+            used_tokens += cost
+        schema_string = "\n".join(parts)
+        logger.info(f"Schema ridotto: {len(parts) - 1}/{len(tables)} tabelle, "
+                    f"~{used_tokens} token invece di ~{full_tokens} (risparmiati ~{full_tokens - used_tokens}).")
+        return schema_string
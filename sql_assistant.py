@@ -0,0 +1,187 @@
+# sql_assistant.py
+# Parti del percorso domanda -> SQL -> risposta che non fanno I/O,
+# condivise tra l'app Flask (MariaCarla.py) e quella asincrona (mariacarla_async.py).
+import csv
+import datetime
+import decimal
+import io
+import logging
+
+from sql_guard import collapse_whitespace
+from think_filter import strip_think
+
+logger = logging.getLogger("sql_assistant")
+
+# Codici di tipo MySQL (cursor.description[i][1]), uguali per mysql.connector e aiomysql
+MYSQL_COLUMN_TYPES = {
+    0: "numero", 1: "numero", 2: "numero", 3: "numero", 4: "numero", 5: "numero", 8: "numero",
+    9: "numero", 13: "numero", 16: "numero", 246: "numero",
+    10: "data", 14: "data", 7: "dataora", 12: "dataora", 11: "ora",
+    249: "binario", 250: "binario", 251: "binario", 252: "binario",
+}
+
+
+def is_db_question(user_question):
+    # Logica di routing (da migliorare con LLM più potente per classificazione)
+    keywords_db = ["database", "tabella", "tabelle", "query", "sql", "dati di", "record di", "elenca da"]
+    return any(keyword in user_question.lower() for keyword in keywords_db)
+
+
+SQL_SESSION_RULES = ("Genera UNA SOLA query SQL SELECT valida per MySQL che risponda alla domanda qui sotto, "
+                     "usando lo schema del database e, per le domande di seguito, le query precedenti della conversazione. "
+                     "Rispondi ESCLUSIVAMENTE con la query SQL, senza spiegazioni, commenti o blocchi di codice. "
+                     "Se non e' possibile rispondi ESATTAMENTE \"NON POSSO GENERARE LA QUERY\".")
+
+
+def format_sql_examples(examples):
+    # Esempi few-shot da sql_examples.py: coppie domanda/SQL gia' eseguite con successo su questo database
+    if not examples:
+        return ""
+    lines = ["Esempi di domande gia' risolte su questo database:"]
+    for example in examples:
+        lines.append(f"Domanda Utente: {example['domanda']}\nQuery SQL: {example['sql']}")
+    return "\n\n".join(lines) + "\n\n"
+
+
+def build_sql_session_prompt(user_question, examples=None):
+    # Ultimo messaggio di un turno di conversazione: lo schema e' gia' nel prefisso fisso della sessione
+    return f"{SQL_SESSION_RULES}\n{format_sql_examples(examples)}Domanda Utente: {user_question}\nQuery SQL:"
+
+
+def build_sql_prompts(user_question, db_schema, examples=None):
+    # *** PROMPT SQL GENERATION MODIFICATO (SOLUZIONE 1) ***
+    system_sql_gen = '''
+    Sei un esperto di MySQL. Il tuo compito è generare UNA SOLA query SQL SELECT valida per rispondere alla domanda dell'utente, basandoti sullo schema del database fornito.
+    IMPORTANTE: La tua risposta DEVE contenere ESCLUSIVAMENTE la query SQL, e nient'altro.
+    Non includere spiegazioni, commenti, testo introduttivo, tag di pensiero, o qualsiasi altra cosa prima o dopo la query SQL.
+    Se la domanda non può essere risposta con una singola query SELECT o richiede informazioni non presenti nello schema, la tua risposta DEVE essere ESATTAMENTE la stringa "NON POSSO GENERARE LA QUERY".
+    {db_schema}
+    '''.format(db_schema=db_schema)
+
+    # Gli esempi stanno nel messaggio utente: il system (istruzioni + schema) resta uguale tra le domande
+    prompt_sql_gen = f"{format_sql_examples(examples)}Domanda Utente: {user_question}\nQuery SQL:"
+    # *** FINE MODIFICA PROMPT ***
+    return system_sql_gen, prompt_sql_gen
+
+
+def clean_generated_sql(generated_sql_raw):
+    generated_sql = strip_think(generated_sql_raw).strip()
+    # Blocchi ```sql ... ``` che a volte il modello aggiunge nonostante il prompt
+    if generated_sql.startswith("```"):
+        generated_sql = generated_sql.strip("`").strip()
+        if generated_sql.lower().startswith("sql"):
+            generated_sql = generated_sql[3:].strip()
+    # Semplice pulizia di virgolette esterne che a volte i modelli aggiungono
+    if generated_sql.startswith('"') and generated_sql.endswith('"'):
+        generated_sql = generated_sql[1:-1].strip()
+    elif generated_sql.startswith("'") and generated_sql.endswith("'"):
+        generated_sql = generated_sql[1:-1].strip()
+    generated_sql = collapse_whitespace(generated_sql)
+    logger.info(f"SQL pulito per esecuzione: '{generated_sql}'")
+    return generated_sql
+
+
+def check_generated_sql(generated_sql, generated_sql_raw):
+    # Testo di risposta se l'SQL generato non e' utilizzabile, altrimenti None
+    if "NON POSSO GENERARE LA QUERY" in generated_sql.upper() or not generated_sql.upper().startswith("SELECT"):
+        return f"Non sono riuscito a generare una query SQL valida. (LLM ha detto: '{generated_sql_raw}')"
+    return None
+
+
+def column_types(description):
+    # [{'nome', 'tipo'}] dalla description del cursore; i tipi non mappati sono testo
+    return [{"nome": desc[0], "tipo": MYSQL_COLUMN_TYPES.get(desc[1], "testo")} for desc in description]
+
+
+def json_value(value):
+    # Valore di una cella convertito in un tipo JSON, senza passare da str() della riga intera
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (datetime.date, datetime.datetime, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta): # Colonne TIME
+        return str(value)
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value).decode('utf-8', errors='replace')
+    if isinstance(value, (set, frozenset)): # Colonne SET
+        return ",".join(sorted(value))
+    return str(value)
+
+
+class ResultCollector:
+    # Le righe arrivano a blocchi da fetchmany: si tiene solo la pagina richiesta
+    # e si smette di leggere oltre max_rows, cosi' la memoria non dipende dal risultato.
+    def __init__(self, offset=0, page_size=100, max_rows=1000):
+        self.offset = offset
+        self.page_size = page_size
+        self.max_rows = max_rows
+        self.rows = []
+        self.seen = 0
+        self.truncated = False
+
+    def add(self, batch):
+        # False quando non serve leggere altro
+        for row in batch:
+            if self.seen >= self.max_rows:
+                self.truncated = True
+                return False
+            if self.offset <= self.seen < self.offset + self.page_size:
+                self.rows.append([json_value(v) for v in row])
+            self.seen += 1
+        return True
+
+    def result(self, columns):
+        return {"columns": columns, "rows": self.rows, "rowcount": self.seen,
+                "offset": self.offset, "page_size": self.page_size, "truncated": self.truncated}
+
+
+def result_window(data, page_size, max_rows):
+    # Dal corpo della richiesta: (offset, righe per pagina, True se richiesto CSV).
+    # Il CSV contiene tutte le righe fino a max_rows; il JSON solo la pagina richiesta.
+    if str(data.get('formato', 'json')).lower() == 'csv':
+        return 0, max_rows, True
+    try:
+        page = max(1, int(data.get('pagina') or 1))
+    except (TypeError, ValueError):
+        page = 1
+    return (page - 1) * page_size, page_size, False
+
+
+def shape_sql_result(generated_sql, query_results):
+    # Risultato tabellare per il frontend (colonne tipizzate, righe della pagina, paginazione)
+    page_size = query_results['page_size'] or 1
+    return {
+        "sql": generated_sql,
+        "colonne": query_results['columns'],
+        "righe": query_results['rows'],
+        "pagina": query_results['offset'] // page_size + 1,
+        "pagine": max(1, -(-query_results['rowcount'] // page_size)),
+        "righe_per_pagina": page_size,
+        "righe_totali": query_results['rowcount'],
+        "troncato": query_results['truncated'],
+    }
+
+
+def sql_result_to_csv(query_results):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([col['nome'] for col in query_results['columns']])
+    writer.writerows(query_results['rows'])
+    return buffer.getvalue()
+
+
+def format_sql_results(generated_sql, query_results):
+    # Restituisce (testo risposta, True se la query e' stata eseguita senza errori)
+    if "error" in query_results:
+        return f"Errore esecuzione SQL: {query_results['error']}\nSQL: {generated_sql}", False
+    if not query_results.get("rows") and query_results.get("rowcount", 0) == 0 :
+        return f"Query eseguita, nessun risultato.\nSQL: {generated_sql}", True
+
+    lines = [f"Query SQL Eseguita: {generated_sql}", "Risultati:", "",
+             ", ".join(col['nome'] for col in query_results['columns'])]
+    lines.extend(", ".join("" if v is None else str(v) for v in row) for row in query_results['rows'])
+    if query_results.get("truncated"):
+        lines.append(f"... risultato limitato alle prime {query_results['rowcount']} righe.")
+    return "\n".join(lines) + "\n", True
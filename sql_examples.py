@@ -0,0 +1,257 @@
+# sql_examples.py
+# Archivio delle coppie domanda -> SQL prodotte da /ask, con esito, righe e latenza.
+# Le coppie riuscite (query eseguita con almeno una riga) servono in due modi:
+#   - esempi few-shot: le piu' simili alla nuova domanda (embedding) vanno nel prompt SQL
+#   - modello: una domanda uguale a una riuscita a parte numeri e testi tra virgolette, che
+#     compaiono anche nel suo SQL, riusa quell'SQL con i nuovi valori senza chiamare il modello
+# Gli esempi stanno in SQLite (sopravvivono al riavvio e sono condivisi tra processi). Per ogni
+# esempio si salvano le impronte delle tabelle usate: se lo schema di una tabella cambia o la
+# tabella sparisce, i suoi esempi vengono eliminati. Oltre max_examples si tolgono prima i
+# fallimenti, poi gli esempi usati meno di recente.
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+from answer_cache import normalize_question
+from bm25 import tokenize
+
+logger = logging.getLogger("sql_examples")
+
+LITERAL_RE = re.compile(r"'([^']*)'|\"([^\"]*)\"|(?<![\w.])(\d+(?:[.,]\d+)?)(?![\w.])")
+NUMBER_RE = re.compile(r"\d+(?:\.\d+)?")
+# Testi ammessi in un letterale SQL: senza backslash ne' caratteri di controllo, il cui significato dipende
+# da sql_mode (NO_BACKSLASH_ESCAPES). Cosi' raddoppiare gli apici basta in ogni configurazione.
+SAFE_TEXT_RE = re.compile(r"[^\\\x00-\x1f]*")
+
+SCHEMA_SQL = """
+CREATE TABLE IF NOT EXISTS esempi (
+    id INTEGER PRIMARY KEY,
+    chiave TEXT UNIQUE NOT NULL,
+    modello TEXT NOT NULL,
+    valori TEXT NOT NULL,
+    domanda TEXT NOT NULL,
+    sql TEXT NOT NULL,
+    riuscito INTEGER NOT NULL,
+    righe INTEGER,
+    latenza_ms REAL,
+    tabelle TEXT NOT NULL,
+    embedding BLOB,
+    creato REAL NOT NULL,
+    usato REAL NOT NULL,
+    usi INTEGER NOT NULL DEFAULT 0,
+    fallimenti INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS esempi_modello ON esempi (modello);
+"""
+
+
+def question_template(question):
+    # ("prime <n> righe della tabella d", ["15"]): numeri e testi tra virgolette diventano segnaposto
+    values = []
+
+    def placeholder(match):
+        if match.group(3) is not None:
+            values.append(match.group(3))
+            return " qqnumeroqq "
+        values.append(match.group(1) if match.group(1) is not None else match.group(2))
+        return " qqtestoqq "
+
+    template = normalize_question(LITERAL_RE.sub(placeholder, question))
+    return template.replace("qqnumeroqq", "<n>").replace("qqtestoqq", "<s>"), values
+
+
+def sql_literal_pattern(value):
+    if NUMBER_RE.fullmatch(value):
+        return re.compile(r"(?<![\w.])" + re.escape(value) + r"(?![\w.])")
+    return re.compile(r"'" + re.escape(value.replace("'", "''")) + r"'")
+
+
+def fill_template(sql, old_values, new_values):
+    # SQL con i nuovi valori al posto dei vecchi, o None se un vecchio valore non compare
+    # esattamente una volta nell'SQL (non si sa a cosa corrisponda) o se un nuovo testo non e'
+    # sicuro da mettere tra apici: la domanda va allora al modello
+    if len(old_values) != len(new_values) or len(set(old_values)) != len(old_values):
+        return None
+    spans = []
+    for old, new in zip(old_values, new_values):
+        matches = list(sql_literal_pattern(old).finditer(sql))
+        if len(matches) != 1:
+            return None
+        is_number = bool(NUMBER_RE.fullmatch(old))
+        if is_number != bool(NUMBER_RE.fullmatch(new)):
+            return None
+        if not is_number and not SAFE_TEXT_RE.fullmatch(new):
+            return None
+        replacement = new if is_number else "'" + new.replace("'", "''") + "'"
+        spans.append((matches[0].start(), matches[0].end(), replacement))
+    for start, end, replacement in sorted(spans, reverse=True):
+        sql = sql[:start] + replacement + sql[end:]
+    return sql
+
+
+def table_hashes(sql, tables):
+    # {tabella usata nell'SQL: hash della sua definizione} per le tabelle del catalogo
+    tokens = set(tokenize(sql))
+    return {name: hashlib.md5(table['rendered'].encode('utf-8')).hexdigest()[:12]
+            for name, table in tables.items() if name.lower() in tokens}
+
+
+class SQLExampleStore:
+    def __init__(self, path, max_examples=2000, min_similarity=0.6):
+        self.path = path
+        self.max_examples = max_examples
+        self.min_similarity = min_similarity
+        self.schema_version = None
+        self.counters = {"few_shot": 0, "template_hits": 0, "recorded": 0, "invalidated": 0, "evicted": 0}
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._cache = None  # (data_version, [(id, domanda, sql)], matrice embedding)
+        self._cache_dirty = True
+
+    def _connection(self):
+        # Una connessione per processo: dopo un fork (gunicorn --preload) se ne apre una nuova
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA_SQL)
+            self._pid = os.getpid()
+            self._cache_dirty = True
+        return self._conn
+
+    def sync_schema(self, schema_version, tables):
+        # Da chiamare con la versione del catalogo: elimina gli esempi su tabelle cambiate o sparite
+        if schema_version is None or schema_version == self.schema_version:
+            return
+        current = {name: hashlib.md5(table['rendered'].encode('utf-8')).hexdigest()[:12]
+                   for name, table in tables.items()}
+        with self._lock:
+            try:
+                conn = self._connection()
+                stale = [row_id for row_id, used in conn.execute("SELECT id, tabelle FROM esempi")
+                         if any(current.get(name) != digest for name, digest in json.loads(used).items())]
+                if stale:
+                    conn.executemany("DELETE FROM esempi WHERE id = ?", [(row_id,) for row_id in stale])
+                    conn.commit()
+                    self.counters["invalidated"] += len(stale)
+                    self._cache_dirty = True
+                    logger.info(f"Schema cambiato: {len(stale)} esempi SQL eliminati.")
+                self.schema_version = schema_version
+            except sqlite3.Error as e:
+                logger.warning(f"Esempi SQL non allineati allo schema: {e}")
+
+    def template_sql(self, question):
+        # (sql, domanda dell'esempio) per una domanda con lo stesso modello di una riuscita, o (None, None)
+        template, values = question_template(question)
+        with self._lock:
+            try:
+                conn = self._connection()
+                rows = conn.execute("SELECT id, valori, domanda, sql FROM esempi WHERE modello = ? AND riuscito = 1 "
+                                    "ORDER BY usato DESC LIMIT 5", (template,)).fetchall()
+                for row_id, stored_values, stored_question, sql in rows:
+                    filled = fill_template(sql, json.loads(stored_values), values)
+                    if filled is not None:
+                        conn.execute("UPDATE esempi SET usato = ?, usi = usi + 1 WHERE id = ?", (time.time(), row_id))
+                        conn.commit()
+                        self.counters["template_hits"] += 1
+                        logger.info(f"SQL dal modello di '{stored_question}': '{filled}'")
+                        return filled, stored_question
+            except sqlite3.Error as e:
+                logger.warning(f"Ricerca del modello SQL fallita: {e}")
+        return None, None
+
+    def _load_cache(self, conn):
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        if self._cache is not None and not self._cache_dirty and self._cache[0] == data_version:
+            return self._cache
+        rows, vectors = [], []
+        for row_id, question, sql, blob in conn.execute(
+                "SELECT id, domanda, sql, embedding FROM esempi WHERE riuscito = 1 AND embedding IS NOT NULL"):
+            rows.append((row_id, question, sql))
+            vectors.append(np.frombuffer(blob, dtype=np.float32))
+        dims = {len(v) for v in vectors}
+        if len(dims) > 1:  # Modello di embedding cambiato: si tengono quelli della dimensione piu' recente
+            dim = len(vectors[-1])
+            rows = [r for r, v in zip(rows, vectors) if len(v) == dim]
+            vectors = [v for v in vectors if len(v) == dim]
+        matrix = np.stack(vectors) if vectors else None
+        if matrix is not None:
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            matrix = matrix / np.where(norms == 0, 1.0, norms)
+        self._cache = (data_version, rows, matrix)
+        self._cache_dirty = False
+        return self._cache
+
+    def similar(self, embedding, n=3):
+        # Fino a n esempi riusciti [{'domanda', 'sql'}] con similarita' >= min_similarity, dal piu' simile
+        if embedding is None or n <= 0:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            try:
+                _, rows, matrix = self._load_cache(self._connection())
+            except sqlite3.Error as e:
+                logger.warning(f"Esempi SQL non disponibili: {e}")
+                return []
+        if matrix is None or matrix.shape[1] != len(query):
+            return []
+        similarities = matrix @ (query / (np.linalg.norm(query) or 1.0))
+        examples = []
+        for idx in np.argsort(-similarities)[:n]:
+            if similarities[idx] < self.min_similarity:
+                break
+            examples.append({'domanda': rows[idx][1], 'sql': rows[idx][2]})
+        if examples:
+            self.counters["few_shot"] += 1
+        return examples
+
+    def record(self, question, sql, success, rows=None, latency_ms=None, embedding=None, tables=None):
+        # success: query eseguita senza errori; diventa un esempio solo con almeno una riga
+        template, values = question_template(question)
+        used = table_hashes(sql, tables or {})
+        succeeded = 1 if success and rows else 0
+        blob = np.asarray(embedding, dtype=np.float32).tobytes() if embedding is not None else None
+        now = time.time()
+        with self._lock:
+            try:
+                conn = self._connection()
+                conn.execute(
+                    "INSERT INTO esempi (chiave, modello, valori, domanda, sql, riuscito, righe, latenza_ms, tabelle, "
+                    "embedding, creato, usato, fallimenti) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT(chiave) DO UPDATE SET modello = excluded.modello, valori = excluded.valori, "
+                    "domanda = excluded.domanda, sql = excluded.sql, riuscito = excluded.riuscito, righe = excluded.righe, "
+                    "latenza_ms = excluded.latenza_ms, tabelle = excluded.tabelle, "
+                    "embedding = COALESCE(excluded.embedding, esempi.embedding), usato = excluded.usato, "
+                    "fallimenti = esempi.fallimenti + excluded.fallimenti",
+                    (normalize_question(question), template, json.dumps(values), question, sql, succeeded, rows,
+                     latency_ms, json.dumps(used), blob, now, now, 0 if succeeded else 1))
+                excess = conn.execute("SELECT COUNT(*) FROM esempi").fetchone()[0] - self.max_examples
+                if excess > 0:
+                    conn.execute("DELETE FROM esempi WHERE id IN (SELECT id FROM esempi ORDER BY riuscito, usato LIMIT ?)",
+                                 (excess,))
+                    self.counters["evicted"] += excess
+                conn.commit()
+                self.counters["recorded"] += 1
+                self._cache_dirty = True
+            except sqlite3.Error as e:
+                logger.warning(f"Impossibile salvare l'esempio SQL per '{question}': {e}")
+
+    def stats(self):
+        with self._lock:
+            try:
+                total, succeeded, avg_latency = self._connection().execute(
+                    "SELECT COUNT(*), COALESCE(SUM(riuscito), 0), AVG(latenza_ms) FROM esempi").fetchone()
+            except sqlite3.Error as e:
+                return {**self.counters, "errore": str(e)}
+            return {**self.counters, "esempi": total, "riusciti": succeeded,
+                    "latenza_media_ms": round(avg_latency, 1) if avg_latency is not None else None}
@@ -0,0 +1,152 @@
+# sql_guard.py
+# Controlli sull'SQL generato prima di eseguirlo: una sola SELECT, niente costrutti
+# pericolosi, LIMIT imposto dal codice, tempo massimo per statement e stima del costo via EXPLAIN.
+import logging
+import re
+
+logger = logging.getLogger("sql_guard")
+
+# Parole vietate fuori dalle stringhe (scritture su file, lock, funzioni per rallentare il server)
+# (INSERT e REPLACE no: sono anche funzioni stringa, e come istruzioni le esclude gia' il controllo sul SELECT)
+FORBIDDEN_WORDS = {"INTO", "OUTFILE", "DUMPFILE", "LOCK", "UPDATE", "SLEEP", "BENCHMARK", "LOAD_FILE", "GET_LOCK"}
+LIMIT_TAIL = re.compile(r"LIMIT\s+(\d+)(?:\s*,\s*(\d+))?(?:\s+OFFSET\s+(\d+))?\s*$", re.IGNORECASE)
+EXECUTION_HINT = re.compile(r"^SELECT /\*\+ MAX_EXECUTION_TIME\(\d+\) \*/") # Aggiunto da prepare_sql
+# Costrutti che obbligano MySQL a leggere tutte le righe prima di poter applicare il LIMIT
+FULL_READ_WORDS = {"ORDER", "GROUP", "DISTINCT", "HAVING", "JOIN", "UNION", "OVER",
+                   "COUNT", "SUM", "AVG", "MIN", "MAX", "GROUP_CONCAT", "STD", "STDDEV", "VARIANCE"}
+
+
+class SQLRejected(Exception):
+    pass
+
+
+def quoted_end(sql, i):
+    # Indice subito dopo la stringa o l'identificatore quotato che inizia in sql[i]
+    quote = sql[i]
+    i += 1
+    while i < len(sql) and sql[i] != quote:
+        i += 2 if sql[i] == '\\' and quote != '`' else 1
+    return i + 1
+
+
+def collapse_whitespace(sql):
+    # Spazi e a capo consecutivi ridotti a uno, tranne dentro stringhe e identificatori quotati
+    # ('Mario  Rossi' resta com'e': e' un altro valore)
+    parts = []
+    i = 0
+    n = len(sql)
+    while i < n:
+        if sql[i] in "'\"`":
+            end = quoted_end(sql, i)
+            parts.append(sql[i:end])
+            i = end
+        elif sql[i].isspace():
+            while i < n and sql[i].isspace():
+                i += 1
+            parts.append(" ")
+        else:
+            start = i
+            while i < n and not sql[i].isspace() and sql[i] not in "'\"`":
+                i += 1
+            parts.append(sql[start:i])
+    return "".join(parts).strip()
+
+
+def scan_sql(sql):
+    # Parole fuori da stringhe e identificatori quotati: [(PAROLA, inizio, profondita' parentesi)].
+    # Solleva SQLRejected per commenti o piu' statement.
+    words = []
+    depth = 0
+    i = 0
+    n = len(sql)
+    while i < n:
+        ch = sql[i]
+        if ch in "'\"`":
+            i = quoted_end(sql, i)
+        elif ch == '(':
+            depth += 1
+            i += 1
+        elif ch == ')':
+            depth -= 1
+            i += 1
+        elif ch == '#' or sql.startswith('--', i) or sql.startswith('/*', i):
+            raise SQLRejected("Commenti non ammessi nell'SQL generato.")
+        elif ch == ';':
+            raise SQLRejected("Ammessa una sola istruzione SQL.")
+        elif ch.isalpha() or ch == '_':
+            start = i
+            while i < n and (sql[i].isalnum() or sql[i] == '_'):
+                i += 1
+            words.append((sql[start:i].upper(), start, depth))
+        else:
+            i += 1
+    return words
+
+
+def prepare_sql(sql, max_rows, max_execution_ms=0):
+    # SQL pronto da eseguire: LIMIT aggiunto o ridotto a max_rows + 1 (la riga in piu' serve
+    # solo a sapere che il risultato e' troncato) e hint MAX_EXECUTION_TIME.
+    sql = sql.strip().rstrip(';').strip()
+    words = scan_sql(sql)
+    if not words or words[0][0] != "SELECT":
+        raise SQLRejected("Permesse solo query SELECT.")
+    forbidden = sorted({w for w, _, _ in words if w in FORBIDDEN_WORDS})
+    if forbidden:
+        raise SQLRejected(f"Costrutti non ammessi nella query: {', '.join(forbidden)}.")
+
+    limit = max_rows + 1
+    top_level_limits = [start for w, start, depth in words if w == "LIMIT" and depth == 0]
+    if top_level_limits:
+        match = LIMIT_TAIL.match(sql, top_level_limits[-1])
+        if not match:
+            raise SQLRejected("LIMIT non riconosciuto nella query.")
+        if match.group(2) is not None: # LIMIT offset, righe
+            offset, count = int(match.group(1)), int(match.group(2))
+        else:
+            offset, count = int(match.group(3) or 0), int(match.group(1))
+        if count > limit:
+            logger.info(f"LIMIT {count} ridotto a {limit}.")
+        sql = f"{sql[:match.start()]}LIMIT {min(count, limit)}" + (f" OFFSET {offset}" if offset else "")
+    else:
+        sql = f"{sql} LIMIT {limit}"
+
+    if max_execution_ms > 0:
+        # Hint per singolo statement (MySQL >= 5.7.8); sugli altri server e' un commento ignorato
+        sql = f"SELECT /*+ MAX_EXECUTION_TIME({int(max_execution_ms)}) */{sql[len('SELECT'):]}"
+    return sql
+
+
+def stops_at_limit(sql):
+    # True se MySQL smette di leggere dopo le righe del LIMIT: LIMIT esterno e niente ordinamenti,
+    # raggruppamenti, DISTINCT, join o aggregati. La stima di EXPLAIN (tutta la tabella) non vale.
+    try:
+        words = scan_sql(EXECUTION_HINT.sub("SELECT", sql.strip()))
+    except SQLRejected:
+        return False
+    has_limit = any(w == "LIMIT" and depth == 0 for w, _, depth in words)
+    return has_limit and not any(w in FULL_READ_WORDS for w, _, _ in words)
+
+
+def check_explain(columns, rows, max_estimated_rows, max_full_scan_rows, sql=None):
+    # Righe di EXPLAIN (formato tabellare): stima delle righe esaminate come prodotto delle
+    # righe per tabella dello stesso SELECT (join annidati), piu' i full scan su tabelle grandi.
+    # Con sql, una sola tabella letta fino al LIMIT (stops_at_limit) non viene rifiutata.
+    # Restituisce il motivo del rifiuto o None.
+    if sql is not None and len(rows) == 1 and stops_at_limit(sql):
+        return None
+    names = [c.lower() for c in columns]
+    estimates = {}
+    for row in rows:
+        info = dict(zip(names, row))
+        table_rows = info.get('rows')
+        if table_rows is None:
+            continue
+        table_rows = int(table_rows)
+        if info.get('type') == 'ALL' and max_full_scan_rows and table_rows > max_full_scan_rows:
+            return f"Scansione completa della tabella {info.get('table')} (circa {table_rows} righe)."
+        select_id = info.get('id')
+        estimates[select_id] = estimates.get(select_id, 1) * max(table_rows, 1)
+    estimated = sum(estimates.values())
+    if max_estimated_rows and estimated > max_estimated_rows:
+        return f"Query troppo costosa (circa {estimated} righe da esaminare)."
+    return None
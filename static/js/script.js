@@ -6,6 +6,15 @@ document.addEventListener('DOMContentLoaded', () => {
     const clearChatButton = document.getElementById('clearChatButton');
     const typingIndicator = document.getElementById('typing-indicator');
 
+    // Id della conversazione: il server tiene lo storico e lo usa per le domande di seguito
+    let sessionId = sessionStorage.getItem('sessione') || newSessionId();
+
+    function newSessionId() {
+        const id = crypto.randomUUID ? crypto.randomUUID() : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+        sessionStorage.setItem('sessione', id);
+        return id;
+    }
+
     const initialBotMessage = "Ciao! Sono pnAI002, il tuo assistente avanzato. Puoi farmi domande sui documenti caricati o sui dati nel database."; // Messaggio aggiornato
 
     function addInitialBotMessage() {
@@ -34,8 +43,7 @@ document.addEventListener('DOMContentLoaded', () => {
         // Per output contenente tabelle o formattazione complessa da SQL, questo potrebbe non essere sufficiente
         // Potresti aver bisogno di librerie come DOMPurify per output HTML più ricco e sicuro
         // o parsareMarkdown se il bot restituisce markdown.
-        const safeText = text.replace(/</g, "&lt;").replace(/>/g, "&gt;");
-        messageBubble.innerHTML = safeText.replace(/\n/g, '<br>');
+        setBubbleText(messageBubble, text);
 
         if (sender === 'user') {
             messageContainer.appendChild(messageBubble);
@@ -47,6 +55,169 @@ document.addEventListener('DOMContentLoaded', () => {
 
         chatbox.appendChild(messageContainer);
         scrollToBottom();
+        return messageBubble;
+    }
+
+    function setBubbleText(messageBubble, text) {
+        const safeText = text.replace(/</g, "&lt;").replace(/>/g, "&gt;");
+        messageBubble.innerHTML = safeText.replace(/\n/g, '<br>');
+    }
+
+    // Legge lo stream SSE di /ask/stream: i token vengono mostrati appena arrivano,
+    // l'evento "done" sostituisce il contenuto con la risposta finale.
+    async function askStream(question) {
+        const response = await fetch('/ask/stream', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ domanda: question, sessione: sessionId }),
+        });
+
+        if (!response.ok || !response.body) {
+            let errorMsg = `Errore Server: ${response.status} ${response.statusText}`;
+            try {
+                const errorData = await response.json();
+                errorMsg = errorData.risposta || errorData.errore || errorMsg;
+            } catch (e) { /* Ignora errore parsing JSON del corpo dell'errore */ }
+            throw new Error(errorMsg);
+        }
+
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        let bubble = null;
+        let streamedText = '';
+
+        while (true) {
+            const { value, done } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+
+            let sep;
+            while ((sep = buffer.indexOf('\n\n')) !== -1) {
+                const rawEvent = buffer.slice(0, sep);
+                buffer = buffer.slice(sep + 2);
+
+                let eventName = 'message';
+                let data = '';
+                for (const line of rawEvent.split('\n')) {
+                    if (line.startsWith('event: ')) eventName = line.slice(7);
+                    else if (line.startsWith('data: ')) data += line.slice(6);
+                }
+                if (!data) continue;
+                const payload = JSON.parse(data);
+
+                if (!bubble) {
+                    hideTypingIndicator();
+                    bubble = addMessage('', 'bot');
+                }
+                if (eventName === 'token') {
+                    streamedText += payload.t;
+                    setBubbleText(bubble, streamedText);
+                    scrollToBottom();
+                } else if (eventName === 'done') {
+                    if (payload.sessione) {
+                        console.log(`Sessione ${payload.sessione.id}: turno ${payload.sessione.turni}, ` +
+                                    `prefill ${payload.sessione.prefill_ms}ms (${payload.sessione.token_prompt} token)`);
+                    }
+                    if (payload.risultato) {
+                        renderResult(bubble, question, payload.risultato);
+                    } else {
+                        setBubbleText(bubble, payload.risposta);
+                    }
+                    scrollToBottom();
+                }
+            }
+        }
+    }
+
+    // Risultato SQL come tabella: colonne tipizzate, pagine richieste a /ask ripetendo la domanda
+    // (l'SQL arriva dalla cache del server) e download CSV del risultato completo.
+    function renderResult(bubble, question, risultato) {
+        bubble.innerHTML = '';
+        const sqlLine = document.createElement('div');
+        sqlLine.classList.add('small', 'text-muted', 'mb-2');
+        sqlLine.textContent = `SQL: ${risultato.sql}`;
+        bubble.appendChild(sqlLine);
+
+        if (!risultato.righe.length) {
+            const empty = document.createElement('div');
+            empty.textContent = 'Query eseguita, nessun risultato.';
+            bubble.appendChild(empty);
+            return;
+        }
+
+        const wrapper = document.createElement('div');
+        wrapper.classList.add('table-responsive');
+        const table = document.createElement('table');
+        table.classList.add('table', 'table-sm', 'table-striped', 'mb-2');
+        const headRow = table.createTHead().insertRow();
+        for (const col of risultato.colonne) {
+            const th = document.createElement('th');
+            th.textContent = col.nome;
+            headRow.appendChild(th);
+        }
+        const body = table.createTBody();
+        for (const riga of risultato.righe) {
+            const tr = body.insertRow();
+            riga.forEach((valore, i) => {
+                const td = tr.insertCell();
+                td.textContent = valore === null ? '' : valore;
+                if (risultato.colonne[i].tipo === 'numero') td.classList.add('text-end');
+            });
+        }
+        wrapper.appendChild(table);
+        bubble.appendChild(wrapper);
+
+        const footer = document.createElement('div');
+        footer.classList.add('d-flex', 'align-items-center', 'gap-2', 'small');
+        const info = document.createElement('span');
+        info.textContent = `Pagina ${risultato.pagina} di ${risultato.pagine} (${risultato.righe_totali} righe${risultato.troncato ? ', risultato troncato' : ''})`;
+        footer.appendChild(info);
+        if (risultato.pagina > 1) {
+            footer.appendChild(pageButton('Precedente', () => loadPage(bubble, question, risultato.pagina - 1)));
+        }
+        if (risultato.pagina < risultato.pagine) {
+            footer.appendChild(pageButton('Successiva', () => loadPage(bubble, question, risultato.pagina + 1)));
+        }
+        footer.appendChild(pageButton('CSV', () => downloadCsv(question)));
+        bubble.appendChild(footer);
+    }
+
+    function pageButton(label, onClick) {
+        const button = document.createElement('button');
+        button.type = 'button';
+        button.classList.add('btn', 'btn-outline-secondary', 'btn-sm');
+        button.textContent = label;
+        button.addEventListener('click', onClick);
+        return button;
+    }
+
+    async function loadPage(bubble, question, pagina) {
+        const response = await fetch('/ask', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ domanda: question, pagina: pagina, sessione: sessionId }),
+        });
+        const data = await response.json();
+        if (data.risultato) {
+            renderResult(bubble, question, data.risultato);
+        } else {
+            setBubbleText(bubble, data.risposta);
+        }
+    }
+
+    async function downloadCsv(question) {
+        const response = await fetch('/ask', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ domanda: question, formato: 'csv', sessione: sessionId }),
+        });
+        const blob = await response.blob();
+        const link = document.createElement('a');
+        link.href = URL.createObjectURL(blob);
+        link.download = 'risultato.csv';
+        link.click();
+        URL.revokeObjectURL(link.href);
     }
 
     function showTypingIndicator() {
@@ -77,26 +248,7 @@ document.addEventListener('DOMContentLoaded', () => {
         showTypingIndicator();
 
         try {
-            const response = await fetch('/ask', { // L'endpoint è '/ask' come definito in app.py
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ domanda: question }), // 'domanda' è la chiave attesa da app.py
-            });
-
-            hideTypingIndicator(); // Nascondi appena arriva la risposta (anche errore HTTP)
-
-            if (!response.ok) {
-                let errorMsg = `Errore Server: ${response.status} ${response.statusText}`;
-                try {
-                    const errorData = await response.json();
-                    errorMsg = errorData.risposta || errorData.errore || errorMsg; // 'risposta' è la chiave usata da app.py per i messaggi
-                } catch (e) { /* Ignora errore parsing JSON del corpo dell'errore */ }
-                 throw new Error(errorMsg);
-            }
-
-            const data = await response.json();
-            addMessage(data.risposta, 'bot'); // 'risposta' è la chiave usata da app.py per i messaggi di successo
-
+            await askStream(question);
         } catch (error) {
             hideTypingIndicator(); // Assicurati sia nascosto in caso di errore fetch
             console.error('Errore nella richiesta /ask:', error);
@@ -110,6 +262,8 @@ document.addEventListener('DOMContentLoaded', () => {
     });
 
     clearChatButton.addEventListener('click', () => {
+         fetch(`/sessione/${encodeURIComponent(sessionId)}`, { method: 'DELETE' }).catch(() => {});
+         sessionId = newSessionId();
          chatbox.innerHTML = '';
          hideTypingIndicator();
          addInitialBotMessage();
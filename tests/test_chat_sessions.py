@@ -0,0 +1,27 @@
+# test_chat_sessions.py
+import os
+import time
+
+from chat_sessions import ChatSession, SessionStore
+
+
+def test_save_purges_expired_session_files(tmp_path):
+    store = SessionStore(str(tmp_path), ttl_seconds=60, purge_every=2)
+    store.save(ChatSession("vecchia"))
+    old_path = tmp_path / "vecchia.json"
+    past = time.time() - 3600
+    os.utime(old_path, (past, past))
+
+    store.save(ChatSession("nuova"))  # Secondo salvataggio: pulizia
+
+    assert not old_path.exists()
+    assert (tmp_path / "nuova.json").exists()
+
+
+def test_purge_every_zero_keeps_files(tmp_path):
+    store = SessionStore(str(tmp_path), ttl_seconds=60, purge_every=0)
+    store.save(ChatSession("vecchia"))
+    past = time.time() - 3600
+    os.utime(tmp_path / "vecchia.json", (past, past))
+    store.save(ChatSession("nuova"))
+    assert (tmp_path / "vecchia.json").exists()
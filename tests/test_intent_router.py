@@ -0,0 +1,101 @@
+# test_intent_router.py
+import hashlib
+
+import numpy as np
+import pytest
+
+from intent_router import INTENT_CHAT, INTENT_DB, INTENT_DOCS, IntentRouter
+
+
+def fake_embedding(text, dim=256):
+    # Come benchmark/fake_ollama.py: parole -> componenti, domande simili -> vettori simili
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in text.lower().split():
+        vector[int(hashlib.md5(word.encode('utf-8')).hexdigest(), 16) % dim] += 1.0
+    return vector
+
+
+LABELLED = [(f"elenca da tabella t_{n:04d} le righe con valore alto", INTENT_DB) for n in (3, 17, 42)] + \
+    [(f"query sulla tabella t_{n:04d} ordinata per valore", INTENT_DB) for n in (1, 8, 25)] + \
+    [(f"dati di t_{n:04d}: quali elementi hanno il valore maggiore?", INTENT_DB) for n in (5, 30)] + [
+    ("quanti clienti abbiamo a Torino", INTENT_DB),
+    ("scrivi una query SQL per le fatture scadute", INTENT_DB),
+    ("cosa dice il manuale sulle ferie estive", INTENT_DOCS),
+    ("qual e' la procedura per richiedere un permesso", INTENT_DOCS),
+    ("come si configura la VPN secondo la guida", INTENT_DOCS),
+    ("cosa prevede il regolamento per le trasferte", INTENT_DOCS),
+    ("riassumi la circolare sul lavoro agile", INTENT_DOCS),
+    ("ciao MariaCarla", INTENT_CHAT),
+    ("buongiorno a te", INTENT_CHAT),
+    ("arrivederci e grazie", INTENT_CHAT),
+]
+
+
+@pytest.fixture(scope="module")
+def router():
+    router = IntentRouter(lambda texts: [fake_embedding(t) for t in texts])
+    assert router.train()
+    return router
+
+
+def route(router, question, llm_answer=None):
+    intent, confidence, source, classify_ms = router.first_pass(question, fake_embedding(question))
+    return router.finish(question, intent, confidence, source, llm_answer)
+
+
+def test_calibrated_scale_leaves_room_for_the_fallback(router):
+    assert router.scale < 20.0
+    confidences = [router.classify(fake_embedding(q), q)[1] for q, _ in LABELLED]
+    assert min(confidences) < 0.99
+
+
+def test_labelled_questions(router):
+    # Senza modello: basta embedding + parole chiave per le domande etichettate,
+    # e nessuna domanda sul database finisce sicura tra i documenti
+    results = [(route(router, q), expected) for q, expected in LABELLED]
+    correct = sum(intent == expected for (intent, _, _), expected in results)
+    assert correct / len(LABELLED) >= 0.9
+    assert all(intent == INTENT_DB for (intent, _, _), expected in results if expected == INTENT_DB)
+
+
+def test_strong_keyword_raises_db_probability(router):
+    question = "query sulla tabella t_0001 ordinata per valore"
+    embedding = fake_embedding(question)
+    without_prior = router.classify(embedding)
+    with_prior = router.classify(embedding, question)
+    assert with_prior[0] == INTENT_DB
+    assert without_prior[0] != INTENT_DB or with_prior[1] > without_prior[1]
+
+
+def test_llm_answer_decides_when_uncertain(router):
+    intent, confidence, source, classify_ms = router.first_pass("boh", fake_embedding("boh"))
+    assert router.uncertain(intent, confidence)
+    assert router.needs_llm(intent, confidence, source)
+    assert router.finish("boh", intent, confidence, source, "documenti")[:3:2] == (INTENT_DOCS, "llm")
+
+
+def test_fixed_scale_is_kept():
+    router = IntentRouter(lambda texts: [fake_embedding(t) for t in texts], scale=20.0)
+    router.train()
+    assert router.scale == 20.0
+
+
+def test_untrained_router_uses_keywords_without_llm():
+    router = IntentRouter(lambda texts: [fake_embedding(t) for t in texts])
+    intent, confidence, source, _ = router.first_pass("quante righe ha la tabella ordini", None)
+    assert (intent, source) == (INTENT_DB, "parole_chiave")
+    assert not router.needs_llm(intent, confidence, source)
+
+
+def test_log_failure_does_not_raise(tmp_path):
+    router = IntentRouter(None, log_path=str(tmp_path / "manca" / "intent_log.jsonl"))
+    router.log("ciao", INTENT_CHAT, 0.9, "embedding", 0.1)
+
+
+def test_log_is_rotated_above_max_bytes(tmp_path):
+    log_path = tmp_path / "intent_log.jsonl"
+    router = IntentRouter(None, log_path=str(log_path), log_max_bytes=200)
+    for _ in range(5):
+        router.log("quante righe ha la tabella ordini", INTENT_DB, 0.9, "embedding", 0.1)
+    assert (tmp_path / "intent_log.jsonl.1").exists()
+    assert log_path.stat().st_size <= 200 + 200
@@ -0,0 +1,140 @@
+# test_result_cache.py
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+import pytest
+
+from result_cache import TABLE_TIMES_QUERY, ResultCache
+
+
+class FakeCursor:
+    def __init__(self, db):
+        self.db = db
+        self.rows = []
+
+    def execute(self, sql):
+        if sql == TABLE_TIMES_QUERY:
+            self.rows = [(name, update_time, age) for name, (update_time, age) in self.db.tables.items()]
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class FakeDB:
+    # UPDATE_TIME e secondi dall'ultima scrittura per tabella, modificabili dal test
+    def __init__(self, **tables):
+        self.tables = {name: ("2026-01-01 10:00:00", 3600) for name in tables} if tables else {}
+
+    def write(self, name, update_time):
+        self.tables[name] = (update_time, 0)
+
+    @contextmanager
+    def connection(self):
+        yield self
+
+    def cursor(self):
+        return FakeCursor(self)
+
+
+def result(n):
+    return {"columns": [{"nome": "id", "tipo": "numero"}], "rows": [[i] for i in range(n)], "rowcount": n}
+
+
+def cached(cache, sql, value):
+    hit, ticket = cache.lookup(sql)
+    assert hit is None and ticket is not None
+    cache.store(ticket, value)
+
+
+@pytest.fixture
+def db():
+    return FakeDB(clienti=True, ordini=True)
+
+
+def test_hit_until_the_table_changes(db):
+    cache = ResultCache(db.connection, check_seconds=0)
+    cached(cache, "SELECT * FROM clienti", result(3))
+    assert cache.lookup("SELECT  *  FROM clienti;")[0] == result(3)
+    db.write("ordini", "2026-01-01 11:00:00")
+    assert cache.lookup("SELECT * FROM clienti")[0] == result(3)  # Scrittura su un'altra tabella
+    db.tables["clienti"] = ("2026-01-01 11:00:00", 3600)
+    hit, _ = cache.lookup("SELECT * FROM clienti")
+    assert hit is None
+    assert cache.stats()["invalidated"] == 1
+
+
+def test_join_invalidated_by_either_table(db):
+    cache = ResultCache(db.connection, check_seconds=0)
+    cached(cache, "SELECT * FROM clienti JOIN ordini ON ordini.cliente = clienti.id", result(2))
+    db.tables["ordini"] = ("2026-01-01 12:00:00", 3600)
+    assert cache.lookup("SELECT * FROM clienti JOIN ordini ON ordini.cliente = clienti.id")[0] is None
+
+
+@pytest.mark.parametrize("sql", ["SELECT * FROM clienti WHERE creato > NOW()", "SELECT RAND() FROM clienti",
+                                 "SELECT 1"])
+def test_not_cacheable(db, sql):
+    cache = ResultCache(db.connection, check_seconds=0)
+    assert cache.lookup(sql) == (None, None)
+
+
+def test_recent_write_not_cached(db):
+    db.write("clienti", "2026-01-01 10:00:05")
+    cache = ResultCache(db.connection, check_seconds=0)
+    assert cache.lookup("SELECT * FROM clienti") == (None, None)
+
+
+def test_expired_after_ttl(db):
+    cache = ResultCache(db.connection, ttl_seconds=0, check_seconds=0)
+    cached(cache, "SELECT * FROM clienti", result(1))
+    assert cache.lookup("SELECT * FROM clienti")[0] is None
+    assert cache.stats()["expired"] == 1
+
+
+def test_db_unavailable_skips_cache():
+    @contextmanager
+    def broken():
+        raise ConnectionError("giu'")
+        yield
+    cache = ResultCache(broken, check_seconds=0)
+    assert cache.lookup("SELECT * FROM clienti") == (None, None)
+
+
+def test_spill_to_disk_and_back(db, tmp_path):
+    one_result = len(json.dumps(result(20), ensure_ascii=False).encode('utf-8'))
+    cache = ResultCache(db.connection, max_bytes=one_result + 10, check_seconds=0, spill_dir=str(tmp_path))
+    cached(cache, "SELECT * FROM clienti", result(20))
+    cached(cache, "SELECT * FROM ordini", result(20))  # La prima esce dalla memoria e va su disco
+    assert cache.stats()["spilled"] == 1
+    assert cache.lookup("SELECT * FROM clienti")[0] == result(20)
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_disk_bytes_consistent_under_concurrency(db, tmp_path):
+    cache = ResultCache(db.connection, max_bytes=1, check_seconds=60, spill_dir=str(tmp_path), max_disk_bytes=3000)
+    cache.lookup("SELECT * FROM clienti")  # Legge gli UPDATE_TIME una volta
+
+    def worker(n):
+        for i in range(30):
+            cached(cache, f"SELECT * FROM clienti WHERE id = {n * 100 + i}", result(5))
+            cache.lookup(f"SELECT * FROM clienti WHERE id = {n * 100 + i // 2}")
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    on_disk = sum(entry.stat().st_size for entry in os.scandir(tmp_path) if entry.name.endswith('.json'))
+    assert cache.stats()["disk_bytes"] == on_disk
+    assert on_disk <= 3000 + 1000
+
+
+def test_bytes_counts_utf8_bytes(db):
+    cache = ResultCache(db.connection, check_seconds=0)
+    value = {"columns": [{"nome": "città", "tipo": "testo"}], "rows": [["perché già così"]], "rowcount": 1}
+    cached(cache, "SELECT * FROM clienti", value)
+    assert cache.stats()["bytes"] == len(json.dumps(value, ensure_ascii=False).encode('utf-8'))
@@ -0,0 +1,45 @@
+# test_sql_examples.py
+import pytest
+
+from sql_examples import SQLExampleStore, fill_template, question_template
+
+SQL = "SELECT * FROM d WHERE nome = 'Rossi' AND valore > 5"
+
+
+def test_question_template():
+    assert question_template("righe di d con nome 'Rossi' e valore 5") == ("righe di d con nome <s> e valore <n>", ["Rossi", "5"])
+
+
+@pytest.mark.parametrize("new_values, expected", [
+    (["Bianchi", "3"], "SELECT * FROM d WHERE nome = 'Bianchi' AND valore > 3"),
+    (["D'Amico", "3"], "SELECT * FROM d WHERE nome = 'D''Amico' AND valore > 3"),
+    (["x' OR '1'='1", "3"], "SELECT * FROM d WHERE nome = 'x'' OR ''1''=''1' AND valore > 3"),
+    (["", "3.5"], "SELECT * FROM d WHERE nome = '' AND valore > 3.5"),
+])
+def test_fill_template_quotes_values(new_values, expected):
+    assert fill_template(SQL, ["Rossi", "5"], new_values) == expected
+
+
+@pytest.mark.parametrize("new_values", [
+    ["x\\", "3"],              # 'x\' chiuderebbe la stringa con il backslash attivo
+    ["a\\' OR 1=1 -- ", "3"],
+    ["riga\nnuova", "3"],
+    ["Bianchi", "tre"],         # Numero al posto di numero
+    ["7", "3"],                 # Testo al posto di testo
+    ["Bianchi"],
+])
+def test_fill_template_rejects(new_values):
+    assert fill_template(SQL, ["Rossi", "5"], new_values) is None
+
+
+def test_fill_template_needs_one_occurrence():
+    assert fill_template("SELECT * FROM d WHERE a > 5 AND b > 5", ["5"], ["3"]) is None
+    assert fill_template("SELECT * FROM d WHERE a > 15", ["5"], ["3"]) is None
+
+
+def test_template_sql_from_recorded_example(tmp_path):
+    store = SQLExampleStore(str(tmp_path / "esempi.sqlite3"))
+    store.record("righe di d con nome 'Rossi' e valore 5", SQL, True, rows=2)
+    assert store.template_sql("righe di d con nome 'Verdi' e valore 8") == (
+        "SELECT * FROM d WHERE nome = 'Verdi' AND valore > 8", "righe di d con nome 'Rossi' e valore 5")
+    assert store.template_sql("righe di d con nome 'x\\' e valore 3") == (None, None)
@@ -0,0 +1,112 @@
+# test_sql_guard.py
+import pytest
+
+from sql_guard import SQLRejected, check_explain, collapse_whitespace, prepare_sql
+
+
+@pytest.mark.parametrize("sql, expected", [
+    ("SELECT * FROM d", "SELECT * FROM d LIMIT 11"),
+    ("SELECT * FROM d;", "SELECT * FROM d LIMIT 11"),
+    ("SELECT * FROM d LIMIT 5", "SELECT * FROM d LIMIT 5"),
+    ("SELECT * FROM d LIMIT 500", "SELECT * FROM d LIMIT 11"),
+    ("SELECT * FROM d LIMIT 20, 500", "SELECT * FROM d LIMIT 11 OFFSET 20"),
+    ("SELECT * FROM d LIMIT 500 OFFSET 20", "SELECT * FROM d LIMIT 11 OFFSET 20"),
+    ("select * from d limit 3", "select * from d LIMIT 3"),
+])
+def test_limit_added_or_clamped(sql, expected):
+    assert prepare_sql(sql, 10) == expected
+
+
+def test_limit_in_subquery_is_not_the_outer_limit():
+    sql = "SELECT * FROM (SELECT id FROM d LIMIT 500) AS x"
+    assert prepare_sql(sql, 10) == sql + " LIMIT 11"
+
+
+def test_max_execution_hint():
+    assert prepare_sql("SELECT id FROM d", 10, 2000) == "SELECT /*+ MAX_EXECUTION_TIME(2000) */ id FROM d LIMIT 11"
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM d; DROP TABLE d",
+    "SELECT * FROM d; SELECT * FROM e",
+])
+def test_multiple_statements_rejected(sql):
+    with pytest.raises(SQLRejected, match="una sola istruzione"):
+        prepare_sql(sql, 10)
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM d -- commento",
+    "SELECT * FROM d # commento",
+    "SELECT /* commento */ * FROM d",
+])
+def test_comments_rejected(sql):
+    with pytest.raises(SQLRejected, match="Commenti"):
+        prepare_sql(sql, 10)
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM d FOR UPDATE",
+    "SELECT * FROM d LOCK IN SHARE MODE",
+    "SELECT * INTO OUTFILE '/tmp/x' FROM d",
+    "SELECT SLEEP(10)",
+])
+def test_forbidden_constructs_rejected(sql):
+    with pytest.raises(SQLRejected, match="Costrutti non ammessi"):
+        prepare_sql(sql, 10)
+
+
+@pytest.mark.parametrize("sql", ["DELETE FROM d", "UPDATE d SET a = 1", "DROP TABLE d", ""])
+def test_only_select_allowed(sql):
+    with pytest.raises(SQLRejected):
+        prepare_sql(sql, 10)
+
+
+def test_keywords_inside_strings_are_allowed():
+    sql = "SELECT * FROM d WHERE nota = 'update; -- into' LIMIT 2"
+    assert prepare_sql(sql, 10) == sql
+
+
+def test_check_explain():
+    columns = ["id", "table", "type", "rows"]
+    assert check_explain(columns, [(1, "d", "ref", 10)], 1000, 1000) is None
+    assert "Scansione completa" in check_explain(columns, [(1, "d", "ALL", 5000)], 0, 1000)
+    assert "troppo costosa" in check_explain(columns, [(1, "d", "ref", 100), (1, "e", "ref", 100)], 1000, 0)
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM big LIMIT 15",
+    "SELECT id, nome FROM big WHERE citta = 'Milano' LIMIT 11",
+    "SELECT /*+ MAX_EXECUTION_TIME(2000) */ * FROM big LIMIT 11",
+])
+def test_full_scan_with_limit_is_allowed(sql):
+    columns = ["id", "table", "type", "rows"]
+    assert check_explain(columns, [(1, "big", "ALL", 5_000_000)], 1000, 1000, sql) is None
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM big ORDER BY nome LIMIT 15",
+    "SELECT citta, COUNT(*) FROM big GROUP BY citta LIMIT 15",
+    "SELECT COUNT(*) FROM big LIMIT 15",
+    "SELECT DISTINCT citta FROM big LIMIT 15",
+    "SELECT * FROM big",
+])
+def test_full_scan_that_reads_everything_is_rejected(sql):
+    columns = ["id", "table", "type", "rows"]
+    assert "Scansione completa" in check_explain(columns, [(1, "big", "ALL", 5_000_000)], 0, 1000, sql)
+
+
+def test_join_with_limit_is_still_checked():
+    columns = ["id", "table", "type", "rows"]
+    rows = [(1, "big", "ALL", 5_000_000), (1, "d", "ref", 10)]
+    assert "Scansione completa" in check_explain(columns, rows, 0, 1000, "SELECT * FROM big JOIN d ON d.id = big.d_id LIMIT 15")
+
+
+@pytest.mark.parametrize("sql, expected", [
+    ("SELECT *\n  FROM d\tWHERE a = 1 ", "SELECT * FROM d WHERE a = 1"),
+    ("SELECT * FROM d WHERE nome = 'Mario  Rossi'", "SELECT * FROM d WHERE nome = 'Mario  Rossi'"),
+    ("SELECT  `col  x`\nFROM d WHERE n = \"a\n b\"", "SELECT `col  x` FROM d WHERE n = \"a\n b\""),
+    ("SELECT * FROM d WHERE n = 'l\\'a  b'   LIMIT 2", "SELECT * FROM d WHERE n = 'l\\'a  b' LIMIT 2"),
+])
+def test_collapse_whitespace_keeps_literals(sql, expected):
+    assert collapse_whitespace(sql) == expected
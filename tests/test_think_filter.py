@@ -0,0 +1,41 @@
+# test_think_filter.py
+import pytest
+
+from think_filter import ThinkFilter, strip_think
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("risposta", "risposta"),
+    ("<think>ragiono</think>risposta", "risposta"),
+    ("prima <think>a</think>in mezzo<think>b</think> dopo", "prima in mezzo dopo"),
+    ("risposta<think>non chiuso", "risposta"),
+    ("ragionamento senza apertura</think>risposta", "risposta"),
+])
+def test_strip_think(text, expected):
+    assert strip_think(text) == expected
+
+
+def stream(chunks):
+    think_filter = ThinkFilter()
+    return "".join(think_filter.feed(chunk) for chunk in chunks) + think_filter.flush()
+
+
+def test_stream_tag_split_across_chunks():
+    assert stream(["<thi", "nk>ragiono</th", "ink>ris", "posta"]) == "risposta"
+    assert stream(list("<think>x</think>ciao")) == "ciao"
+
+
+def test_stream_keeps_text_that_only_looks_like_a_tag():
+    assert stream(["a <", "b e <t", "abella>"]) == "a <b e <tabella>"
+    assert stream(["fine <thi"]) == "fine <thi"
+
+
+def test_stream_drops_unclosed_think_block():
+    assert stream(["risposta<think>", "ragionamento"]) == "risposta"
+
+
+def test_stream_drops_reasoning_before_lone_close_tag():
+    assert stream(["ragiono", "</think>risposta"]) == "risposta"
+    assert stream(list("ragiono</think>ciao")) == "ciao"
+    think_filter = ThinkFilter()
+    assert think_filter.feed("ragiono</think>risposta") == "risposta"
@@ -0,0 +1,74 @@
+# think_filter.py
+# Rimozione del blocco <think>...</think> prodotto da qwen3, sia a testo completo
+# sia token per token durante lo streaming.
+
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+
+
+def strip_think(text):
+    while True:
+        start = text.find(THINK_OPEN)
+        if start == -1:
+            break
+        end = text.find(THINK_CLOSE, start)
+        if end == -1:
+            text = text[:start]
+            break
+        text = text[:start] + text[end + len(THINK_CLOSE):]
+    # Tag di chiusura senza apertura (il template del modello a volte la mette gia' nel prompt)
+    if THINK_CLOSE in text:
+        text = text.split(THINK_CLOSE)[-1]
+    return text
+
+
+class ThinkFilter:
+    # Riceve i pezzi di testo man mano che arrivano e restituisce solo la parte visibile.
+    # Un tag puo' arrivare spezzato su piu' pezzi: la coda che potrebbe essere l'inizio
+    # di un tag viene trattenuta finche' non si sa cosa sia.
+    # Se il template di qwen3 ha gia' messo <think> nel prompt, il modello manda solo </think>:
+    # per questo l'inizio dello stream viene trattenuto finche' non arriva il primo tag
+    # (o la fine dello stream) e con un </think> senza apertura si scarta tutto quello che c'era prima.
+    def __init__(self):
+        self.in_think = False
+        self.pending = ""
+        self.started = False
+
+    def feed(self, chunk):
+        text = self.pending + chunk
+        self.pending = ""
+        if not self.started:
+            open_pos = text.find(THINK_OPEN)
+            close_pos = text.find(THINK_CLOSE)
+            if close_pos != -1 and (open_pos == -1 or close_pos < open_pos):
+                text = text[close_pos + len(THINK_CLOSE):]
+            elif open_pos == -1:
+                self.pending = text
+                return ""
+            self.started = True
+        output = []
+        while text:
+            tag = THINK_CLOSE if self.in_think else THINK_OPEN
+            pos = text.find(tag)
+            if pos != -1:
+                if not self.in_think:
+                    output.append(text[:pos])
+                text = text[pos + len(tag):]
+                self.in_think = not self.in_think
+                continue
+            # Nessun tag completo: trattieni un eventuale prefisso di tag in coda
+            keep = 0
+            for i in range(1, len(tag)):
+                if text.endswith(tag[:i]):
+                    keep = i
+            if not self.in_think:
+                output.append(text[:len(text) - keep])
+            self.pending = text[len(text) - keep:]
+            break
+        return "".join(output)
+
+    def flush(self):
+        # Stream finito senza tag: tutto quello trattenuto era testo visibile
+        text = "" if self.in_think else self.pending
+        self.pending = ""
+        return text
@@ -0,0 +1,297 @@
+# vector_index.py
+# Indice vettoriale locale dei chunk, alternativo a Chroma per la ricerca: i vettori normalizzati
+# stanno in float16 o int8 (con una scala per riga) in un .npy aperto in memory-map, cosi' il
+# sistema operativo carica solo le pagine lette e l'avvio non cresce con il corpus. Testi e
+# metadati sono in un JSONL letto per offset, gli id in un JSON accanto.
+# Con ivf_lists > 0 i chunk sono raggruppati per centroide (k-means) e la ricerca visita solo
+# i gruppi piu' vicini alla domanda: utile sopra qualche centinaio di migliaia di chunk.
+# Si esporta dalla collezione Chroma con export_from_chroma (create_vectorstore_docs.py --local-index).
+import json
+import logging
+import mmap
+import os
+import shutil
+import time
+
+import numpy as np
+
+logger = logging.getLogger("vector_index")
+
+LOCAL_INDEX_DIRNAME = "indice_locale" # Dentro la cartella del vector store
+INDEX_VERSION = 1
+DTYPES = ("float16", "int8")
+SEARCH_BLOCK_ROWS = 8192 # Righe convertite in float32 per volta durante la ricerca esaustiva
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE = 50000 # Vettori usati per addestrare i centroidi IVF
+
+
+def normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def quantize(vectors, dtype):
+    # Vettori normalizzati -> (dati, scale per riga o None). int8: scala = max assoluto / 127
+    if dtype == "float16":
+        return vectors.astype(np.float16), None
+    scales = np.abs(vectors).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+
+def dequantize(vectors, scales, start, stop):
+    block = np.asarray(vectors[start:stop], dtype=np.float32)
+    if scales is not None:
+        block *= scales[start:stop, None]
+    return block
+
+
+def nearest(vectors, centroids):
+    # Centroide piu' vicino (coseno) per ogni vettore, a blocchi
+    assign = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), SEARCH_BLOCK_ROWS):
+        assign[start:start + SEARCH_BLOCK_ROWS] = np.argmax(vectors[start:start + SEARCH_BLOCK_ROWS] @ centroids.T, axis=1)
+    return assign
+
+
+def kmeans(vectors, n_lists, iterations=KMEANS_ITERATIONS, seed=0):
+    rng = np.random.default_rng(seed)
+    sample = vectors if len(vectors) <= KMEANS_SAMPLE else vectors[rng.choice(len(vectors), KMEANS_SAMPLE, replace=False)]
+    centroids = sample[rng.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assign = nearest(sample, centroids)
+        for i in range(n_lists):
+            members = sample[assign == i]
+            if len(members):
+                centroids[i] = members.mean(axis=0)
+        centroids = normalize(centroids)
+    return centroids.astype(np.float32)
+
+
+def shrink_npy(array, path, rows):
+    # Prime `rows` righe di un .npy memory-mapped in un file della misura giusta, a blocchi
+    tmp_path = path + ".tmp"
+    shrunk = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=array.dtype, shape=(rows,) + array.shape[1:])
+    for start in range(0, rows, SEARCH_BLOCK_ROWS):
+        shrunk[start:start + SEARCH_BLOCK_ROWS] = array[start:min(start + SEARCH_BLOCK_ROWS, rows)]
+    shrunk.flush()
+    del array, shrunk
+    os.replace(tmp_path, path)
+    return np.load(path, mmap_mode='r+')
+
+
+def read_meta(index_dir):
+    try:
+        with open(os.path.join(index_dir, "meta.json"), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def export_from_chroma(collection, index_dir, dtype="float16", ivf_lists=0, page_size=5000, fingerprint=None):
+    # Scrive l'indice in una cartella temporanea e la sostituisce a quella vecchia solo alla fine.
+    # fingerprint: impronta della collezione esportata (manifest_fingerprint), controllata da load()
+    if dtype not in DTYPES:
+        raise ValueError(f"Tipo non supportato per l'indice locale: {dtype} (usa {', '.join(DTYPES)})")
+    start = time.time()
+    count = collection.count()
+    if not count:
+        logger.warning("Collezione vuota: indice locale non creato.")
+        return None
+    tmp_dir = index_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    vectors = scales = None
+    ids = []
+    offsets = [0]
+    with open(os.path.join(tmp_dir, "chunks.jsonl"), 'wb') as f:
+        while len(ids) < count:
+            page = collection.get(include=['embeddings', 'documents', 'metadatas'], limit=page_size, offset=len(ids))
+            if not len(page['ids']):
+                break
+            data, page_scales = quantize(normalize(np.asarray(page['embeddings'], dtype=np.float32)), dtype)
+            if vectors is None:
+                vectors = np.lib.format.open_memmap(os.path.join(tmp_dir, "vectors.npy"), mode='w+',
+                                                    dtype=data.dtype, shape=(count, data.shape[1]))
+                scales = np.ones(count, dtype=np.float32) if page_scales is not None else None
+            n = min(len(data), count - len(ids))
+            vectors[len(ids):len(ids) + n] = data[:n]
+            if scales is not None:
+                scales[len(ids):len(ids) + n] = page_scales[:n]
+            for doc_id, text, metadata in list(zip(page['ids'], page['documents'], page['metadatas']))[:n]:
+                line = json.dumps({'text': text or "", 'metadata': metadata or {}}, ensure_ascii=False).encode('utf-8') + b"\n"
+                f.write(line)
+                offsets.append(offsets[-1] + len(line))
+                ids.append(doc_id)
+    if len(ids) < count:
+        # Collezione cambiata durante l'export: il file dei vettori va riscritto con le sole righe lette
+        logger.warning(f"Esportati {len(ids)} chunk su {count} previsti: collezione modificata durante l'export.")
+        if not ids:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return None
+        vectors = shrink_npy(vectors, os.path.join(tmp_dir, "vectors.npy"), len(ids))
+    vectors.flush()
+    count = len(ids)
+    if scales is not None:
+        np.save(os.path.join(tmp_dir, "scales.npy"), scales[:count])
+    np.save(os.path.join(tmp_dir, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+    with open(os.path.join(tmp_dir, "ids.json"), 'w', encoding='utf-8') as f:
+        json.dump(ids, f)
+
+    ivf_lists = min(ivf_lists, count)
+    if ivf_lists:
+        full = dequantize(vectors, scales, 0, count)
+        centroids = kmeans(full, ivf_lists)
+        assign = nearest(full, centroids)
+        rows = np.argsort(assign, kind='stable').astype(np.int64)
+        list_offsets = np.searchsorted(assign[rows], np.arange(ivf_lists + 1)).astype(np.int64)
+        np.save(os.path.join(tmp_dir, "ivf_centroids.npy"), centroids)
+        np.save(os.path.join(tmp_dir, "ivf_rows.npy"), rows)
+        np.save(os.path.join(tmp_dir, "ivf_offsets.npy"), list_offsets)
+    dim = vectors.shape[1]
+    del vectors
+
+    meta = {'versione': INDEX_VERSION, 'dtype': dtype, 'dim': dim, 'count': count, 'ivf_lists': ivf_lists,
+            'impronta': fingerprint, 'creato': time.time()}
+    with open(os.path.join(tmp_dir, "meta.json"), 'w', encoding='utf-8') as f:
+        json.dump(meta, f)
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(tmp_dir, index_dir)
+    logger.info(f"Indice locale {dtype} di {count} chunk (dim {dim}, IVF {ivf_lists or 'no'}) "
+                f"creato in {time.time() - start:.2f} secondi.")
+    return meta
+
+
+class LocalVectorIndex:
+    # Solo lettura: stessa interfaccia minima usata da DocumentRetriever su Chroma (search + get)
+    def __init__(self, index_dir, nprobe=8):
+        self.index_dir = index_dir
+        self.nprobe = nprobe
+        self.meta = None
+        self.vectors = None
+        self.scales = None
+        self.ids = []
+        self.rows = {}
+        self.offsets = None
+        self.centroids = None
+        self.ivf_rows = None
+        self.ivf_offsets = None
+        self._chunks_file = None
+        self._chunks = None
+
+    @property
+    def count(self):
+        return len(self.ids)
+
+    def _path(self, name):
+        return os.path.join(self.index_dir, name)
+
+    def load(self, fingerprint=None):
+        # fingerprint: impronta attuale della collezione; se l'indice e' stato esportato da un'altra
+        # versione (chunk aggiunti, rimossi o cambiati dopo l'export) non viene caricato
+        meta = read_meta(self.index_dir)
+        if meta is None or meta.get('versione') != INDEX_VERSION:
+            logger.warning(f"Indice locale non trovato o di un'altra versione in '{self.index_dir}'.")
+            return False
+        if fingerprint is not None and meta.get('impronta') != fingerprint:
+            logger.warning(f"Indice locale non allineato alla collezione in '{self.index_dir}': "
+                           f"riesegui 'create_vectorstore_docs.py'.")
+            return False
+        try:
+            start = time.time()
+            self.vectors = np.load(self._path("vectors.npy"), mmap_mode='r')
+            self.scales = np.load(self._path("scales.npy"), mmap_mode='r') if meta['dtype'] == "int8" else None
+            self.offsets = np.load(self._path("offsets.npy"), mmap_mode='r')
+            with open(self._path("ids.json"), 'r', encoding='utf-8') as f:
+                self.ids = json.load(f)
+            self.rows = {doc_id: row for row, doc_id in enumerate(self.ids)}
+            if len(self.vectors) != len(self.ids) or (self.scales is not None and len(self.scales) != len(self.ids)):
+                raise ValueError(f"{len(self.vectors)} vettori per {len(self.ids)} id")
+            if meta.get('ivf_lists'):
+                self.centroids = np.load(self._path("ivf_centroids.npy"))
+                self.ivf_rows = np.load(self._path("ivf_rows.npy"), mmap_mode='r')
+                self.ivf_offsets = np.load(self._path("ivf_offsets.npy"))
+            self._chunks_file = open(self._path("chunks.jsonl"), 'rb')
+            self._chunks = mmap.mmap(self._chunks_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Indice locale illeggibile ({self.index_dir}): {e}")
+            self.close()
+            return False
+        self.meta = meta
+        logger.info(f"Indice locale {meta['dtype']} caricato in {time.time() - start:.3f}s. "
+                    f"Elementi: {self.count}, IVF: {meta.get('ivf_lists') or 'no'}")
+        return True
+
+    def close(self):
+        if self._chunks is not None:
+            self._chunks.close()
+        if self._chunks_file is not None:
+            self._chunks_file.close()
+        self._chunks = self._chunks_file = None
+        self.vectors = self.scales = self.offsets = self.ivf_rows = None
+        self.meta = None
+
+    def _candidate_rows(self, query):
+        # IVF: righe dei nprobe gruppi piu' vicini, in ordine crescente (letture sequenziali sul file)
+        lists = np.argsort(self.centroids @ query)[::-1][:self.nprobe]
+        rows = np.concatenate([self.ivf_rows[self.ivf_offsets[i]:self.ivf_offsets[i + 1]] for i in lists])
+        rows.sort()
+        return rows
+
+    def search(self, query_embedding, n):
+        # Id dei n chunk piu' simili (coseno), dal piu' vicino
+        if not self.count or n <= 0:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        best_rows = []
+        best_scores = []
+        if self.centroids is not None:
+            rows = self._candidate_rows(query)
+            for start in range(0, len(rows), SEARCH_BLOCK_ROWS):
+                block_rows = rows[start:start + SEARCH_BLOCK_ROWS]
+                block = np.asarray(self.vectors[block_rows], dtype=np.float32)
+                if self.scales is not None:
+                    block *= self.scales[block_rows][:, None]
+                best_rows.append(block_rows)
+                best_scores.append(block @ query)
+        else:
+            for start in range(0, self.count, SEARCH_BLOCK_ROWS):
+                stop = min(start + SEARCH_BLOCK_ROWS, self.count)
+                scores = dequantize(self.vectors, self.scales, start, stop) @ query
+                top = np.argpartition(scores, -n)[-n:] if len(scores) > n else np.arange(len(scores))
+                best_rows.append(top + start)
+                best_scores.append(scores[top])
+        if not best_rows:
+            return []
+        rows = np.concatenate(best_rows)
+        scores = np.concatenate(best_scores)
+        if len(scores) > n:
+            top = np.argpartition(scores, -n)[-n:]
+            rows, scores = rows[top], scores[top]
+        return [self.ids[row] for row in rows[np.argsort(-scores)]]
+
+    def get(self, ids):
+        # Stesso formato di collection.get di Chroma (solo gli id presenti)
+        found_ids, documents, metadatas = [], [], []
+        for doc_id in ids:
+            row = self.rows.get(doc_id)
+            if row is None:
+                continue
+            chunk = json.loads(self._chunks[int(self.offsets[row]):int(self.offsets[row + 1])])
+            found_ids.append(doc_id)
+            documents.append(chunk['text'])
+            metadatas.append(chunk['metadata'])
+        return {'ids': found_ids, 'documents': documents, 'metadatas': metadatas}
+
+    def stats(self):
+        if self.meta is None:
+            return None
+        vector_bytes = self.vectors.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+        return {
+            "dtype": self.meta['dtype'], "count": self.count, "dim": self.meta['dim'],
+            "ivf_lists": self.meta.get('ivf_lists') or 0, "nprobe": self.nprobe if self.centroids is not None else None,
+            "vettori_mb": round(vector_bytes / 1e6, 2),
+            "vettori_float32_mb": round(self.count * self.meta['dim'] * 4 / 1e6, 2),
+        }